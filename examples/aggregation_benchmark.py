@@ -0,0 +1,189 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Windowed Aggregation Benchmark
+
+Feeds a WindowAggregator --events DiaChannelDataFull payloads spread over
+--devices devices of --channels channels each, --rate events per second of
+event time, up to --jitter seconds out of order.  Measures the events
+aggregated per second and the memory held, for tumbling windows and for
+sliding windows of --size seconds every --slide seconds.
+
+For comparison, the same is done by buffering each key's values and
+rescanning the window's values whenever it completes, as a callback
+without incremental aggregates would.
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import random
+import time
+
+from idigi_monitor_api import WindowAggregator
+from idigi_monitor_api.batching import parse_timestamp
+
+def get_parser():
+    """ Parser for this script """
+    parser = argparse.ArgumentParser(
+        description="Windowed Aggregation Benchmark",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--devices', dest='devices', type=int, default=1000,
+        help='Number of devices.')
+
+    parser.add_argument('--channels', dest='channels', type=int, default=4,
+        help='Number of channels of each device.')
+
+    parser.add_argument('--events', dest='events', type=int, default=600000,
+        help='Number of events fed to the aggregator.')
+
+    parser.add_argument('--rate', dest='rate', type=float, default=4000,
+        help='Events per second of event time.')
+
+    parser.add_argument('--size', dest='size', type=float, default=60,
+        help='Seconds covered by each window.')
+
+    parser.add_argument('--slide', dest='slide', type=float, default=5,
+        help='Seconds between sliding windows.')
+
+    parser.add_argument('--jitter', dest='jitter', type=float, default=2,
+        help='Seconds events may arrive out of order, also the lateness '
+            'allowed.')
+
+    return parser
+
+def timestamp(seconds):
+    """
+    Returns the iDigi timestamp (i.e. 2012-06-12T03:18:45.381Z) of a time.
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)) + \
+        '.%03dZ' % (seconds % 1 * 1000)
+
+def payloads(args):
+    """
+    Returns the DiaChannelDataFull payloads fed to the aggregators.
+    """
+    result = []
+    started = 1339471125.0
+    for i in xrange(args.events):
+        device = random.randrange(args.devices)
+        at = started + i / args.rate - random.uniform(0, args.jitter)
+        result.append(json.dumps({'Document' : {'Msg' : {
+            'topic' : 'DiaChannelDataFull',
+            'operation' : 'UPDATE',
+            'timestamp' : timestamp(at),
+            'DiaChannelDataFull' : {
+                'id' : {'devConnectwareId' :
+                            '00000000-00000000-00409DFF-%08X' % device,
+                        'ddInstanceName' : 'sensor%d' % (device % 4),
+                        'dcChannelName' : 'channel%d' %
+                            random.randrange(args.channels)},
+                'dcdStringValue' : '%.2f' % random.uniform(0, 100),
+                'dcUnits' : 'C'}}}}))
+    return result
+
+def rss():
+    """ Returns the current resident set size in MB """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / \
+            1048576.0
+
+class Rescan(object):
+    """
+    Buffers each key's values and computes each window from them once it
+    is complete.
+    """
+
+    def __init__(self, sink, size, slide, lateness):
+        self.sink      = sink
+        self.size      = size
+        self.slide     = slide
+        self.lateness  = lateness
+        self.values    = collections.defaultdict(list)
+        self.watermark = 0
+        self.closed    = None
+
+    def __call__(self, data):
+        msg = json.loads(data)['Document']['Msg']
+        channel_data = msg['DiaChannelDataFull']
+        channel_id = channel_data['id']
+        key = (channel_id['devConnectwareId'], "%s.%s" % \
+            (channel_id['ddInstanceName'], channel_id['dcChannelName']))
+        at = parse_timestamp(msg['timestamp'])
+        self.values[key].append((at, float(channel_data['dcdStringValue'])))
+        self.watermark = max(self.watermark, at - self.lateness)
+        end = int(self.watermark // self.slide) * self.slide
+        if self.closed is None:
+            self.closed = end
+        while self.closed < end:
+            self.closed += self.slide
+            results = []
+            for key, values in self.values.items():
+                values[:] = [(at, value) for at, value in values
+                            if at >= self.closed - self.size]
+                window = [(at, value) for at, value in values
+                        if at < self.closed]
+                if window:
+                    numbers = [value for _, value in window]
+                    results.append((key, self.closed, len(numbers),
+                                    min(numbers), max(numbers),
+                                    sum(numbers) / len(numbers),
+                                    max(window)[1]))
+                elif not values:
+                    del self.values[key]
+            self.sink(results)
+        return True
+
+def run(name, make, data):
+    """
+    Feeds data to the aggregator make returns, in a child process so that
+    the memory it holds is measured alone, and prints the rate and memory.
+    """
+    def child():
+        windows = [0]
+        def sink(results):
+            windows[0] += len(results)
+        before = rss()
+        aggregator = make(sink)
+        started = time.time()
+        for payload in data:
+            aggregator(payload)
+        elapsed = time.time() - started
+        held = ''
+        if isinstance(aggregator, WindowAggregator):
+            stats = aggregator.stats()
+            held = ', %d keys held, %d late' % (stats['keys'],
+                                                stats['late'])
+        print "%-20s %7.0f events/s %7d windows %6.1f MB%s" % (name,
+            len(data) / elapsed, windows[0], rss() - before, held)
+    process = multiprocessing.Process(target=child)
+    process.start()
+    process.join()
+
+def main():
+    """ Main function call """
+    args = get_parser().parse_args()
+    data = payloads(args)
+    print "%d events, %d keys, %.0f s of event time" % (len(data),
+        args.devices * args.channels, args.events / args.rate)
+
+    for slide in (args.size, args.slide):
+        kind = 'tumbling' if slide == args.size else 'sliding'
+        run('incremental ' + kind, lambda sink: WindowAggregator(sink,
+            args.size, slide, args.jitter), data)
+        run('rescan ' + kind, lambda sink: Rescan(sink, args.size, slide,
+            args.jitter), data)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Autoscale Benchmark
+
+Shows how an autoscaling callback worker pool responds to a step change in
+message rate.  A local fake push server (see soak_test.py) sends each
+session a message every --interval seconds, and callbacks block for
+--callback-time seconds as if waiting on a database.  The run starts with
+--low sessions, steps up to --high sessions, then back down, printing the
+delivery rate, worker count, utilization and delivery latency every second.
+
+The fake server listens on the insecure push port (3200) of --host, so
+nothing else may be using it.
+"""
+import argparse
+import logging
+import multiprocessing
+import threading
+import time
+
+from idigi_monitor_api import push_client
+from soak_test import FakePushServer
+
+def get_parser():
+    """ Parser for this script """
+    parser = argparse.ArgumentParser(description="Autoscale Benchmark",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+        help='Address the fake server listens on.')
+
+    parser.add_argument('--interval', dest='interval', type=float,
+        default=0.01, help='Seconds between messages on each session.')
+
+    parser.add_argument('--callback-time', dest='callback_time', type=float,
+        default=0.005, help='Seconds each callback blocks for.')
+
+    parser.add_argument('--low', dest='low', type=int, default=2,
+        help='Sessions before and after the step.')
+
+    parser.add_argument('--high', dest='high', type=int, default=20,
+        help='Sessions during the step.')
+
+    parser.add_argument('--phase', dest='phase', type=float, default=15,
+        help='Seconds each phase lasts.')
+
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+        help='Minimum number of callback workers.')
+
+    parser.add_argument('--max-workers', dest='max_workers', type=int,
+        default=32, help='Maximum number of callback workers, equal to ' \
+        '--workers for a fixed pool.')
+
+    return parser
+
+def report(client, started, delivered, last):
+    """
+    Prints one line of progress, returns the delivered count it was for.
+    """
+    count = delivered[0]
+    workers = client.worker_stats()
+    latency = client.lane_stats()[1]
+    print "%5.1fs %7d msgs/s workers %3d utilization %.2f queued %4d " \
+        "p99 latency %7.1f ms" % (time.time() - started, count - last,
+        workers['size'], workers['utilization'], workers['queued'],
+        latency['p99_latency'] * 1000)
+    return count
+
+def main():
+    """ Main function call """
+    args = get_parser().parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.WARNING)
+
+    server = FakePushServer(args.host, args.interval, 0, 0, False)
+    server_process = multiprocessing.Process(target=server.serve_forever)
+    server_process.daemon = True
+    server_process.start()
+    time.sleep(1)
+
+    lock = threading.Lock()
+    delivered = [0]
+    def callback(data):
+        time.sleep(args.callback_time)
+        with lock:
+            delivered[0] += 1
+        return True
+
+    client = push_client('bench', 'bench', hostname=args.host, secure=False,
+                        workers=args.workers, max_workers=args.max_workers)
+    sessions = [client.create_session(callback, monitor_id)
+                for monitor_id in xrange(args.low)]
+
+    started = time.time()
+    last = 0
+    try:
+        for count in (args.low, args.high, args.low):
+            while len(sessions) < count:
+                sessions.append(client.create_session(callback,
+                                                    len(sessions)))
+            while len(sessions) > count:
+                sessions.pop().stop()
+            print "--- %d sessions, %d msgs/s offered" % \
+                (count, count / args.interval)
+            phase_end = time.time() + args.phase
+            while time.time() < phase_end:
+                time.sleep(1)
+                last = report(client, started, delivered, last)
+    finally:
+        client.stop_all()
+        server_process.terminate()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Backfill Demo
+
+Shows a GapBackfill recovering the events a monitor missed during an
+outage.  A local fake push server publishes a DeviceCore event every
+--interval seconds and records it in a history served by a local fake web
+service at /ws/DeviceCore.  After --outage-at seconds it drops the
+connection and holds off accepting the reconnect for --outage seconds, so
+the events published meanwhile only reach the history.
+
+Once the run ends, the events delivered to the callback are checked to be
+every event published, each exactly once and in order.  Exits with status 1
+otherwise.
+
+The fake push server listens on the insecure push port (3200) of --host,
+so nothing else may be using it.
+"""
+import argparse
+import json
+import logging
+import socket
+import struct
+import sys
+import threading
+import time
+import urlparse
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from idigi_monitor_api import push_client, GapBackfill
+from idigi_monitor_api.push_client import PUSH_OPEN_PORT, \
+    CONNECTION_RESPONSE, PUBLISH_MESSAGE, STATUS_OK
+
+LOG = logging.getLogger("backfill_demo")
+
+def get_parser():
+    """ Parser for this script """
+    parser = argparse.ArgumentParser(description="Backfill Demo",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+        help='Address the fake servers listen on.')
+
+    parser.add_argument('--web-port', dest='web_port', type=int,
+        default=8080, help='Port of the fake web service.')
+
+    parser.add_argument('--web-latency', dest='web_latency', type=float,
+        default=0.05, help='Seconds the fake web service takes per request.')
+
+    parser.add_argument('--interval', dest='interval', type=float,
+        default=0.002, help='Seconds between events.')
+
+    parser.add_argument('--duration', dest='duration', type=float,
+        default=8, help='Seconds events are published for.')
+
+    parser.add_argument('--outage-at', dest='outage_at', type=float,
+        default=2, help='Seconds into the run the connection is dropped.')
+
+    parser.add_argument('--outage', dest='outage', type=float, default=3,
+        help='Seconds the push server does not accept the reconnect.')
+
+    parser.add_argument('--page-size', dest='page_size', type=int,
+        default=100, help='Items per backfill query.')
+
+    parser.add_argument('--parallel', dest='parallel', type=int, default=4,
+        help='Backfill pages fetched at once.')
+
+    return parser
+
+def timestamp(seconds):
+    """
+    Returns the iDigi timestamp (i.e. 2012-06-12T03:18:45.381Z) of a time.
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)) + \
+        '.%03dZ' % (seconds % 1 * 1000)
+
+class FakeIdigi(object):
+    """
+    Publishes DeviceCore events to the push session connected, if any, and
+    records all of them in a history.
+    """
+
+    def __init__(self, host, interval, outage_at, outage):
+        """
+        :param host: Address to listen on.
+        :param interval: Seconds between events.
+        :param outage_at: Seconds after start the connection is dropped.
+        :param outage: Seconds reconnects are held off for.
+        """
+        self.host       = host
+        self.interval   = interval
+        self.outage_at  = outage_at
+        self.outage     = outage
+        self.history    = []
+        self.connection = None
+        # Events published while no session was connected.
+        self.missed     = 0
+        self.lock       = threading.Lock()
+        self.started    = time.time()
+        self.listener   = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, PUSH_OPEN_PORT))
+        self.listener.listen(5)
+
+    def accept(self):
+        """
+        Accepts push sessions, holding off those made during the outage.
+        """
+        while True:
+            conn, _ = self.listener.accept()
+            conn.recv(65536)
+            resume = self.started + self.outage_at + self.outage
+            if self.started + self.outage_at <= time.time() < resume:
+                time.sleep(resume - time.time())
+            conn.sendall(struct.pack('!HIHH', CONNECTION_RESPONSE, 4,
+                                    STATUS_OK, 0))
+            with self.lock:
+                self.connection = conn
+            thread = threading.Thread(target=self.drain, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def drain(self, conn):
+        """
+        Reads and discards the acknowledgements of a session.
+        """
+        try:
+            while conn.recv(65536):
+                pass
+        except socket.error:
+            pass
+
+    def publish(self, duration):
+        """
+        Publishes an event every interval for duration seconds, dropping
+        the connection once outage_at seconds have passed.
+        """
+        block_id = 0
+        dropped = False
+        while time.time() < self.started + duration:
+            block_id = (block_id + 1) % 65536
+            sequence = len(self.history)
+            item = {'id' : {'devId' : sequence},
+                    'devConnectwareId' : '00000000-00000000-00409DFF-FF000001',
+                    # Synthetic times, one interval apart, so no two events
+                    # share a timestamp.
+                    'dpLastConnectTime' : timestamp(self.started +
+                                                sequence * self.interval)}
+            payload = json.dumps({'Document' : {'Msg' : {
+                'topic' : '1/DeviceCore/%d/0' % sequence,
+                'operation' : 'UPDATE',
+                'timestamp' : item['dpLastConnectTime'],
+                'DeviceCore' : item}}})
+            body = struct.pack('!HHBBI', block_id, 1, 0, 0, len(payload)) + \
+                payload
+            with self.lock:
+                self.history.append(item)
+                if not dropped and \
+                        time.time() >= self.started + self.outage_at:
+                    dropped = True
+                    if self.connection is not None:
+                        self.connection.shutdown(socket.SHUT_RDWR)
+                        self.connection.close()
+                        self.connection = None
+                if self.connection is None:
+                    self.missed += 1
+                else:
+                    self.connection.sendall(struct.pack('!HI',
+                                            PUBLISH_MESSAGE, len(body)) + body)
+            time.sleep(self.interval)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """ An HTTPServer serving each connection from its own thread """
+    daemon_threads = True
+
+def web_service(idigi, host, port, latency):
+    """
+    Returns an HTTP server answering /ws/DeviceCore queries of the form
+    GapBackfill makes from idigi's history.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        """ Serves one page of history """
+        # Keeps connections open for the client's pool.
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            """ Handles a GET request """
+            url = urlparse.urlparse(self.path)
+            query = dict(urlparse.parse_qsl(url.query))
+            since = query['condition'].split("'")[1]
+            start = int(query.get('start', 0))
+            size = int(query.get('size', 1000))
+            time.sleep(latency)
+            with idigi.lock:
+                items = [item for item in idigi.history
+                        if item['dpLastConnectTime'] >= since]
+            content = json.dumps({'resultTotalRows' : len(items),
+                                'requestedStartRow' : start,
+                                'resultSize' : len(items[start:start + size]),
+                                'requestedSize' : size,
+                                'remainingSize' : max(0, len(items) - start
+                                                    - size),
+                                'items' : items[start:start + size]})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            """ Keeps requests out of the output """
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+def main():
+    """ Main function call """
+    args = get_parser().parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+
+    idigi = FakeIdigi(args.host, args.interval, args.outage_at, args.outage)
+    web = web_service(idigi, args.host, args.web_port, args.web_latency)
+    for target in (idigi.accept, web.serve_forever):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+    delivered = []
+    backfilled = [0]
+    def callback(msg):
+        delivered.append(msg['DeviceCore']['id']['devId'])
+        if msg.get('backfilled'):
+            backfilled[0] += 1
+        return True
+
+    client = push_client('demo', 'demo', hostname=args.host, secure=False)
+    backfill = GapBackfill(client, callback, ['DeviceCore'],
+                            page_size=args.page_size, parallel=args.parallel,
+                            hostname='%s:%d' % (args.host, args.web_port))
+    client.create_session(backfill, 1, on_connect=backfill.connected)
+    try:
+        idigi.publish(args.duration)
+        time.sleep(1)
+    finally:
+        client.stop_all()
+        backfill.pool.close()
+        web.shutdown()
+
+    published = len(idigi.history)
+    print "Published %d events, %d during the outage." % (published,
+                                                        idigi.missed)
+    print "Delivered %d events, %d of them backfilled." % (len(delivered),
+                                                        backfilled[0])
+    if delivered != range(published):
+        missing = len(set(xrange(published)) - set(delivered))
+        duplicates = len(delivered) - len(set(delivered))
+        print "FAILED: %d missing, %d duplicated, in order: %s." % (missing,
+            duplicates, delivered == sorted(delivered))
+        sys.exit(1)
+    print "Every event delivered exactly once, in order."
+
+if __name__ == "__main__":
+    main()
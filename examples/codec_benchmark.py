@@ -0,0 +1,162 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Codec Benchmark
+
+Compares the time each installed JSON backend takes to decode batched
+DeviceCore, FileData and DiaChannelDataFull documents shaped like those
+pushed by iDigi.  Call with '-h' for usage.
+"""
+import argparse
+import base64
+import json
+import os
+import time
+
+from idigi_monitor_api.codec import JSON_BACKENDS, json_backend
+
+def device_core(i):
+    """ A DeviceCore Msg """
+    return {"topic" : "1210/DeviceCore/%d/0" % (7200 + i),
+            "group" : "*",
+            "operation" : "UPDATE",
+            "timestamp" : "2012-06-12T03:18:45.381Z",
+            "DeviceCore" : {
+                "id" : {"devId" : 7200 + i, "devVersion" : 0},
+                "devRecordStartDate" : "2012-06-01T00:00:00.000Z",
+                "devMac" : "00:40:9D:49:%02X:%02X" % (i >> 8 & 255, i & 255),
+                "devConnectwareId" : "00000000-00000000-00409DFF-FF%06X" % i,
+                "cstId" : 1210,
+                "grpId" : 1210,
+                "devEffectiveStartDate" : "2012-06-01T00:00:00.000Z",
+                "devTerminated" : "false",
+                "dvVendorId" : 4261412864,
+                "dpDeviceType" : "ConnectPort X2",
+                "dpFirmwareLevel" : 34472456,
+                "dpFirmwareLevelDesc" : "2.14.0.8",
+                "dpRestrictedStatus" : 0,
+                "dpLastKnownIp" : "10.8.%d.%d" % (i >> 8 & 255, i & 255),
+                "dpGlobalIp" : "66.77.174.%d" % (i & 255),
+                "dpConnectionStatus" : i % 2,
+                "dpLastConnectTime" : "2012-06-12T03:18:45.157Z",
+                "dpContact" : "",
+                "dpDescription" : "",
+                "dpLocation" : "",
+                "dpPanId" : "0x1234",
+                "xpExtAddr" : "00:13:A2:00:40:%02X:%02X:%02X" % \
+                    (i >> 16 & 255, i >> 8 & 255, i & 255),
+                "dpServerId" : "ClientID[3]",
+                "dpZigbeeCapabilities" : 383,
+                "dpCapabilities" : 6378}}
+
+def file_data(i, size):
+    """ A FileData Msg with size bytes of content """
+    device = "00000000-00000000-00409DFF-FF%06X" % i
+    return {"topic" : "1210/FileData/~/%s/trace/trace.log" % device,
+            "group" : "*",
+            "operation" : "INSERT",
+            "timestamp" : "2012-06-12T03:18:45.381Z",
+            "FileData" : {
+                "id" : {"fdPath" : "/~/%s/trace/" % device,
+                        "fdName" : "trace%d.log" % i},
+                "cstId" : 1210,
+                "fdCreatedDate" : "2012-06-12T03:18:45.381Z",
+                "fdLastModifiedDate" : "2012-06-12T03:18:45.381Z",
+                "fdContentType" : "application/octet-stream",
+                "fdSize" : size,
+                "fdType" : "file",
+                "fdData" : base64.b64encode(os.urandom(size))}}
+
+def dia_channel(i):
+    """ A DiaChannelDataFull Msg """
+    return {"topic" : "1210/DiaChannelDataFull/00000000-00000000-00409DFF-" \
+                "FF%06X/xbee/temperature" % (i % 100),
+            "group" : "*",
+            "operation" : "INSERT",
+            "timestamp" : "2012-06-12T03:18:45.381Z",
+            "DiaChannelDataFull" : {
+                "id" : {"devConnectwareId" :
+                            "00000000-00000000-00409DFF-FF%06X" % (i % 100),
+                        "ddInstanceName" : "xbee",
+                        "dcChannelName" : "temperature"},
+                "cstId" : 1210,
+                "dcdUpdateTime" : "2012-06-12T03:18:45.381Z",
+                "dcdStringValue" : "%.2f" % (20 + (i % 50) / 10.0),
+                "dcdIntegerValue" : 20 + i % 5,
+                "dcdFloatValue" : 20 + (i % 50) / 10.0,
+                "dcdUnits" : "C",
+                "dcdDataType" : 2}}
+
+def document(msgs):
+    """ Returns a batched json Document of msgs """
+    return json.dumps({"Document" : {"Msg" : msgs}})
+
+def get_parser():
+    """ Parser for this script """
+    parser = argparse.ArgumentParser(description="Codec Benchmark",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--batch', '-b', dest='batch', type=int, default=100,
+        help='Msgs per document.')
+
+    parser.add_argument('--file-size', dest='file_size', type=int,
+        default=2048, help='Bytes of content of each FileData Msg.')
+
+    parser.add_argument('--seconds', '-s', dest='seconds', type=float,
+        default=2.0, help='Seconds to run each measurement for.')
+
+    return parser
+
+def measure(loads, data, seconds):
+    """
+    Returns the average seconds loads takes to decode data.
+    """
+    count = 0
+    start = time.time()
+    while True:
+        loads(data)
+        count += 1
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            return elapsed / count
+
+def main():
+    """ Main function call """
+    args = get_parser().parse_args()
+    documents = [
+        ('DeviceCore', document([device_core(i)
+                                for i in range(args.batch)])),
+        ('FileData', document([file_data(i, args.file_size)
+                                for i in range(args.batch)])),
+        ('DiaChannelDataFull', document([dia_channel(i)
+                                        for i in range(args.batch)]))]
+
+    backends = []
+    for name in JSON_BACKENDS:
+        try:
+            backends.append(json_backend(name))
+        except ImportError:
+            print "%s is not installed." % name
+
+    print "%-20s %-12s %10s %10s %10s" % ("Document", "Backend", "ms/doc",
+                                        "MB/s", "vs json")
+    for document_name, data in documents:
+        results = [(name, measure(loads, data, args.seconds))
+                    for name, loads in backends]
+        baseline = dict(results)['json']
+        for name, elapsed in results:
+            print "%-20s %-12s %10.3f %10.1f %9.2fx" % (document_name, name,
+                elapsed * 1000, len(data) / elapsed / 1048576,
+                baseline / elapsed)
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ import sys
 sys.path.append('..')
 
 from idigi_monitor_api import push_client
+from idigi_monitor_api.batching import DiaChannelBatcher
 import logging
 import time
 import json
@@ -26,6 +27,19 @@ def trace_callback(data):
         print repr(e)
     return False
 
+def batch_sink(batch):
+    """
+    Sink for columnar batches, prints one summary line per channel.
+    """
+    counts = {}
+    for i in xrange(len(batch)):
+        key = (batch.devices[i], batch.channels[i])
+        counts[key] = counts.get(key, 0) + 1
+    for (device, channel), count in sorted(counts.items()):
+        sys.stdout.write("%s %s %d events\n" % 
+                         (batch.device_table[device], 
+                          batch.channel_table[channel], count))
+
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', 
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
 
@@ -46,6 +60,10 @@ if __name__ == "__main__":
     parser.add_argument('--host', '-a', dest='host', action='store', 
         type=str, default='developer.idigi.com', 
         help='iDigi server to connect to.')
+
+    parser.add_argument('--columnar', dest='columnar', action='store_true',
+        default=False,
+        help='Collect events into columnar batches and print summaries.')
     
     args = parser.parse_args()
 
@@ -65,8 +83,10 @@ if __name__ == "__main__":
 
     monitor = client.create_monitor(topics, format_type='json')
 
+    # Batched events are acknowledged once printed.
+    callback = DiaChannelBatcher(batch_sink, ack_after_sink=True) \
+        if args.columnar else trace_callback
     try:
-        callback = trace_callback
         session = client.create_session(callback, monitor)
         while True:
             time.sleep(3.14)
@@ -76,4 +96,7 @@ if __name__ == "__main__":
     Closing Sessions and Cleaning Up.")
     finally:
         client.stop_all()
+        if args.columnar:
+            # Stops its timer thread and prints the last batch.
+            callback.close()
         #client.delete_monitor(monitor)
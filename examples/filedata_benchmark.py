@@ -0,0 +1,197 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+FileData Sink Benchmark
+
+Feeds FileData payloads of --batch files each to a FileDataSink from
+--callbacks threads, as callback workers would, and measures the files
+and bytes written per second: --small-files files of --small-size bytes,
+then --large-files files of --large-size bytes, spread over --devices
+device directories under --dest (a temporary directory by default).
+
+For comparison, the same is done by a callback writing each file itself,
+as filedata_client.py used to: makedirs for every file, ignoring any
+error, then a synchronous open, write and (with --fsync) fsync.
+"""
+import argparse
+import base64
+import errno
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from Queue import Queue
+
+from idigi_monitor_api.filedata import FileDataSink
+
+def get_parser():
+    """ Parser for this script """
+    parser = argparse.ArgumentParser(description="FileData Sink Benchmark",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--dest', dest='dest', type=str, default=None,
+        help='Directory to write under, removed afterwards.')
+
+    parser.add_argument('--small-files', dest='small_files', type=int,
+        default=100000, help='Number of small files.')
+
+    parser.add_argument('--small-size', dest='small_size', type=int,
+        default=512, help='Bytes of each small file.')
+
+    parser.add_argument('--large-files', dest='large_files', type=int,
+        default=1000, help='Number of large files.')
+
+    parser.add_argument('--large-size', dest='large_size', type=int,
+        default=4194304, help='Bytes of each large file.')
+
+    parser.add_argument('--batch', '-b', dest='batch', type=int, default=50,
+        help='Files per payload of small files, large files are sent one '
+            'per payload.')
+
+    parser.add_argument('--devices', dest='devices', type=int, default=100,
+        help='Number of device directories.')
+
+    parser.add_argument('--callbacks', dest='callbacks', type=int, default=4,
+        help='Callback threads.')
+
+    parser.add_argument('--writers', dest='writers', type=int, default=8,
+        help='Writer threads of the sink.')
+
+    parser.add_argument('--fsync', dest='fsync', action='store_true',
+        help='Sync files and directories to disk.')
+
+    return parser
+
+def payloads(count, size, batch, devices):
+    """
+    Yields FileData payloads of batch files of size bytes, count files in
+    all.  The content is the same for every file, so that generating it
+    does not dominate.
+    """
+    encoded = base64.b64encode(os.urandom(size))
+    for first in xrange(0, count, batch):
+        msgs = []
+        for i in xrange(first, min(count, first + batch)):
+            device = "00000000-00000000-00409DFF-FF%06X" % (i % devices)
+            msgs.append({"topic" : "1210/FileData/~/%s/upload/file%d.bin" %
+                            (device, i),
+                        "operation" : "INSERT",
+                        "timestamp" : "2012-06-12T03:18:45.381Z",
+                        "FileData" : {
+                            "id" : {"fdPath" : "/~/%s/upload/" % device,
+                                    "fdName" : "file%d.bin" % i},
+                            "fdLastModifiedDate" :
+                                "2012-06-12T03:18:45.381Z",
+                            "fdSize" : size,
+                            "fdData" : encoded}})
+        yield json.dumps({"Document" : {"Msg" : msgs}})
+
+class Synchronous(object):
+    """
+    Writes each file from the callback thread, as filedata_client.py used
+    to.
+    """
+
+    def __init__(self, dest_root, fsync):
+        self.dest_root = dest_root
+        self.fsync     = fsync
+
+    def __call__(self, data):
+        msgs = json.loads(data)['Document']['Msg']
+        if isinstance(msgs, dict):
+            msgs = [msgs]
+        for msg in msgs:
+            filedata = msg['FileData']
+            modified = filedata['fdLastModifiedDate']
+            directory = os.path.join(self.dest_root,
+                                    filedata['id']['fdPath'][1:],
+                                    '%d/%d/%d' % (int(modified[0:4]),
+                                                    int(modified[5:7]),
+                                                    int(modified[8:10])))
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+            with open(os.path.join(directory, filedata['id']['fdName']),
+                        'wb') as output:
+                output.write(base64.b64decode(filedata['fdData']))
+                if self.fsync:
+                    output.flush()
+                    os.fsync(output.fileno())
+        return True
+
+def run(name, callback, data, callbacks):
+    """
+    Calls callback with every payload of data from callbacks threads,
+    returns the seconds taken.
+    """
+    queue = Queue(callbacks * 2)
+    failures = []
+    def worker():
+        while True:
+            payload = queue.get()
+            if payload is None:
+                return
+            if not callback(payload):
+                failures.append(payload)
+    threads = [threading.Thread(target=worker) for _ in xrange(callbacks)]
+    for thread in threads:
+        thread.start()
+    started = time.time()
+    for payload in data:
+        queue.put(payload)
+    for _ in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    if failures:
+        print "%s: %d payloads failed" % (name, len(failures))
+    return elapsed
+
+def main():
+    """ Main function call """
+    args = get_parser().parse_args()
+    root = args.dest or tempfile.mkdtemp(prefix='filedata_benchmark')
+    print "%-12s %-12s %9s %9s %9s" % ("Files", "Writer", "seconds",
+                                        "files/s", "MB/s")
+    try:
+        for count, size, batch in ((args.small_files, args.small_size,
+                                    args.batch),
+                                    (args.large_files, args.large_size, 1)):
+            if not count:
+                continue
+            for name in ('sink', 'synchronous'):
+                dest = os.path.join(root, name)
+                if name == 'sink':
+                    callback = FileDataSink(dest, writers=args.writers,
+                                            fsync=args.fsync)
+                else:
+                    callback = Synchronous(dest, args.fsync)
+                elapsed = run(name, callback, payloads(count, size, batch,
+                                args.devices), args.callbacks)
+                print "%-12s %-12s %9.1f %9.0f %9.1f" % ("%d x %d" % (count,
+                    size), name, elapsed, count / elapsed,
+                    count * size / elapsed / 1048576)
+                shutil.rmtree(dest)
+    finally:
+        try:
+            shutil.rmtree(root)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+
+if __name__ == "__main__":
+    main()
@@ -6,57 +6,21 @@ NEEDS TO BE RUN WITH ACCESS TO https://github.com/digidotcom/idigi-python-monito
 based on push_client.py
 """
 import argparse
-import base64
-import iso8601
-import json
 import logging
-import os.path
 import time
-import zlib
 
-from xml.dom.minidom import parseString
 from idigi_monitor_api import push_client
+from idigi_monitor_api.filedata import FileDataSink
 
 LOG = logging.getLogger("filedata_client")
 
-def json_cb(dest_root):
+def message_topic(msg):
     """
-    Sample callback, parses data as json and pretty prints it.
-    Returns True if json is valid, False otherwise.
+    Only write FileData pushed under a message directory.
 
-    :param data: The payload of the PublishMessage.
+    :param msg: The decoded FileData Msg.
     """
-    def callback(data):
-        try:
-            json_data = json.loads(data)
-            for msg in json_data['Document']['Msg']:
-                try:
-                    if 'message' in msg['topic'] and 'FileData' in msg['topic']:
-                        filedata = msg['FileData']
-                        if 'id' in filedata and 'fdData' in filedata:
-                            fileid = filedata.get('id')
-                            modtime = iso8601.parse_date(filedata['fdLastModifiedDate'])
-                            filepath = os.path.join(dest_root, fileid['fdPath'][1:], '%d/%d/%d' % (modtime.year, modtime.month, modtime.day))
-                            filename = os.path.join(filepath, fileid['fdName'])
-
-                            try:
-                                os.makedirs(filepath)
-                            except Exception:
-                                pass
-                            with open(filename, 'w') as f:
-                                f.write(base64.b64decode(filedata['fdData']))
-
-                            #LOG.info("Data Received %s" % json.dumps(msg, sort_keys=True,
-                            #                                     indent=4))
-                        LOG.info("Received FileData %s", msg['topic'])
-                except Exception:
-                    LOG.exception(str(msg))
-            return True
-        except Exception, exception:
-            LOG.exception(data)
-
-        return False
-    return callback
+    return 'message' in msg['topic']
 
 def get_parser():
     """ Parser for this script """
@@ -93,6 +57,10 @@ def get_parser():
         required=True,
         help='Root directory to dump FileData files')
 
+    parser.add_argument('--writers', '-w', dest='writers', type=int,
+        default=4,
+        help='Number of threads writing files to disk.')
+
     return parser
 
 def loop(args):
@@ -118,7 +86,8 @@ def loop(args):
         batch_duration=args.batchduration)
 
     try:
-        callback = json_cb(args.dest_root)
+        callback = FileDataSink(args.dest_root, writers=args.writers,
+                                match=message_topic)
         client.create_session(callback, monitor_id)
         while True:
             time.sleep(.31416)
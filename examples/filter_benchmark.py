@@ -0,0 +1,129 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Message Filter Benchmark
+
+Compares the CPU time spent on --documents batched documents of --batch
+DiaChannelDataFull messages by a callback that decodes every document
+and keeps the messages of one device, with that of a MessageFilter
+dropping the other messages before the remaining ones are decoded.  The
+share of messages kept is 1%, 10% and 50%.
+"""
+import argparse
+import json
+import os
+
+from idigi_monitor_api import MessageFilter
+
+# Device whose messages are kept.
+WANTED = "00000000-00000000-00409DFF-FF000000"
+
+def get_parser():
+    """ Parser for this script """
+    parser = argparse.ArgumentParser(description="Message Filter Benchmark",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--documents', '-n', dest='documents', type=int,
+        default=200, help='Number of documents.')
+
+    parser.add_argument('--batch', '-b', dest='batch', type=int, default=100,
+        help='Msgs per document.')
+
+    parser.add_argument('--rounds', '-r', dest='rounds', type=int, default=5,
+        help='Times each document is processed.')
+
+    return parser
+
+def dia_channel(i, device):
+    """ A DiaChannelDataFull Msg of device """
+    return {"topic" : "1210/DiaChannelDataFull/%s/xbee/temperature" % device,
+            "group" : "*",
+            "operation" : "INSERT",
+            "timestamp" : "2012-06-12T03:18:45.381Z",
+            "DiaChannelDataFull" : {
+                "id" : {"devConnectwareId" : device,
+                        "ddInstanceName" : "xbee",
+                        "dcChannelName" : "temperature"},
+                "cstId" : 1210,
+                "dcdUpdateTime" : "2012-06-12T03:18:45.381Z",
+                "dcdStringValue" : "%.2f" % (20 + (i % 50) / 10.0),
+                "dcdIntegerValue" : 20 + i % 5,
+                "dcdFloatValue" : 20 + (i % 50) / 10.0,
+                "dcdUnits" : "C",
+                "dcdDataType" : 2}}
+
+def documents(args, selectivity):
+    """
+    Returns the documents, in which selectivity of the messages are those
+    of WANTED.
+    """
+    result = []
+    wanted = 0
+    for d in xrange(args.documents):
+        msgs = []
+        for i in xrange(args.batch):
+            n = d * args.batch + i
+            if int((n + 1) * selectivity) > wanted:
+                wanted += 1
+                device = WANTED
+            else:
+                device = "00000000-00000000-00409DFF-FF%06X" % (1 + n % 997)
+            msgs.append(dia_channel(n, device))
+        result.append(json.dumps({"Document" : {"Msg" : msgs}}))
+    return result
+
+def decode_all(data):
+    """ Decodes the document and keeps the messages of WANTED """
+    msgs = json.loads(data)['Document']['Msg']
+    if isinstance(msgs, dict):
+        msgs = [msgs]
+    return [msg for msg in msgs if
+            msg['DiaChannelDataFull']['id']['devConnectwareId'] == WANTED]
+
+def filtered(message_filter):
+    """ Returns a callback decoding what message_filter keeps """
+    def callback(data):
+        data = message_filter.apply(data)
+        if data is None:
+            return []
+        msgs = json.loads(data)['Document']['Msg']
+        return [msgs] if isinstance(msgs, dict) else msgs
+    return callback
+
+def measure(callback, data, rounds):
+    """
+    Returns the CPU seconds callback takes on data, and the messages kept.
+    """
+    kept = 0
+    start = sum(os.times()[:2])
+    for _ in xrange(rounds):
+        for document in data:
+            kept += len(callback(document))
+    return sum(os.times()[:2]) - start, kept / rounds
+
+def main():
+    """ Main function call """
+    args = get_parser().parse_args()
+    message_filter = MessageFilter(device_ids=[WANTED])
+
+    print "%-12s %12s %12s %10s %8s" % ("Selectivity", "decode all s",
+                                        "filtered s", "CPU saved", "kept")
+    for selectivity in (0.01, 0.1, 0.5):
+        data = documents(args, selectivity)
+        baseline, expected = measure(decode_all, data, args.rounds)
+        elapsed, kept = measure(filtered(message_filter), data, args.rounds)
+        assert kept == expected, (kept, expected)
+        print "%11.0f%% %12.2f %12.2f %9.0f%% %8d" % (selectivity * 100,
+            baseline, elapsed, (1 - elapsed / baseline) * 100, kept)
+
+if __name__ == "__main__":
+    main()
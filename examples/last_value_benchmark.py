@@ -0,0 +1,151 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Last Value Cache Benchmark
+
+Feeds a LastValueCache DiaChannelDataFull payloads for --devices devices of
+--channels channels each, then measures:
+
+    - ingestion rate, in memory and persisted to a file
+    - lookup time
+    - snapshot and iteration time, and the ingestion rate while another
+      thread takes --snapshot-rate snapshots per second
+    - the time to warm-start a new cache from the file, and that it holds
+      the same values
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+from idigi_monitor_api import LastValueCache
+
+def get_parser():
+    """ Parser for this script """
+    parser = argparse.ArgumentParser(description="Last Value Cache Benchmark",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--devices', dest='devices', type=int, default=10000,
+        help='Number of devices.')
+
+    parser.add_argument('--channels', dest='channels', type=int, default=10,
+        help='Number of channels of each device.')
+
+    parser.add_argument('--updates', dest='updates', type=int,
+        default=500000, help='Number of updates fed to the cache.')
+
+    parser.add_argument('--snapshot-rate', dest='snapshot_rate', type=float,
+        default=10, help='Snapshots per second taken while ingesting.')
+
+    return parser
+
+def payloads(devices, channels, count):
+    """
+    Returns count DiaChannelDataFull payloads of random channels, with
+    increasing timestamps.
+    """
+    result = []
+    for i in xrange(count):
+        device = random.randrange(devices)
+        result.append(json.dumps({'Document' : {'Msg' : {
+            'topic' : 'DiaChannelDataFull',
+            'operation' : 'UPDATE',
+            'timestamp' : '2012-06-12T03:%02d:%02d.%03dZ' % (i / 60000 % 60,
+                                                    i / 1000 % 60, i % 1000),
+            'DiaChannelDataFull' : {
+                'id' : {'devConnectwareId' :
+                            '00000000-00000000-00409DFF-%08X' % device,
+                        'ddInstanceName' : 'sensor%d' % (device % 4),
+                        'dcChannelName' : 'channel%d' %
+                            random.randrange(channels)},
+                'dcdStringValue' : '%.2f' % random.uniform(0, 100),
+                'dcUnits' : 'C'}}}}))
+    return result
+
+def rss():
+    """ Returns the maximum resident set size in MB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def ingest(cache, data):
+    """ Feeds data to cache, returns the updates per second """
+    started = time.time()
+    for payload in data:
+        cache(payload)
+    return len(data) / (time.time() - started)
+
+def main():
+    """ Main function call """
+    args = get_parser().parse_args()
+    data = payloads(args.devices, args.channels, args.updates)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'lastvalues')
+    try:
+        memory = LastValueCache()
+        before = rss()
+        rate = ingest(memory, data)
+        print "in memory: %d keys, %.0f updates/s, %.1f MB" % (len(memory),
+            rate, rss() - before)
+
+        cache = LastValueCache(path)
+        rate = ingest(cache, data)
+        print "persisted: %d keys, %.0f updates/s, file %.1f MB" % \
+            (len(cache), rate, os.path.getsize(path) / 1048576.0)
+
+        keys = [(device, channel) for device, channel, _, _ in cache.items()]
+        probes = [random.choice(keys) for _ in xrange(1000000)]
+        started = time.time()
+        for device, channel in probes:
+            cache.get(device, channel)
+        print "get: %.2f us" % ((time.time() - started) / len(probes) * 1e6)
+
+        started = time.time()
+        snapshot = cache.snapshot()
+        print "snapshot of %d values: %.1f ms" % (len(snapshot),
+            (time.time() - started) * 1000)
+        started = time.time()
+        count = sum(1 for _ in cache.items())
+        print "items over %d values: %.1f ms" % (count,
+            (time.time() - started) * 1000)
+
+        # Ingestion while another thread takes snapshots, as a dashboard
+        # refreshing would.
+        stop = threading.Event()
+        taken = [0]
+        def snapshots():
+            while not stop.wait(1.0 / args.snapshot_rate):
+                cache.snapshot()
+                taken[0] += 1
+        thread = threading.Thread(target=snapshots)
+        thread.start()
+        rate = ingest(cache, data[:100000])
+        stop.set()
+        thread.join()
+        print "persisted while snapshotting: %.0f updates/s, %d snapshots" % \
+            (rate, taken[0])
+
+        expected = cache.snapshot()
+        cache.close()
+        started = time.time()
+        warm = LastValueCache(path)
+        print "warm start of %d values: %.1f ms, identical: %s" % (len(warm),
+            (time.time() - started) * 1000, warm.snapshot() == expected)
+        warm.close()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Resolver Benchmark
+
+Measures how long reconnecting takes through a Resolver, compared with
+socket.create_connection as sessions used to connect, against local
+servers behind a simulated DNS server that takes --dns-latency seconds to
+answer:
+
+    - idigi.example resolves to a blackhole address, whose connects hang,
+      then to a working one.
+    - down.example resolves to an address refusing connections, and
+      failover.example to a working one.
+
+Also checks that connecting keeps working from the cache while the DNS
+server is down.
+"""
+import argparse
+import logging
+import socket
+import threading
+import time
+
+from idigi_monitor_api.resolver import Resolver
+
+# Addresses of the simulated servers.
+WORKING = '127.0.0.1'
+BLACKHOLE = '127.0.0.3'
+REFUSING = '127.0.0.4'
+
+def get_parser():
+    """ Parser for this script """
+    parser = argparse.ArgumentParser(description="Resolver Benchmark",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--connects', dest='connects', type=int, default=20,
+        help='Number of reconnects measured for each case.')
+
+    parser.add_argument('--dns-latency', dest='dns_latency', type=float,
+        default=0.2, help='Seconds the simulated DNS server takes.')
+
+    parser.add_argument('--connect-timeout', dest='connect_timeout',
+        type=float, default=2, help='Seconds before a connect to the '
+        'blackhole is abandoned by socket.create_connection.')
+
+    return parser
+
+class FakeDns(object):
+    """
+    Replaces socket.getaddrinfo, answering for the .example hostnames
+    after latency seconds, or failing while down.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.down    = False
+        self.lookups = 0
+        self.records = {'idigi.example' : [BLACKHOLE, WORKING],
+                        'down.example' : [REFUSING],
+                        'failover.example' : [WORKING]}
+        self.getaddrinfo = socket.getaddrinfo
+        socket.getaddrinfo = self
+
+    def __call__(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        if host not in self.records:
+            return self.getaddrinfo(host, port, family, socktype, proto,
+                                    flags)
+        self.lookups += 1
+        time.sleep(self.latency)
+        if self.down:
+            raise socket.gaierror(socket.EAI_AGAIN,
+                                    'Temporary failure in name resolution')
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+                (address, port or 0)) for address in self.records[host]]
+
+def servers():
+    """
+    Starts a server accepting connections on WORKING and a blackhole on
+    BLACKHOLE, on the same port, and returns the port.
+    """
+    working = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    working.bind((WORKING, 0))
+    working.listen(128)
+    port = working.getsockname()[1]
+
+    def accept():
+        while True:
+            conn, _ = working.accept()
+            conn.close()
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+
+    # A full backlog makes the kernel drop further SYNs, so connects hang
+    # as with an unreachable server.
+    blackhole = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    blackhole.bind((BLACKHOLE, port))
+    blackhole.listen(0)
+    filler = socket.create_connection((BLACKHOLE, port))
+    return port, (working, blackhole, filler)
+
+def measure(name, connect, count):
+    """ Times count calls of connect, which returns a socket """
+    times = []
+    for _ in xrange(count):
+        started = time.time()
+        sock = connect()
+        times.append(time.time() - started)
+        sock.close()
+    print "%-36s first %7.1f ms, then mean %6.2f ms, max %7.1f ms" % (name,
+        times[0] * 1000, sum(times[1:]) / max(len(times) - 1, 1) * 1000,
+        max(times[1:] or times) * 1000)
+
+def main():
+    """ Main function call """
+    args = get_parser().parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.WARNING)
+    dns = FakeDns(args.dns_latency)
+    port, _ = servers()
+
+    measure('create_connection idigi.example',
+            lambda: socket.create_connection(('idigi.example', port),
+                                            args.connect_timeout),
+            args.connects)
+    resolver = Resolver()
+    measure('Resolver idigi.example',
+            lambda: resolver.connect(['idigi.example'], port)[0],
+            args.connects)
+
+    def failover_connection():
+        try:
+            return socket.create_connection(('down.example', port))
+        except socket.error:
+            return socket.create_connection(('failover.example', port))
+    measure('create_connection down/failover', failover_connection,
+            args.connects)
+    measure('Resolver down/failover',
+            lambda: resolver.connect(['down.example', 'failover.example'],
+                                    port)[0],
+            args.connects)
+
+    # Expire the cache and take the DNS server down.
+    stale = Resolver(ttl=0.5)
+    stale.connect(['idigi.example'], port)[0].close()
+    time.sleep(0.6)
+    dns.down = True
+    lookups = dns.lookups
+    measure('Resolver idigi.example, DNS down',
+            lambda: stale.connect(['idigi.example'], port)[0],
+            args.connects)
+    time.sleep(args.dns_latency * 2)
+    print "%d lookups attempted in the background while down." % \
+        (dns.lookups - lookups)
+    for address, stats in sorted(resolver.stats().items()):
+        print "%s:%d %s" % (address[0], address[1], stats)
+
+if __name__ == "__main__":
+    main()
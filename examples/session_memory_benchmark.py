@@ -0,0 +1,76 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Session Memory Benchmark
+
+Creates --sessions SecurePushSession objects of one client without
+connecting them, and reports the resident memory they take per session
+and the number of loggers created.  With --stats, the SessionStats of each
+session are created too, as they are once traffic is received.
+
+Resident memory is read from /proc/self/statm, so this needs Linux.
+"""
+import argparse
+import gc
+import logging
+import os
+import resource
+
+from idigi_monitor_api import push_client
+from idigi_monitor_api.push_client import SecurePushSession
+
+def get_parser():
+    """ Parser for this script """
+    parser = argparse.ArgumentParser(description="Session Memory Benchmark",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--sessions', '-n', dest='sessions', type=int,
+        default=10000, help='Number of sessions.')
+
+    parser.add_argument('--stats', dest='stats', action='store_true',
+        help='Create the SessionStats of each session.')
+
+    return parser
+
+def rss():
+    """ Returns the resident memory of this process in bytes """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+def main():
+    """ Main function call """
+    args = get_parser().parse_args()
+    client = push_client('benchmark', 'secret', hostname='127.0.0.1')
+    callback = lambda data: True
+    # Warm up the allocator and anything created by the first session.
+    SecurePushSession(callback, -1, client).stats
+
+    gc.collect()
+    loggers = len(logging.Logger.manager.loggerDict)
+    before = rss()
+    sessions = []
+    for monitor_id in xrange(args.sessions):
+        session = SecurePushSession(callback, monitor_id, client)
+        if args.stats:
+            session.stats
+        sessions.append(session)
+    gc.collect()
+    used = rss() - before
+
+    print "%d sessions%s: %.0f bytes per session, %d loggers created" % (
+        len(sessions), " with stats" if args.stats else "",
+        float(used) / len(sessions),
+        len(logging.Logger.manager.loggerDict) - loggers)
+    client.stop_all()
+
+if __name__ == "__main__":
+    main()
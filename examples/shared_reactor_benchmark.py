@@ -0,0 +1,135 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Shared Reactor Benchmark
+
+Runs --tenants PushClients, each with one session to a local fake push
+server (see soak_test.py), either each with its own IO thread, writer
+thread and callback workers or all attached to one shared PushReactor
+(--shared).  Prints the thread count, delivery rate and CPU time spent per
+message.
+
+With --slow-tenant, the callbacks of the first tenant block for a while,
+showing how --max-queued keeps it from holding up the other tenants of a
+shared reactor.
+
+The fake server listens on the insecure push port (3200) of --host, so
+nothing else may be using it.  It runs in a child process so that its
+threads and CPU time are not counted.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from idigi_monitor_api import push_client, PushReactor
+from soak_test import FakePushServer
+
+def get_parser():
+    """ Parser for this script """
+    parser = argparse.ArgumentParser(description="Shared Reactor Benchmark",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+        help='Address the fake server listens on.')
+
+    parser.add_argument('--tenants', dest='tenants', type=int, default=200,
+        help='Number of PushClients, each with one session.')
+
+    parser.add_argument('--shared', dest='shared', action='store_true',
+        help='Attach every client to one shared PushReactor.')
+
+    parser.add_argument('--workers', dest='workers', type=int, default=4,
+        help='Callback workers of each reactor.')
+
+    parser.add_argument('--max-queued', dest='max_queued', type=int,
+        default=None, help='Callbacks each client may have queued at once.')
+
+    parser.add_argument('--slow-tenant', dest='slow_tenant', type=float,
+        default=0, help='Seconds the callbacks of the first tenant block.')
+
+    parser.add_argument('--interval', dest='interval', type=float,
+        default=0.05, help='Seconds between messages on each session.')
+
+    parser.add_argument('--duration', dest='duration', type=float,
+        default=10, help='Seconds to measure for.')
+
+    return parser
+
+def main():
+    """ Main function call """
+    args = get_parser().parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.WARNING)
+
+    server = FakePushServer(args.host, args.interval, 0, 0, False)
+    server_process = multiprocessing.Process(target=server.serve_forever)
+    server_process.daemon = True
+    server_process.start()
+    time.sleep(1)
+
+    delivered = [0] * args.tenants
+    def make_callback(tenant):
+        def callback(data):
+            if tenant == 0 and args.slow_tenant:
+                time.sleep(args.slow_tenant)
+            delivered[tenant] += 1
+            return True
+        return callback
+
+    threads_before = threading.active_count()
+    reactor = PushReactor(workers=args.workers) if args.shared else None
+    clients = [push_client('tenant%d' % tenant, 'secret', hostname=args.host,
+                            secure=False, workers=args.workers,
+                            reactor=reactor, max_queued=args.max_queued)
+                for tenant in xrange(args.tenants)]
+    for tenant, client in enumerate(clients):
+        client.create_session(make_callback(tenant), tenant)
+
+    try:
+        time.sleep(1)
+        threads = threading.active_count() - threads_before
+        start_count = sum(delivered)
+        start_first = delivered[0]
+        start_cpu = sum(os.times()[:2])
+        started = time.time()
+        time.sleep(args.duration)
+        elapsed = time.time() - started
+        cpu = sum(os.times()[:2]) - start_cpu
+        count = sum(delivered) - start_count
+        first = delivered[0] - start_first
+    finally:
+        # Clients with their own reactor each wait for their threads, stop
+        # them all at once.
+        stoppers = [threading.Thread(target=client.stop_all)
+                    for client in clients]
+        for stopper in stoppers:
+            stopper.start()
+        for stopper in stoppers:
+            stopper.join()
+        if reactor is not None:
+            reactor.stop()
+        server_process.terminate()
+
+    print "%d tenants, %s reactor: %d threads" % (args.tenants,
+        'shared' if args.shared else 'own', threads)
+    print "%.0f msgs/s offered, %.0f msgs/s delivered, %.1f us CPU per " \
+        "message, %.0f%% CPU" % (args.tenants / args.interval,
+        count / elapsed, cpu / max(count, 1) * 1e6, cpu / elapsed * 100)
+    if args.slow_tenant:
+        print "slow tenant %.1f msgs/s, others %.1f msgs/s each" % \
+            (first / elapsed, (count - first) / elapsed / (args.tenants - 1))
+
+if __name__ == "__main__":
+    main()
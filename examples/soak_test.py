@@ -0,0 +1,385 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Soak Test
+
+Runs a PushClient for a long time against a local fake push server, which
+randomly drops connections, periodically drops all of them at once (a
+reconnect storm) and is served by callbacks of which some are slow.
+
+The client's memory, thread count and session table size are sampled
+periodically, along with the object types (or allocation sites, if
+tracemalloc is available) that grew the most.  Once a warmup has passed,
+growth beyond the given budgets fails the run with exit status 1.
+
+The fake server listens on --port of --host, a free port by default, and
+the client is pointed at it.  It runs in a child process so that its
+memory is not counted.
+"""
+import argparse
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from collections import defaultdict
+from idigi_monitor_api import push_client
+from idigi_monitor_api.push_client import CONNECTION_REQUEST, \
+    CONNECTION_RESPONSE, PUBLISH_MESSAGE, STATUS_OK
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+LOG = logging.getLogger("soak_test")
+
+# The module, the package's push_client attribute being the factory.
+PUSH_CLIENT = sys.modules['idigi_monitor_api.push_client']
+
+def recv_exactly(sock, size):
+    """
+    Reads size bytes from a blocking socket, raising EOFError if it closes.
+    """
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+class FakePushServer(object):
+    """
+    Accepts push sessions and sends each a DeviceCore PublishMessage every
+    interval seconds until the connection is dropped.
+    """
+
+    def __init__(self, host, interval, disconnect_rate, storm_every,
+                compress, port=0):
+        """
+        :param host: Address to listen on.
+        :param port: Port to listen on, 0 for a free one.
+        :param interval: Seconds between PublishMessages on a connection.
+        :param disconnect_rate: Chance of dropping a connection after each
+            PublishMessage.
+        :param storm_every: Seconds between dropping every connection, 0 to
+            never.
+        :param compress: Whether to compress payloads.
+        """
+        self.host            = host
+        self.interval        = interval
+        self.disconnect_rate = disconnect_rate
+        self.storm_every     = storm_every
+        self.compress        = compress
+        self.port            = port
+        self.listener        = None
+        self.connections     = set()
+        self.lock            = threading.Lock()
+
+    def payload(self, block_id, monitor_id):
+        """
+        Returns a PublishMessage payload.
+        """
+        return json.dumps({"Document" : {"Msg" : {
+            "topic" : "1/DeviceCore/%d/%d" % (monitor_id, block_id),
+            "operation" : "UPDATE",
+            "timestamp" : "2012-06-12T03:18:45.381Z",
+            "DeviceCore" : {
+                "devConnectwareId" : "00000000-00000000-00409DFF-%08X" % \
+                    monitor_id,
+                "dpConnectionStatus" : block_id % 2}}}})
+
+    def handle(self, conn):
+        """
+        Serves one push session.
+        """
+        try:
+            _, length = struct.unpack('!HI', recv_exactly(conn, 6))
+            monitor_id = struct.unpack('!I', recv_exactly(conn, length)[-4:])[0]
+            conn.sendall(struct.pack('!HIHH', CONNECTION_RESPONSE, 4,
+                                    STATUS_OK, 0))
+            block_id = 0
+            next_send = time.time()
+            while True:
+                block_id = (block_id + 1) % 65536
+                payload = self.payload(block_id, monitor_id)
+                if self.compress:
+                    payload = zlib.compress(payload)
+                body = struct.pack('!HHBBI', block_id, 1, int(self.compress),
+                                    0, len(payload)) + payload
+                conn.sendall(struct.pack('!HI', PUBLISH_MESSAGE, len(body)) +
+                            body)
+                if random.random() < self.disconnect_rate:
+                    break
+                # Drain acknowledgements until the next message is due, 
+                # keeping to the schedule whatever the client's pace.
+                next_send += self.interval
+                while True:
+                    remaining = next_send - time.time()
+                    if remaining <= 0:
+                        break
+                    if select.select([conn], [], [], remaining)[0]:
+                        if not conn.recv(65536):
+                            raise EOFError()
+        except (EOFError, socket.error):
+            pass
+        finally:
+            with self.lock:
+                self.connections.discard(conn)
+            conn.close()
+
+    def storm(self):
+        """
+        Periodically drops every connection at once.
+        """
+        while True:
+            time.sleep(self.storm_every)
+            with self.lock:
+                connections = list(self.connections)
+            for conn in connections:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def listen(self):
+        """
+        Starts listening, before serve_forever is run in a child process,
+        and returns the port listened on.
+        """
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(1024)
+        self.port = self.listener.getsockname()[1]
+        return self.port
+
+    def serve_forever(self):
+        """
+        Accepts connections until killed.
+        """
+        if self.listener is None:
+            self.listen()
+        listener = self.listener
+        if self.storm_every:
+            thread = threading.Thread(target=self.storm)
+            thread.daemon = True
+            thread.start()
+        while True:
+            conn, _ = listener.accept()
+            with self.lock:
+                self.connections.add(conn)
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+def rss_bytes():
+    """
+    Returns the resident set size of this process, or its maximum where
+    /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def object_counts():
+    """
+    Returns a dict of the number of live objects of each type.
+    """
+    counts = defaultdict(int)
+    for obj in gc.get_objects():
+        counts[type(obj).__name__] += 1
+    return counts
+
+def top_growth(baseline, current, count=5):
+    """
+    Returns the count largest increases between two object_counts dicts as
+    a list of (type name, increase).
+    """
+    growth = [(name, current[name] - baseline.get(name, 0))
+                for name in current]
+    growth.sort(key=lambda item: -item[1])
+    return [item for item in growth[:count] if item[1] > 0]
+
+class Sample(object):
+    """
+    A measurement of the client's resource usage.
+    """
+
+    def __init__(self, client, started):
+        self.elapsed  = time.time() - started
+        self.rss      = rss_bytes()
+        self.threads  = threading.active_count()
+        self.sessions = len(client.sessions)
+        self.buffered = client.buffers.used
+
+    def __str__(self):
+        return "%7ds rss %7.1f MB threads %4d sessions %5d buffered %d" % \
+            (self.elapsed, self.rss / 1048576.0, self.threads, self.sessions,
+            self.buffered)
+
+def get_parser():
+    """ Parser for this script """
+    parser = argparse.ArgumentParser(description="iDigi Push Client Soak Test",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+        help='Address the fake server listens on.')
+
+    parser.add_argument('--port', dest='port', type=int, default=0,
+        help='Port the fake server listens on, 0 for a free one.')
+
+    parser.add_argument('--duration', dest='duration', type=float,
+        default=3600, help='Seconds to run for.')
+
+    parser.add_argument('--warmup', dest='warmup', type=float, default=60,
+        help='Seconds after which growth is measured.')
+
+    parser.add_argument('--sample', dest='sample', type=float, default=30,
+        help='Seconds between samples.')
+
+    parser.add_argument('--sessions', dest='sessions', type=int, default=50,
+        help='Number of sessions.')
+
+    parser.add_argument('--workers', dest='workers', type=int, default=4,
+        help='Number of callback workers.')
+
+    parser.add_argument('--interval', dest='interval', type=float,
+        default=0.05, help='Seconds between messages on each session.')
+
+    parser.add_argument('--compress', dest='compress', action='store_true',
+        default=False, help='Compress payloads.')
+
+    parser.add_argument('--disconnect-rate', dest='disconnect_rate',
+        type=float, default=0.001,
+        help='Chance of dropping a connection after each message.')
+
+    parser.add_argument('--storm-every', dest='storm_every', type=float,
+        default=300, help='Seconds between dropping every connection.')
+
+    parser.add_argument('--slow-rate', dest='slow_rate', type=float,
+        default=0.01, help='Chance of a callback being slow.')
+
+    parser.add_argument('--slow-time', dest='slow_time', type=float,
+        default=0.5, help='Seconds a slow callback takes.')
+
+    parser.add_argument('--rss-budget', dest='rss_budget', type=float,
+        default=16, help='Allowed RSS growth after warmup in MB.')
+
+    parser.add_argument('--thread-budget', dest='thread_budget', type=int,
+        default=0, help='Allowed thread count growth after warmup.')
+
+    return parser
+
+def main():
+    """ Main function call """
+    args = get_parser().parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.WARNING)
+    LOG.setLevel(logging.INFO)
+
+    server = FakePushServer(args.host, args.interval, args.disconnect_rate,
+                            args.storm_every, args.compress, args.port)
+    PUSH_CLIENT.PUSH_OPEN_PORT = server.listen()
+    server_process = multiprocessing.Process(target=server.serve_forever)
+    server_process.daemon = True
+    server_process.start()
+    server.listener.close()
+
+    delivered = [0]
+    def callback(data):
+        if random.random() < args.slow_rate:
+            time.sleep(args.slow_time)
+        json.loads(data)
+        delivered[0] += 1
+        return True
+
+    client = push_client('soak', 'soak', hostname=args.host, secure=False,
+                        workers=args.workers)
+    if tracemalloc is not None:
+        tracemalloc.start()
+
+    started = time.time()
+    for monitor_id in xrange(args.sessions):
+        client.create_session(callback, monitor_id)
+
+    baseline = None
+    failures = []
+    try:
+        while time.time() - started < args.duration:
+            time.sleep(args.sample)
+            sample = Sample(client, started)
+            LOG.info("%s delivered %d" % (sample, delivered[0]))
+
+            if baseline is None:
+                if sample.elapsed >= args.warmup:
+                    baseline = sample
+                    baseline_objects = object_counts()
+                    if tracemalloc is not None:
+                        baseline_snapshot = tracemalloc.take_snapshot()
+                continue
+
+            LOG.info("Object growth since warmup: %s" %
+                ", ".join("%s +%d" % item for item in
+                top_growth(baseline_objects, object_counts())))
+            if tracemalloc is not None:
+                for stat in tracemalloc.take_snapshot().compare_to(
+                        baseline_snapshot, 'lineno')[:5]:
+                    LOG.info("Allocation growth: %s" % stat)
+    except KeyboardInterrupt:
+        LOG.warn("Interrupted.")
+    finally:
+        # A session being restarted is missing from the table until it has
+        # reconnected, which is retried a few seconds later if it fails.
+        settle = time.time() + 10
+        while len(client.sessions) != args.sessions and time.time() < settle:
+            time.sleep(0.1)
+        final = Sample(client, started)
+        client.stop_all()
+        server_process.terminate()
+
+    if baseline is None:
+        LOG.error("Run ended before the warmup did, nothing was checked.")
+        sys.exit(1)
+
+    rss_growth = (final.rss - baseline.rss) / 1048576.0
+    if rss_growth > args.rss_budget:
+        failures.append("RSS grew %.1f MB (budget %.1f MB)" %
+                        (rss_growth, args.rss_budget))
+    if final.threads - baseline.threads > args.thread_budget:
+        failures.append("Thread count grew from %d to %d" %
+                        (baseline.threads, final.threads))
+    if final.sessions != args.sessions:
+        failures.append("Session table holds %d sessions, expected %d" %
+                        (final.sessions, args.sessions))
+
+    LOG.info("Final: %s delivered %d" % (final, delivered[0]))
+    for failure in failures:
+        LOG.error(failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,55 @@
 import sys
 sys.path.append('..')
 
-from idigi_monitor_api import push_client
+from idigi_monitor_api import push_client, MessageFilter
+from idigi_monitor_api.filedata import DeviceLogDemux
 import logging
 import time
 import json
 import base64
+import re
+import zlib
 
+TRACE_FILE = 'trace.log.gz'
+DEVICE_ID = re.compile(r'[0-9A-F]{8}-[0-9A-F]{8}-[0-9A-F]{8}-[0-9A-F]{8}', 
+                       re.IGNORECASE)
 
 def trace_callback(data):
     try:
-        json_data = json.loads(data)
+        # A spilled payload is passed as an mmap.
+        json_data = json.loads(data[:])
         file_data = base64.decodestring(json_data['Document']['Msg']['FileData']['fdData'])
+        # trace_logger uploads gzip compressed chunks.
+        file_data = zlib.decompress(file_data, 16 + zlib.MAX_WBITS)
         sys.stdout.write(file_data)
         return True
     except Exception, e:
         print e
     return False
 
+def fleet_callback(demux):
+    """
+    Returns a callback appending the trace chunks of every device to that
+    device's log file.
+    """
+    def callback(data):
+        msgs = json.loads(data[:])['Document']['Msg']
+        if isinstance(msgs, dict):
+            msgs = [msgs]
+        for msg in msgs:
+            file_data = msg.get('FileData')
+            if file_data is None or 'fdData' not in file_data or \
+                    file_data['id']['fdName'] != TRACE_FILE:
+                continue
+            device = DEVICE_ID.search(file_data['id']['fdPath'])
+            if device is None:
+                continue
+            chunk = zlib.decompress(base64.decodestring(file_data['fdData']),
+                                    16 + zlib.MAX_WBITS)
+            demux.write(device.group().upper(), chunk)
+        return True
+    return callback
+
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', 
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
 
@@ -35,8 +67,13 @@ if __name__ == "__main__":
     parser.add_argument('password', type=str,
         help='Password to authenticate with.')
 
-    parser.add_argument('device_id', type=str,  
-        help='The full device id of the device to capture tracing on.')
+    parser.add_argument('device_id', type=str, nargs='?',
+        help='The full device id of the device to capture tracing on.  If ' \
+        'omitted, tracing of all devices is captured into --dest-root.')
+
+    parser.add_argument('--dest-root', dest='dest_root', type=str,
+        default='traces',
+        help='Directory per device trace logs are written to.')
 
     parser.add_argument('--host', '-a', dest='host', action='store', 
         type=str, default='test.idigi.com', 
@@ -48,7 +85,19 @@ if __name__ == "__main__":
                         hostname=args.host,
                         secure=True)
 
-    topics = ['FileData/~%%2F%s/trace.log' % args.device_id ]
+    if args.device_id is not None:
+        topics = ['FileData/~%%2F%s/%s' % (args.device_id, TRACE_FILE)]
+        callback = trace_callback
+        message_filter = None
+        demux = None
+    else:
+        # One monitor for the whole fleet, chunks are demultiplexed by the
+        # device id in their path.  Other FileData uploads are dropped 
+        # before they are decoded.
+        topics = ['FileData']
+        message_filter = MessageFilter(topics=['FileData/*/' + TRACE_FILE])
+        demux = DeviceLogDemux(args.dest_root)
+        callback = fleet_callback(demux)
 
     log.info("Checking to see if Monitor Already Exists.")
     monitor = client.get_monitor(topics)
@@ -58,11 +107,15 @@ if __name__ == "__main__":
         log.info("Monitor already exists, deleting it.")
         client.delete_monitor(monitor)
 
-    monitor = client.create_monitor(topics, format_type='json')
+    if demux is None:
+        monitor = client.create_monitor(topics, format_type='json')
+    else:
+        monitor = client.create_monitor(topics, format_type='json',
+                                        batch_size=100, batch_duration=10)
 
     try:
-        callback = trace_callback
-        session = client.create_session(callback, monitor)
+        session = client.create_session(callback, monitor, 
+                                        message_filter=message_filter)
         while True:
             time.sleep(3.14)
     except KeyboardInterrupt:
@@ -71,4 +124,6 @@ if __name__ == "__main__":
     Closing Sessions and Cleaning Up.")
     finally:
         client.stop_all()
+        if demux is not None:
+            demux.close()
         #client.delete_monitor(monitor)
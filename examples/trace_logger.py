@@ -1,67 +1,253 @@
-import digicli
-import math
+"""
+Trace Logger
+
+Runs on a device: turns on device tracing to syslog, collects the syslog
+datagrams and uploads them to iDigi as gzip compressed trace.log.gz files.
+
+Collected lines are kept in a bounded buffer (the oldest are dropped during
+trace storms) and are uploaded once enough data or a long enough time has
+accumulated.  Uploads that fail are retried with exponential backoff.
+
+Run with --local to try it off device: the idigidata and digicli modules
+are replaced with stand-ins that write uploads to the current directory.
+"""
+import errno
+import getopt
+import gzip
 import select
 import socket
+import sys
 import time
-import idigidata
 
 import StringIO
 
-def flush_trace_cache(cache):
+# Largest possible UDP datagram, so long syslog lines are not truncated.
+MAX_DATAGRAM = 65535
 
-    try:
-        try:
-            cache_value = cache.getvalue()
-            if len(cache_value) > 0:
-                (success, error, errormsg) =\
-                    idigidata.send_to_idigi(cache_value, 
-                                            "trace.log", append=False)
-                if not success:
-                    print "Failed to Send over Data Service, error %d, message: %s" % (error, errormsg)
+class TraceBuffer:
+    """
+    A bounded FIFO of trace lines.  When adding a line would exceed
+    max_bytes, the oldest lines are dropped and counted.
+    """
 
-        except Exception, e:
-            print "trace writer failed with exception: ", e
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lines = []
+        self.head = 0
+        self.size = 0
+        self.dropped = 0
+        self.first_time = None
+
+    def append(self, line):
+        if self.first_time is None:
+            self.first_time = time.time()
+        self.lines.append(line)
+        self.size = self.size + len(line)
+        while self.size > self.max_bytes and self.head < len(self.lines):
+            self.size = self.size - len(self.lines[self.head])
+            self.lines[self.head] = None
+            self.head = self.head + 1
+            self.dropped = self.dropped + 1
+        # Compact once the dropped prefix dominates the list.
+        if self.head > 1024 and self.head * 2 > len(self.lines):
+            self.lines = self.lines[self.head:]
+            self.head = 0
+
+    def age(self):
+        if self.first_time is None:
+            return 0
+        return time.time() - self.first_time
+
+    def take(self):
+        """
+        Removes and returns everything buffered as a single string.
+        """
+        data = "".join(self.lines[self.head:])
+        if self.dropped:
+            data = "*** %d trace lines dropped ***\n%s" % (self.dropped, data)
+        self.lines = []
+        self.head = 0
+        self.size = 0
+        self.dropped = 0
+        self.first_time = None
+        return data
+
+def compress(data):
+    """
+    Returns data compressed in gzip format.
+    """
+    output = StringIO.StringIO()
+    gzip_file = gzip.GzipFile(fileobj=output, mode="wb")
+    try:
+        gzip_file.write(data)
     finally:
+        gzip_file.close()
+    return output.getvalue()
+
+class ChunkUploader:
+    """
+    Uploads compressed chunks in order, keeping at most max_chunks pending.
+    A failed upload is retried after a delay that doubles on each failure
+    up to max_backoff seconds.
+    """
+
+    def __init__(self, idigidata, filename, max_chunks=8, backoff=5,
+                 max_backoff=300):
+        self.idigidata = idigidata
+        self.filename = filename
+        self.max_chunks = max_chunks
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.chunks = []
+        self.delay = 0
+        self.next_attempt = 0
+
+    def add(self, data):
+        self.chunks.append(compress(data))
+        if len(self.chunks) > self.max_chunks:
+            del self.chunks[0]
+            print "Upload backlog full, dropped oldest trace chunk"
+
+    def send(self):
+        """
+        Uploads pending chunks until one fails or none are left.
+        """
+        while self.chunks and time.time() >= self.next_attempt:
+            try:
+                (success, error, errormsg) = \
+                    self.idigidata.send_to_idigi(self.chunks[0],
+                                                 self.filename, append=False)
+            except Exception, e:
+                (success, error, errormsg) = (False, -1, str(e))
+
+            if success:
+                del self.chunks[0]
+                self.delay = 0
+                self.next_attempt = 0
+            else:
+                self.delay = min(max(self.delay * 2, self.backoff),
+                                 self.max_backoff)
+                self.next_attempt = time.time() + self.delay
+                print "Failed to Send over Data Service, error %d, " \
+                      "message: %s, retrying in %d seconds" % \
+                      (error, errormsg, self.delay)
+
+def drain(trace_socket, trace_buffer):
+    """
+    Reads every datagram pending on the non-blocking socket.
+    """
+    while True:
         try:
-            cache.truncate(0)
-        except Exception, e:
-            print "truncate failed with exception: " , e
+            payload, src = trace_socket.recvfrom(MAX_DATAGRAM)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if payload and payload[-1] != "\n":
+            payload = payload + "\n"
+        trace_buffer.append(payload)
+
+def syslog_server(idigidata, port=514, flush_size=32768, flush_age=60,
+                  max_bytes=262144, filename="trace.log.gz"):
+    """
+    Collects syslog datagrams sent to port and uploads them.
 
-def syslog_server():
-    trace_cache = StringIO.StringIO()
-    last_write = time.clock()
+    :param flush_size: upload once this many bytes are buffered.
+    :param flush_age: upload once the oldest buffered line is this old.
+    :param max_bytes: maximum bytes buffered before dropping lines.
+    """
+    trace_buffer = TraceBuffer(max_bytes)
+    uploader = ChunkUploader(idigidata, filename)
     trace_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    
+
     try:
         try:
-            # Bind to syslog port, 514
-            trace_socket.bind(("", 514))
+            trace_socket.bind(("", port))
+            trace_socket.setblocking(0)
 
             print "Entering Trace Read Now..."
 
             while(True):
-                rlist, wlist, xlist = select.select([trace_socket], [], [], 5)
+                timeout = 5
+                if trace_buffer.first_time is not None:
+                    timeout = max(0, min(timeout,
+                                         flush_age - trace_buffer.age()))
+                if uploader.chunks:
+                    timeout = max(0, min(timeout,
+                                         uploader.next_attempt - time.time()))
 
+                rlist, wlist, xlist = select.select([trace_socket], [], [],
+                                                    timeout)
                 if trace_socket in rlist:
-                    payload, src = trace_socket.recvfrom(1024)
+                    drain(trace_socket, trace_buffer)
+
+                if trace_buffer.size >= flush_size or \
+                   (trace_buffer.first_time is not None and
+                    trace_buffer.age() >= flush_age):
+                    uploader.add(trace_buffer.take())
 
-                    trace_cache.write(payload)
-                
-                if(math.fabs(time.clock() - last_write)) > 60:
-                    flush_trace_cache(trace_cache)
-                    last_write = time.clock()
+                uploader.send()
         except Exception, e:
             print "Exception during trace read: ", e
     finally:
         trace_socket.close()
         print "Trace thread ending"
-    
-if __name__ == "__main__":
+
+class LocalDigiCli:
+    """
+    Stand-in for the device digicli module.
+    """
+
+    def digicli(self, command):
+        print "digicli: %s" % command
+        return (True, [])
+
+class LocalIdigiData:
+    """
+    Stand-in for the device idigidata module, writes each upload to a
+    numbered file in the current directory.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def send_to_idigi(self, data, filename, append=False):
+        self.count = self.count + 1
+        name = "%s.%d" % (filename, self.count)
+        output = open(name, "wb")
+        try:
+            output.write(data)
+        finally:
+            output.close()
+        print "idigidata: wrote %d bytes to %s" % (len(data), name)
+        return (True, 0, "")
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "",
+                               ["local", "port=", "flush-size=",
+                                "flush-age=", "max-bytes="])
+    opts = dict(opts)
+    port = int(opts.get("--port", 514))
+
+    if "--local" in opts:
+        digicli = LocalDigiCli()
+        idigidata = LocalIdigiData()
+    else:
+        import digicli
+        import idigidata
+
     try:
-        (status, result) = digicli.digicli("set trace state=on syslog=on mask=sms:*,idigi:*,edp:*,printf:-* loghost=127.0.0.1")
+        (status, result) = digicli.digicli("set trace state=on syslog=on "
+            "mask=sms:*,idigi:*,edp:*,printf:-* loghost=127.0.0.1")
         if not status:
             print "Initial CLI trace set failed"
         else:
-            syslog_server()
+            syslog_server(idigidata, port=port,
+                          flush_size=int(opts.get("--flush-size", 32768)),
+                          flush_age=float(opts.get("--flush-age", 60)),
+                          max_bytes=int(opts.get("--max-bytes", 262144)))
     except Exception, e:
-        print "Initial CLI trace set failed with exception: %s" % e
\ No newline at end of file
+        print "Initial CLI trace set failed with exception: %s" % e
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Wakeup Benchmark
+
+Opens --sessions sessions to a local fake push server, then:
+
+    - leaves them idle for --idle seconds, measuring the CPU time and the
+      voluntary context switches (thread wakeups) of the client,
+    - has the server send a message on each session every --interval
+      seconds for --duration seconds, measuring the time from sending each
+      message to receiving its acknowledgement,
+    - times stop_all.
+
+The fake server listens on a free port of --host, and the client is
+pointed at it.  It runs in a child process so that its CPU time is not
+counted.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import struct
+import time
+
+from idigi_monitor_api import push_client
+from idigi_monitor_api.push_client import CONNECTION_RESPONSE, \
+    PUBLISH_MESSAGE, STATUS_OK
+from soak_test import PUSH_CLIENT, FakePushServer, recv_exactly
+
+def get_parser():
+    """ Parser for this script """
+    parser = argparse.ArgumentParser(description="Wakeup Benchmark",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+        help='Address the fake server listens on.')
+
+    parser.add_argument('--sessions', dest='sessions', type=int, default=20,
+        help='Number of sessions.')
+
+    parser.add_argument('--workers', dest='workers', type=int, default=4,
+        help='Callback workers.')
+
+    parser.add_argument('--max-workers', dest='max_workers', type=int,
+        default=None, help='Autoscale the callback workers up to this many.')
+
+    parser.add_argument('--idle-timeout', dest='idle_timeout', type=float,
+        default=None, help='Idle timeout of the sessions.')
+
+    parser.add_argument('--idle', dest='idle', type=float, default=10,
+        help='Seconds the sessions are left idle.')
+
+    parser.add_argument('--interval', dest='interval', type=float,
+        default=0.2, help='Seconds between messages on each session.')
+
+    parser.add_argument('--duration', dest='duration', type=float,
+        default=10, help='Seconds messages are sent for.')
+
+    return parser
+
+class AckTimingServer(FakePushServer):
+    """
+    Accepts push sessions and, once sending is set, sends each a message
+    every interval seconds and times its acknowledgement.  The times of a
+    connection are put on results when it closes.
+    """
+
+    def __init__(self, host, interval, sending, results):
+        FakePushServer.__init__(self, host, interval, 0, 0, False)
+        self.sending = sending
+        self.results = results
+
+    def handle(self, conn):
+        """
+        Serves one push session.
+        """
+        latencies = []
+        try:
+            _, length = struct.unpack('!HI', recv_exactly(conn, 6))
+            monitor_id = struct.unpack('!I', recv_exactly(conn, length)[-4:])[0]
+            conn.sendall(struct.pack('!HIHH', CONNECTION_RESPONSE, 4,
+                                    STATUS_OK, 0))
+            self.sending.wait()
+            block_id = 0
+            next_send = time.time()
+            while True:
+                block_id = (block_id + 1) % 65536
+                payload = self.payload(block_id, monitor_id)
+                body = struct.pack('!HHBBI', block_id, 1, 0, 0,
+                                    len(payload)) + payload
+                sent = time.time()
+                conn.sendall(struct.pack('!HI', PUBLISH_MESSAGE, len(body)) +
+                            body)
+                recv_exactly(conn, 6)
+                latencies.append(time.time() - sent)
+                next_send += self.interval
+                time.sleep(max(0, next_send - time.time()))
+        except (EOFError, socket.error):
+            pass
+        finally:
+            self.results.put(latencies)
+            conn.close()
+
+def usage():
+    """ Returns the CPU seconds and voluntary context switches so far """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_nvcsw
+
+def main():
+    """ Main function call """
+    args = get_parser().parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.WARNING)
+
+    sending = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    server = AckTimingServer(args.host, args.interval, sending, results)
+    PUSH_CLIENT.PUSH_OPEN_PORT = server.listen()
+    server_process = multiprocessing.Process(target=server.serve_forever)
+    server_process.daemon = True
+    server_process.start()
+    server.listener.close()
+
+    client = push_client('benchmark', 'secret', hostname=args.host,
+                        secure=False, workers=args.workers,
+                        max_workers=args.max_workers)
+    try:
+        for monitor_id in xrange(args.sessions):
+            client.create_session(lambda data: True, monitor_id,
+                                idle_timeout=args.idle_timeout)
+        time.sleep(1)
+
+        cpu, switches = usage()
+        time.sleep(args.idle)
+        idle_cpu, idle_switches = usage()
+        print "idle: %.2f%% CPU, %.0f wakeups/s" % (
+            (idle_cpu - cpu) / args.idle * 100,
+            (idle_switches - switches) / args.idle)
+
+        sending.set()
+        time.sleep(args.duration)
+    finally:
+        started = time.time()
+        client.stop_all()
+        stopped = time.time() - started
+
+    latencies = []
+    for _ in xrange(args.sessions):
+        latencies.extend(results.get(timeout=10))
+    server_process.terminate()
+    latencies.sort()
+    print "acknowledgement latency of %d messages: mean %.2f ms, p50 %.2f " \
+        "ms, p99 %.2f ms, max %.2f ms" % (len(latencies),
+        sum(latencies) / max(len(latencies), 1) * 1000,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000)
+    print "stop_all: %.1f ms" % (stopped * 1000)
+
+if __name__ == "__main__":
+    main()
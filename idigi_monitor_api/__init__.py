@@ -23,4 +23,11 @@ __author__    = 'Digi International'
 __license__   = 'MPL 2.0'
 __copyright__ = 'Copyright 2012 Digi International'
 
-from .push_client import push_client
\ No newline at end of file
+from .push_client import push_client, handoff_state, HANDOFF_ENV, \
+    PRIORITY_HIGH, PRIORITY_NORMAL, AckHandle, PushReactor
+from .filters import MessageFilter
+from .codec import PayloadCodec
+from .backfill import GapBackfill
+from .lastvalue import LastValueCache
+from .aggregation import WindowAggregator
+from .resolver import Resolver
@@ -0,0 +1,392 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Adaptive Monitor Tuning
+
+Tunes the batch size, batch duration and compression of monitors from the
+traffic observed on their sessions, instead of relying on static values
+chosen up front.
+"""
+import logging
+import math
+import time
+import zlib
+
+from threading import Event, Thread
+
+LOG = logging.getLogger("idigi_monitor_api.adaptive")
+
+class _BatchManaged(object):
+    """
+    Controller state for one monitor.
+    """
+
+    def __init__(self, session, batch_size, batch_duration):
+        self.session        = session
+        self.batch_size     = batch_size
+        self.batch_duration = batch_duration
+        self.last_snapshot  = session.stats.snapshot()
+        self.last_time      = time.time()
+        self.last_change    = 0
+        # Exponentially smoothed message rate (Msgs/s) and callback
+        # utilization (busy seconds per second).
+        self.rate           = None
+        self.utilization    = None
+
+class _Controller(object):
+    """
+    Base of controllers that periodically evaluate a set of monitors.
+    Subclasses implement _evaluate.
+    """
+
+    def __init__(self, client, interval):
+        """
+        :param client: The :class:`PushClient` the monitors belong to.
+        :param interval: Seconds between evaluations.
+        """
+        self.client    = client
+        self.interval  = interval
+        self._managed  = {}
+        self.__closed  = Event()
+
+        thread = Thread(target=self.__run)
+        thread.daemon = True
+        thread.start()
+
+    def unmanage(self, session):
+        """
+        Stops tuning the monitor of a session.
+
+        :param session: The :class:`PushSession` of the monitor.
+        """
+        self._managed.pop(session.monitor_id, None)
+
+    def _evaluate(self, managed, now):
+        """
+        Evaluates one managed monitor.
+        """
+        raise NotImplementedError
+
+    def __run(self):
+        """
+        Evaluates every managed monitor each interval.
+        """
+        while not self.__closed.is_set():
+            self.__closed.wait(self.interval)
+            now = time.time()
+            for managed in self._managed.values():
+                try:
+                    self._evaluate(managed, now)
+                except Exception, exception:
+                    LOG.exception(exception)
+
+    def close(self):
+        """
+        Stops the controller.  Monitors keep their current parameters.
+        """
+        self.__closed.set()
+
+class BatchController(_Controller):
+    """
+    Periodically measures the message rate and callback utilization of each
+    managed session and updates its monitor's batch parameters.
+
+    The batch size is chosen so that filling a batch takes about
+    max_latency seconds at the observed rate, and the batch duration bounds
+    the wait when traffic is slower.  When callbacks keep the workers busier
+    than max_utilization, the batch size is increased beyond that to cut
+    per-frame and per-ack overhead.  A monitor is updated at most once per
+    min_interval seconds, and only when the new batch size differs from the
+    current one by more than a factor of 1 + tolerance.
+    """
+
+    def __init__(self, client, max_latency=5.0, max_batch_size=1000,
+                max_utilization=0.75, interval=30.0, min_interval=300.0,
+                tolerance=0.5, smoothing=0.3):
+        """
+        Creates a BatchController and starts its thread.
+
+        :param client: The :class:`PushClient` the monitors belong to.
+        :param max_latency: Target upper bound, in seconds, on the delay
+            batching adds to a message.
+        :param max_batch_size: Largest batch size to configure.
+        :param max_utilization: Callback busy fraction above which batches
+            are grown to favor throughput.
+        :param interval: Seconds between measurements.
+        :param min_interval: Minimum seconds between updates of a monitor.
+        :param tolerance: Relative batch size change required to update.
+        :param smoothing: Weight of the newest measurement in the smoothed
+            rate and utilization.
+        """
+        self.max_latency     = max_latency
+        self.max_batch_size  = max_batch_size
+        self.max_utilization = max_utilization
+        self.min_interval    = min_interval
+        self.tolerance       = tolerance
+        self.smoothing       = smoothing
+        _Controller.__init__(self, client, interval)
+
+    def manage(self, session, batch_size=1, batch_duration=0):
+        """
+        Starts tuning the monitor of a session.
+
+        :param session: The :class:`PushSession` of the monitor.
+        :param batch_size: The batch size the monitor was created with.
+        :param batch_duration: The batch duration the monitor was created
+            with.
+        """
+        self._managed[session.monitor_id] = \
+            _BatchManaged(session, batch_size, batch_duration)
+
+    def parameters(self, monitor_id):
+        """
+        Returns a tuple of the current (batch_size, batch_duration) of a
+        managed monitor.
+
+        :param monitor_id: The id of the monitor.
+        """
+        managed = self._managed[monitor_id]
+        return managed.batch_size, managed.batch_duration
+
+    def __smooth(self, previous, value):
+        """
+        Returns value smoothed against previous.
+        """
+        if previous is None:
+            return value
+        return self.smoothing * value + (1 - self.smoothing) * previous
+
+    def recommend(self, rate, utilization):
+        """
+        Returns the (batch_size, batch_duration) recommended for a monitor.
+
+        :param rate: Observed Msgs per second.
+        :param utilization: Observed callback busy seconds per second.
+        """
+        batch_size = rate * self.max_latency
+        if utilization > self.max_utilization:
+            batch_size *= utilization / self.max_utilization
+        batch_size = int(max(1, min(self.max_batch_size, batch_size)))
+        # A single message is sent immediately, the duration is irrelevant.
+        batch_duration = 0 if batch_size == 1 \
+            else int(math.ceil(self.max_latency))
+        return batch_size, batch_duration
+
+    def _evaluate(self, managed, now):
+        """
+        Measures a managed monitor and updates it if warranted.
+        """
+        snapshot = managed.session.stats.snapshot()
+        elapsed = now - managed.last_time
+        if elapsed <= 0:
+            return
+        last = managed.last_snapshot
+        managed.rate = self.__smooth(managed.rate,
+            (snapshot['messages'] - last['messages']) / elapsed)
+        managed.utilization = self.__smooth(managed.utilization,
+            (snapshot['callback_time'] - last['callback_time']) / elapsed)
+        managed.last_snapshot = snapshot
+        managed.last_time = now
+
+        if now - managed.last_change < self.min_interval:
+            return
+
+        batch_size, batch_duration = \
+            self.recommend(managed.rate, managed.utilization)
+        ratio = float(max(batch_size, managed.batch_size)) / \
+            min(batch_size, managed.batch_size)
+        if ratio <= 1 + self.tolerance:
+            return
+
+        LOG.info("Updating Monitor %s batch size %d -> %d, duration %d -> %d "
+                 "(%.1f Msgs/s, %.0f%% callback utilization)."
+                 % (managed.session.monitor_id, managed.batch_size,
+                    batch_size, managed.batch_duration, batch_duration,
+                    managed.rate, managed.utilization * 100))
+        self.client.update_monitor(managed.session.monitor_id,
+                                    batch_size=batch_size,
+                                    batch_duration=batch_duration)
+        managed.batch_size = batch_size
+        managed.batch_duration = batch_duration
+        managed.last_change = now
+
+def estimate_compression(stats, previous=None):
+    """
+    Returns a tuple of (bytes_saved, inflate_seconds) estimating, for the
+    payloads received since previous, how many bytes gzip compression saved
+    (or would save) and how much CPU decompressing them cost (or would
+    cost).  Returns None if there is nothing to estimate from.
+
+    Compressed payloads are measured directly.  For uncompressed payloads
+    the session's sample payload is compressed and decompressed locally and
+    the result is scaled to the bytes received.
+
+    :param stats: A snapshot of :class:`SessionStats`.
+    :param previous: An earlier snapshot of the same session's stats.
+    """
+    if previous is None:
+        previous = dict((key, 0) for key in stats)
+    compressed = stats['compressed'] - previous['compressed']
+    payloads = stats['payloads'] - previous['payloads']
+    if compressed > 0:
+        saved = (stats['inflated_bytes'] - previous['inflated_bytes']) - \
+            (stats['wire_bytes'] - previous['wire_bytes'])
+        return saved, stats['inflate_time'] - previous['inflate_time']
+
+    sample = stats.get('sample')
+    if payloads == 0 or not sample:
+        return None
+    deflated = zlib.compress(sample)
+    runs = max(1, min(100, 1048576 // len(sample)))
+    start = time.time()
+    for _ in xrange(runs):
+        zlib.decompress(deflated)
+    per_byte_time = (time.time() - start) / runs / len(sample)
+    per_byte_saved = 1 - float(len(deflated)) / len(sample)
+    received = stats['payload_bytes'] - previous['payload_bytes']
+    return received * per_byte_saved, received * per_byte_time
+
+class _CompressionManaged(object):
+    """
+    Controller state for one monitor.
+    """
+
+    def __init__(self, session, compression):
+        self.session       = session
+        self.compression   = compression
+        self.last_snapshot = session.stats.snapshot()
+        self.last_change   = 0
+        # Latest (bytes_saved, inflate_seconds) estimate.
+        self.estimate      = None
+
+class CompressionController(_Controller):
+    """
+    Decides between gzip and no compression for each managed monitor by
+    weighing the bandwidth compression saves against the CPU the IO thread
+    spends decompressing.
+
+    Compression is worth it when it saves at least bytes_per_cpu_second
+    bytes for each second of decompression.  To avoid flapping, the
+    recommendation only changes when the measured value is a factor of
+    margin past that threshold.  Recommendations are available from
+    report(), and when auto is True monitors are updated to follow them at
+    most once per min_interval seconds.
+    """
+
+    def __init__(self, client, bytes_per_cpu_second=10485760, margin=2.0,
+                auto=False, interval=60.0, min_interval=600.0):
+        """
+        Creates a CompressionController and starts its thread.
+
+        :param client: The :class:`PushClient` the monitors belong to.
+        :param bytes_per_cpu_second: Break-even bytes saved per second of
+            decompression CPU.
+        :param margin: Factor past the break-even needed to switch.
+        :param auto: Whether to update monitors to the recommendation.
+        :param interval: Seconds between evaluations.
+        :param min_interval: Minimum seconds between updates of a monitor.
+        """
+        self.bytes_per_cpu_second = bytes_per_cpu_second
+        self.margin               = margin
+        self.auto                 = auto
+        self.min_interval         = min_interval
+        _Controller.__init__(self, client, interval)
+
+    def manage(self, session, compression='gzip'):
+        """
+        Starts evaluating the monitor of a session.
+
+        :param session: The :class:`PushSession` of the monitor.
+        :param compression: The compression the monitor was created with.
+        """
+        self._managed[session.monitor_id] = \
+            _CompressionManaged(session, compression)
+        # Uncompressed payloads are only sampled for a controller.
+        session.stats.sampling = True
+
+    def unmanage(self, session):
+        """
+        Stops evaluating the monitor of a session.
+
+        :param session: The :class:`PushSession` of the monitor.
+        """
+        _Controller.unmanage(self, session)
+        session.stats.sampling = False
+        session.stats.sample = None
+
+    def recommend(self, compression, bytes_saved, inflate_time):
+        """
+        Returns the compression ('gzip' or 'none') recommended given the
+        current compression and an estimate of its effect.
+
+        :param compression: The monitor's current compression.
+        :param bytes_saved: Bytes saved by compression.
+        :param inflate_time: Seconds spent decompressing.
+        """
+        if bytes_saved <= 0:
+            return 'none'
+        if inflate_time <= 0:
+            return 'gzip'
+        value = bytes_saved / inflate_time
+        if compression == 'gzip' and \
+                value < self.bytes_per_cpu_second / self.margin:
+            return 'none'
+        if compression != 'gzip' and \
+                value > self.bytes_per_cpu_second * self.margin:
+            return 'gzip'
+        return compression
+
+    def report(self, monitor_id):
+        """
+        Returns a dict describing the compression of a managed monitor:
+        its current compression, the latest estimate of bytes saved and
+        inflate seconds, and the recommended compression.
+
+        :param monitor_id: The id of the monitor.
+        """
+        managed = self._managed[monitor_id]
+        report = {'compression' : managed.compression,
+                  'bytes_saved' : None,
+                  'inflate_time' : None,
+                  'recommendation' : managed.compression}
+        if managed.estimate is not None:
+            report['bytes_saved'], report['inflate_time'] = managed.estimate
+            report['recommendation'] = self.recommend(managed.compression,
+                                                      *managed.estimate)
+        return report
+
+    def _evaluate(self, managed, now):
+        """
+        Estimates the effect of compression on a managed monitor since the
+        last evaluation and applies the recommendation in auto mode.
+        """
+        snapshot = managed.session.stats.snapshot()
+        snapshot['sample'] = managed.session.stats.sample
+        estimate = estimate_compression(snapshot, managed.last_snapshot)
+        managed.last_snapshot = snapshot
+        if estimate is None:
+            return
+        managed.estimate = estimate
+
+        recommendation = self.recommend(managed.compression, *estimate)
+        if not self.auto or recommendation == managed.compression or \
+                now - managed.last_change < self.min_interval:
+            return
+
+        LOG.info("Updating Monitor %s compression %s -> %s (%d bytes saved "
+                 "for %.3fs of decompression)."
+                 % (managed.session.monitor_id, managed.compression,
+                    recommendation, estimate[0], estimate[1]))
+        self.client.update_monitor(managed.session.monitor_id,
+                                    compression=recommendation)
+        managed.compression = recommendation
+        managed.last_change = now
@@ -0,0 +1,441 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Windowed Aggregation
+
+Computes the count, min, max, mean and last value of each Dia channel (or
+DataPoint stream) over tumbling or sliding windows of event time, as the
+values are pushed, and hands the result of each window to a sink once it
+is complete.
+"""
+import heapq
+import logging
+
+from threading import Lock
+
+from .batching import parse_timestamp
+from .codec import PayloadCodec
+
+LOG = logging.getLogger("idigi_monitor_api.aggregation")
+
+# Fields of a pane: the aggregate of the values of one key falling in one
+# slide of time.
+COUNT, TOTAL, MIN, MAX, LAST_TIME, LAST = range(6)
+
+class WindowResult(object):
+    """
+    The aggregate of the values of one key over one window, which covers
+    event times from start (inclusive) to end (exclusive).
+    """
+
+    __slots__ = ('device', 'channel', 'start', 'end', 'count', 'min', 'max',
+                'mean', 'last')
+
+    def __init__(self, device, channel, start, end, count, minimum, maximum,
+                mean, last):
+        self.device  = device
+        self.channel = channel
+        self.start   = start
+        self.end     = end
+        self.count   = count
+        self.min     = minimum
+        self.max     = maximum
+        self.mean    = mean
+        self.last    = last
+
+    def __repr__(self):
+        return "WindowResult(%r, %r, %r, %r, count=%d, min=%r, max=%r, " \
+            "mean=%r, last=%r)" % (self.device, self.channel, self.start,
+            self.end, self.count, self.min, self.max, self.mean, self.last)
+
+class _Series(object):
+    """
+    The state kept for one key: the panes still open to events, and the
+    closed panes of the current window with the monotonic deques of their
+    minimums and maximums.
+    """
+
+    __slots__ = ('open', 'due', 'window', 'count', 'total', 'mins', 'maxs')
+
+    def __init__(self):
+        # Pane index -> pane, for panes whose end the watermark has not
+        # reached.
+        self.open   = {}
+        # Index of the next pane to close, the bucket this series is in.
+        self.due    = None
+        # Sliding windows only, created once a pane closes: (index, count,
+        # total, last) of the closed, non-empty panes of the window, oldest
+        # first, with their sums.  Lists serve as deques, they never hold
+        # more than a window's panes.
+        self.window = None
+        self.count  = 0
+        self.total  = 0.0
+        # (index, min) increasing and (index, max) decreasing, so the
+        # window's minimum and maximum are always first.
+        self.mins   = None
+        self.maxs   = None
+
+class WindowAggregator(object):
+    """
+    A callable suitable as a session callback for a json formatted
+    DiaChannelDataFull or DataPoint monitor, aggregating the numeric values
+    of each channel over windows of size seconds, starting every slide
+    seconds:
+
+        def sink(results):
+            for result in results:
+                print result.device, result.channel, result.end, result.mean
+
+        aggregator = WindowAggregator(sink, size=300, slide=60, lateness=10)
+        client.create_session(aggregator, monitor_id)
+
+    Dia channel values are kept under (devConnectwareId,
+    'ddInstanceName.dcChannelName') and DataPoint values under (streamId,
+    None).  Values that are not numbers are ignored.
+
+    Windows are of event time, the timestamp of each value, and are
+    aligned on multiples of slide since the epoch.  Each key's values are
+    aggregated per slide, in panes, so an event only updates the running
+    count, sum, min, max and last of its pane.  When a pane closes it is
+    added to the key's window, whose sums are kept up to date and whose
+    minimum and maximum are kept at the head of monotonic deques, so a
+    window's result costs the same whatever the number of panes or values
+    in it.
+
+    A window is complete once the watermark, the latest timestamp seen
+    less lateness seconds, passes its end.  Events for a window that is
+    already complete are late: they are counted and passed to late, if
+    given, rather than aggregated.  The keys with a pane due to close are
+    kept in buckets by pane, so advancing the watermark only visits the
+    keys with a window to complete.
+
+    Only windows holding at least one value are emitted, and a key whose
+    windows are all emitted is forgotten, so memory is bounded by the
+    number of keys active within size + lateness seconds.  At most
+    max_keys keys are aggregated at once; events for further keys are
+    dropped and counted until others are forgotten.
+    """
+
+    def __init__(self, sink, size=60.0, slide=None, lateness=0.0,
+                max_keys=100000, late=None, callback=None):
+        """
+        :param sink: function called with a list of the
+            :class:`WindowResult` completed by an event, in order of end.
+        :param size: Seconds of event time covered by each window.
+        :param slide: Seconds between the starts of successive windows, a
+            divisor of size.  None (the default) for tumbling windows,
+            where slide is size.
+        :param lateness: Seconds an event may arrive after events later
+            than it and still be aggregated.
+        :param max_keys: Maximum number of keys aggregated at once.
+        :param late: Optional function called with the device, channel,
+            timestamp and value of each late event.
+        :param callback: Optional session callback the payloads are then
+            passed to, its result is returned.
+        """
+        slide = size if slide is None else slide
+        panes = int(round(size / float(slide)))
+        if slide <= 0 or abs(panes * slide - size) > 1e-9 * size:
+            raise ValueError("size must be a multiple of slide.")
+        self.sink        = sink
+        self.size        = size
+        self.slide       = slide
+        self.lateness    = lateness
+        self.max_keys    = max_keys
+        self.late        = late
+        self.callback    = callback
+        # Number of panes in a window.
+        self.panes       = panes
+        self.watermark   = float('-inf')
+        self.__series    = {}
+        # Pane index -> keys whose next pane to close is that pane, and the
+        # heap of those pane indexes.
+        self.__buckets   = {}
+        self.__due       = []
+        self.__stats     = {'events' : 0, 'late' : 0, 'dropped' : 0,
+                            'ignored' : 0, 'windows' : 0}
+        self.__codec     = PayloadCodec('json')
+        self.__lock      = Lock()
+        # Held from when windows are completed until the sink has them, so
+        # that successive lists reach the sink in order.
+        self.__emitting  = Lock()
+
+    def __len__(self):
+        return len(self.__series)
+
+    def stats(self):
+        """
+        Returns a dict of the number of keys being aggregated and of
+        events aggregated, late, dropped for exceeding max_keys and ignored
+        for not being numbers, and of windows emitted.
+        """
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['keys'] = len(self.__series)
+        return stats
+
+    def __schedule(self, key, series, index):
+        """
+        Puts a key in the bucket of the pane it is next due at.  Must hold
+        the lock.
+        """
+        if series.due is not None:
+            self.__buckets[series.due].discard(key)
+        series.due = index
+        bucket = self.__buckets.get(index)
+        if bucket is None:
+            bucket = self.__buckets[index] = set()
+            heapq.heappush(self.__due, index)
+        bucket.add(key)
+
+    def __close(self, key, series, index, results):
+        """
+        Closes pane index of a key, adding the result of the window ending
+        with it to results if that window holds any value.  Returns True if
+        the next window holds values too.  Must hold the lock.
+        """
+        pane = series.open.pop(index, None)
+        end = (index + 1) * self.slide
+        if self.panes == 1:
+            # Tumbling: the window is the pane.
+            if pane is not None:
+                results.append(WindowResult(key[0], key[1], end - self.size,
+                                            end, pane[COUNT], pane[MIN],
+                                            pane[MAX],
+                                            pane[TOTAL] / pane[COUNT],
+                                            pane[LAST]))
+            return False
+
+        window = series.window
+        if window is None:
+            window = series.window = []
+            series.mins = []
+            series.maxs = []
+        mins = series.mins
+        maxs = series.maxs
+        oldest = index - self.panes
+        if window and window[0][0] <= oldest:
+            # Min and max entries are of panes in the window, so they only
+            # need evicting if panes left it.
+            while window and window[0][0] <= oldest:
+                _, count, total, _ = window.pop(0)
+                series.count -= count
+                series.total -= total
+            while mins and mins[0][0] <= oldest:
+                del mins[0]
+            while maxs and maxs[0][0] <= oldest:
+                del maxs[0]
+        if pane is not None:
+            window.append((index, pane[COUNT], pane[TOTAL], pane[LAST]))
+            series.count += pane[COUNT]
+            series.total += pane[TOTAL]
+            minimum = pane[MIN]
+            while mins and mins[-1][1] >= minimum:
+                mins.pop()
+            mins.append((index, minimum))
+            maximum = pane[MAX]
+            while maxs and maxs[-1][1] <= maximum:
+                maxs.pop()
+            maxs.append((index, maximum))
+        elif not window:
+            # Keeps subtraction from leaving rounding errors behind.
+            series.total = 0.0
+            return False
+
+        # Panes are in time order, so the last value is the newest pane's.
+        newest = window[-1]
+        results.append(WindowResult(key[0], key[1], end - self.size, end,
+                                    series.count, mins[0][1], maxs[0][1],
+                                    series.total / series.count, newest[3]))
+        return newest[0] > oldest + 1
+
+    def __advance(self, watermark):
+        """
+        Moves the watermark forward, closing the panes it passes the end
+        of in order.  Returns the results of the windows completed.  Must
+        hold the lock.
+        """
+        results = []
+        if watermark <= self.watermark:
+            return results
+        self.watermark = watermark
+        slide = self.slide
+        due = self.__due
+        buckets = self.__buckets
+        all_series = self.__series
+        close = self.__close
+        while due and (due[0] + 1) * slide <= watermark:
+            index = heapq.heappop(due)
+            following = None
+            for key in buckets.pop(index):
+                series = all_series[key]
+                if close(key, series, index, results):
+                    # Most keys due at a pane are due at the next one too.
+                    if following is None:
+                        following = buckets.get(index + 1)
+                        if following is None:
+                            following = buckets[index + 1] = set()
+                            heapq.heappush(due, index + 1)
+                    series.due = index + 1
+                    following.add(key)
+                    continue
+                series.due = None
+                if series.open:
+                    self.__schedule(key, series, min(series.open))
+                else:
+                    del all_series[key]
+        self.__stats['windows'] += len(results)
+        return results
+
+    def __emit(self, results):
+        """
+        Passes results to the sink, logging any exception it raises.  Must
+        hold the emitting lock, which is released.
+        """
+        try:
+            self.sink(results)
+        except Exception, exception:
+            LOG.exception(exception)
+        finally:
+            self.__emitting.release()
+
+    def add(self, device, channel, timestamp, value):
+        """
+        Aggregates the value of a key at timestamp, passing the windows it
+        completes to the sink.  Returns False if the event was late or
+        dropped.
+
+        :param device: The devConnectwareId of the device, or a streamId.
+        :param channel: 'ddInstanceName.dcChannelName', or None.
+        :param timestamp: Seconds since the epoch the value was reported at.
+        :param value: The value, a number.
+        """
+        key = (device, channel)
+        index = int(timestamp // self.slide)
+        late = False
+        with self.__lock:
+            if (index + 1) * self.slide <= self.watermark:
+                self.__stats['late'] += 1
+                late = True
+            else:
+                series = self.__series.get(key)
+                if series is None:
+                    if len(self.__series) >= self.max_keys:
+                        if not self.__stats['dropped']:
+                            LOG.warn("More than max_keys (%d) keys, " \
+                                "dropping events of new keys." % \
+                                self.max_keys)
+                        self.__stats['dropped'] += 1
+                        return False
+                    series = self.__series[key] = _Series()
+                pane = series.open.get(index)
+                if pane is None:
+                    series.open[index] = [1, value, value, value, timestamp,
+                                        value]
+                    if series.due is None or index < series.due:
+                        self.__schedule(key, series, index)
+                else:
+                    pane[COUNT] += 1
+                    pane[TOTAL] += value
+                    if value < pane[MIN]:
+                        pane[MIN] = value
+                    if value > pane[MAX]:
+                        pane[MAX] = value
+                    if timestamp >= pane[LAST_TIME]:
+                        pane[LAST_TIME] = timestamp
+                        pane[LAST] = value
+                self.__stats['events'] += 1
+                results = self.__advance(timestamp - self.lateness)
+                if results:
+                    self.__emitting.acquire()
+        if late:
+            if self.late is not None:
+                self.late(device, channel, timestamp, value)
+            return False
+        if results:
+            self.__emit(results)
+        return True
+
+    def advance(self, watermark):
+        """
+        Moves the watermark forward to watermark, completing the windows
+        that end before it.  Windows otherwise only complete as later
+        events arrive, so this lets them complete when the monitor is
+        quiet, i.e. with time.time() - lateness from a timer.
+
+        :param watermark: Seconds since the epoch.
+        """
+        with self.__lock:
+            results = self.__advance(watermark)
+            if results:
+                self.__emitting.acquire()
+        if results:
+            self.__emit(results)
+
+    def update(self, msg):
+        """
+        Aggregates the value carried by a decoded DiaChannelDataFull or
+        DataPoint Msg.  Returns True if the value was aggregated.
+
+        :param msg: A decoded Msg.
+        """
+        if msg.get('operation') == 'DELETE':
+            return False
+        data = msg.get('DiaChannelDataFull')
+        if data is not None:
+            channel_id = data['id']
+            device = channel_id['devConnectwareId']
+            channel = "%s.%s" % (channel_id['ddInstanceName'],
+                                channel_id['dcChannelName'])
+            timestamp = data.get('dcdUpdateTime') or msg['timestamp']
+            value = data.get('dcdStringValue')
+        else:
+            data = msg.get('DataPoint')
+            if data is None:
+                return False
+            device = data['streamId']
+            channel = None
+            timestamp = msg['timestamp']
+            value = data.get('data')
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            with self.__lock:
+                self.__stats['ignored'] += 1
+            return False
+        return self.add(device, channel, parse_timestamp(timestamp), value)
+
+    def __call__(self, data):
+        """
+        Session callback: aggregates the values in a payload, or in a
+        document already decoded by the session's codec.
+
+        :param data: The payload of the PublishMessage.
+        """
+        document = data if isinstance(data, dict) else self.__codec(data)
+        for msg in self.__codec.messages(document):
+            self.update(msg)
+        if self.callback is not None:
+            return self.callback(data)
+        return True
+
+    def close(self):
+        """
+        Completes every window holding a value, as if no more events were
+        to come, and passes them to the sink.
+        """
+        with self.__lock:
+            results = self.__advance(float('inf'))
+            if results:
+                self.__emitting.acquire()
+        if results:
+            self.__emit(results)
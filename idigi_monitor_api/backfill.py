@@ -0,0 +1,394 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Gap Backfill
+
+Recovers the events a monitor missed while its session was down.  A
+GapBackfill is used as the session's callback and its connected method as
+the session's on_connect.  It remembers the timestamp of the last
+event delivered, and after a reconnect queries the REST resource of each
+of the monitor's topics (i.e. /ws/DeviceCore) for the events since then.
+Live payloads received meanwhile are held, and once the queries complete
+both are merged in timestamp order, without duplicates, and passed to the
+callback one Msg at a time.
+"""
+import logging
+import time
+
+from collections import deque
+from Queue import Queue, Empty
+from threading import Lock, Thread
+
+from .codec import PayloadCodec
+from .push_client import AckHandle
+
+LOG = logging.getLogger("idigi_monitor_api.backfill")
+
+# Field holding the time of the event of each resource, compared against
+# the timestamp of the last event delivered.
+TIME_FIELDS = {
+    'DeviceCore' : 'dpLastConnectTime',
+    'FileData' : 'fdLastModifiedDate',
+    'DiaChannelDataFull' : 'dcdUpdateTime',
+    'XbeeCore' : 'xpLastUpdateTime',
+}
+
+def _resource_of(topic):
+    """
+    Returns the resource of a monitor topic (i.e. DeviceCore[U] or
+    DiaChannelDataFull/00000000-00000000-00409DFF-FF000001) or of a Msg
+    topic (i.e. 1210/DeviceCore/7200/0).
+    """
+    parts = topic.split('/')
+    if parts[0].isdigit() and len(parts) > 1:
+        parts = parts[1:]
+    return parts[0].split('[')[0]
+
+class ConnectionPool(object):
+    """
+    A fixed number of persistent HTTP connections to iDigi's web services,
+    shared by threads making requests.
+    """
+
+    def __init__(self, client, size=4, hostname=None):
+        """
+        :param client: The :class:`PushClient` whose credentials are used.
+        :param size: Maximum number of connections.
+        :param hostname: Host (and optional :port) of the web services,
+            None for the client's hostname and failover hostnames.
+        """
+        self.client   = client
+        self.hostname = hostname
+        self.__idle   = Queue()
+        for _ in xrange(size):
+            self.__idle.put(None)
+
+    def get_json(self, url):
+        """
+        Performs a GET and returns the decoded JSON response.  Blocks until
+        a connection is available.
+
+        :param url: Path and query of the request.
+        """
+        connection = self.__idle.get()
+        try:
+            if connection is None:
+                connection = self.client.get_http_connection(self.hostname)
+            connection.request('GET', url, headers=self.client.headers)
+            response = connection.getresponse()
+            content = response.read()
+            if response.status != 200:
+                raise Exception("Request for %s failed (%s): %s" \
+                    % (url, response.status, content))
+            import json
+            return json.loads(content)
+        except Exception:
+            # The connection is in an unknown state, open a new one.
+            if connection is not None:
+                connection.close()
+            connection = None
+            raise
+        finally:
+            self.__idle.put(connection)
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        while True:
+            try:
+                connection = self.__idle.get_nowait()
+            except Empty:
+                return
+            if connection is not None:
+                connection.close()
+
+class GapBackfill(object):
+    """
+    A session callback that fills gaps in the events of a monitor from
+    REST history.
+
+        backfill = GapBackfill(client, callback, ['DeviceCore'])
+        client.create_session(backfill, monitor_id,
+                                on_connect=backfill.connected)
+
+    callback is called with one decoded Msg (a dict) at a time and returns
+    True once it is processed.  A payload is acknowledged when all of its
+    Msgs are.  Backfilled Msgs have the resource as topic, the value of
+    its time field as timestamp and are marked 'backfilled'.  The monitor
+    must use the json format.
+    """
+
+    def __init__(self, client, callback, topics, since=None, page_size=1000,
+                parallel=4, hostname=None, time_fields=None, conditions=None,
+                history=65536):
+        """
+        :param client: The :class:`PushClient` of the session.
+        :param callback: Called with each Msg, in order.
+        :param topics: The topics of the monitor, the resources to query
+            are taken from them.
+        :param since: Timestamp of the last event processed by a previous
+            run, to backfill from when the session first connects.
+        :param page_size: Items requested per query.
+        :param parallel: Number of pages fetched at once, over as many
+            pooled connections.
+        :param hostname: Host (and optional :port) of the web services,
+            None for the client's hostname and failover hostnames.
+        :param time_fields: Overrides of TIME_FIELDS by resource.
+        :param conditions: Additional query condition by resource (i.e.
+            "devConnectwareId='00000000-00000000-00409DFF-FF000001'").
+        :param history: Number of recently delivered Msgs remembered to
+            drop duplicates.
+        """
+        self.callback    = callback
+        self.page_size   = page_size
+        self.parallel    = parallel
+        self.resources   = sorted(set(_resource_of(topic)
+                                    for topic in topics))
+        self.time_fields = dict(TIME_FIELDS, **(time_fields or {}))
+        self.conditions  = conditions or {}
+        # Timestamp of the newest event delivered.
+        self.last_timestamp = since
+        self.pool        = ConnectionPool(client, parallel, hostname)
+        self.__codec     = PayloadCodec('json')
+        self.__lock      = Lock()
+        # Live Msgs held while backfilling, with the handle of their
+        # payload, and whether a backfill is running.
+        self.__held      = []
+        self.__filling   = False
+        # Gaps to fill, as the timestamps they start at.
+        self.__gaps      = []
+        self.__connected = False
+        # Keys of recently delivered Msgs, oldest first.
+        self.__recent    = deque()
+        self.__seen      = set()
+        self.__history   = history
+        for resource in self.resources:
+            if resource not in self.time_fields:
+                raise ValueError("No time field known for %s." % resource)
+
+    def __key(self, resource, body):
+        """
+        Returns the key identifying an event of resource for deduplication.
+        """
+        identity = body.get('id')
+        if isinstance(identity, dict):
+            identity = tuple(sorted(identity.items()))
+        return (resource, identity, body.get(self.time_fields[resource]))
+
+    def __event(self, msg):
+        """
+        Returns the (timestamp, key) of a Msg.
+        """
+        resource = _resource_of(msg.get('topic', ''))
+        body = msg.get(resource)
+        if not isinstance(body, dict) or resource not in self.time_fields:
+            return msg.get('timestamp'), None
+        return body.get(self.time_fields[resource]) or msg.get('timestamp'), \
+            self.__key(resource, body)
+
+    def __deliver(self, events):
+        """
+        Calls back with events, a list of (timestamp, key, Msg) tuples, in
+        order and skipping duplicates.  Returns whether every Msg was
+        processed.
+        """
+        success = True
+        for timestamp, key, msg in events:
+            if key is not None:
+                with self.__lock:
+                    if key in self.__seen:
+                        continue
+            if not self.callback(msg):
+                success = False
+                continue
+            with self.__lock:
+                if key is not None:
+                    self.__seen.add(key)
+                    self.__recent.append(key)
+                    if len(self.__recent) > self.__history:
+                        self.__seen.discard(self.__recent.popleft())
+                if timestamp is not None and (self.last_timestamp is None
+                        or timestamp > self.last_timestamp):
+                    self.last_timestamp = timestamp
+        return success
+
+    def __call__(self, data):
+        """
+        Delivers the Msgs of a live payload, or holds them and returns an
+        AckHandle while a backfill is running.
+        """
+        document = self.__codec(data)
+        events = []
+        for msg in self.__codec.messages(document):
+            timestamp, key = self.__event(msg)
+            events.append((timestamp, key, msg))
+
+        with self.__lock:
+            if self.__filling:
+                handle = AckHandle()
+                self.__held.append((events, handle))
+                return handle
+        return self.__deliver(events)
+
+    def connected(self, session):
+        """
+        Starts filling the gap since the last event delivered.  Given to
+        create_session as on_connect, it is called whenever the session
+        connects.
+        """
+        with self.__lock:
+            first = not self.__connected
+            self.__connected = True
+            if self.last_timestamp is None:
+                # Nothing delivered yet, there is no gap to fill.
+                if not first:
+                    LOG.warn("Monitor %s reconnected before any event, " \
+                        "not backfilling." % session.monitor_id)
+                return
+            self.__gaps.append(self.last_timestamp)
+            if self.__filling:
+                return
+            self.__filling = True
+        LOG.info("Backfilling Monitor %s since %s." % (session.monitor_id,
+                                                    self.last_timestamp))
+        thread = Thread(target=self.__fill)
+        thread.daemon = True
+        thread.start()
+
+    def __query(self, resource, since):
+        """
+        Returns the items of resource at or after since, oldest first,
+        fetching pages in parallel once the total is known.
+        """
+        field = self.time_fields[resource]
+        condition = "%s>='%s'" % (field, since)
+        if resource in self.conditions:
+            condition += " and %s" % self.conditions[resource]
+
+        import urllib
+
+        def url(start):
+            return '/ws/%s/.json?%s' % (resource, urllib.urlencode([
+                ('condition', condition), ('orderby', field),
+                ('start', start), ('size', self.page_size)]))
+
+        first = self.pool.get_json(url(0))
+        pages = {0 : first.get('items', [])}
+        total = int(first.get('resultTotalRows', len(pages[0])))
+        starts = range(self.page_size, total, self.page_size)
+        remaining = Queue()
+        for start in starts:
+            remaining.put(start)
+        errors = []
+
+        def fetch():
+            while not errors:
+                try:
+                    start = remaining.get_nowait()
+                except Empty:
+                    return
+                try:
+                    pages[start] = self.pool.get_json(url(start))\
+                        .get('items', [])
+                except Exception, exception:
+                    errors.append(exception)
+
+        threads = [Thread(target=fetch)
+                    for _ in xrange(min(self.parallel, len(starts)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return [item for start in [0] + starts for item in pages[start]]
+
+    def __backfilled(self, since):
+        """
+        Returns the (timestamp, key, Msg) tuples of every resource since a
+        timestamp.
+        """
+        events = []
+        for resource in self.resources:
+            field = self.time_fields[resource]
+            started = time.time()
+            items = self.__query(resource, since)
+            LOG.info("Backfilled %d %s items in %.2f seconds." % (len(items),
+                    resource, time.time() - started))
+            for item in items:
+                timestamp = item.get(field)
+                events.append((timestamp, self.__key(resource, item),
+                                {'topic' : resource,
+                                'operation' : 'UPDATE',
+                                'timestamp' : timestamp,
+                                'backfilled' : True,
+                                resource : item}))
+        return events
+
+    def __fill(self):
+        """
+        Fills the pending gaps, then delivers the live Msgs held meanwhile
+        merged with the backfilled ones.  If the callback raises, the held
+        payloads not yet acknowledged are rejected and the backfill ends.
+        """
+        held = []
+        try:
+            while True:
+                with self.__lock:
+                    gaps = self.__gaps
+                    self.__gaps = []
+                    held = self.__held
+                    self.__held = []
+                    if not gaps and not held:
+                        self.__filling = False
+                        return
+                events = []
+                if gaps:
+                    try:
+                        events = self.__backfilled(min(gaps))
+                    except Exception, exception:
+                        LOG.error("Backfill since %s failed, events in " \
+                            "the gap are lost: %s" % (min(gaps), exception))
+
+                # Timestamps of the same format sort chronologically.  Each
+                # held payload is acknowledged once its own Msgs are
+                # delivered.
+                merged = [(event, None) for event in events]
+                for held_events, handle in held:
+                    merged.extend((event, handle) for event in held_events)
+                merged.sort(key=lambda item: item[0][0])
+                failed = set()
+                for event, handle in merged:
+                    if not self.__deliver([event]) and handle is not None:
+                        failed.add(handle)
+                for _, handle in held:
+                    if handle in failed:
+                        handle.nack()
+                    else:
+                        handle.ack()
+        except Exception, exception:
+            LOG.exception(exception)
+        finally:
+            with self.__lock:
+                if self.__filling:
+                    # Left by an exception, live payloads are delivered
+                    # directly again and those held are redelivered.
+                    held.extend(self.__held)
+                    self.__held = []
+                    self.__filling = False
+                else:
+                    held = []
+            for _, handle in held:
+                if not handle.done:
+                    handle.nack()
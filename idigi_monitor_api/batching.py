@@ -0,0 +1,333 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Columnar Batching
+
+Collects DiaChannelDataFull events pushed by iDigi into column arrays and
+hands complete batches to a sink, so downstream processing can work on
+whole columns instead of one decoded message at a time.
+"""
+import calendar
+import logging
+import time
+
+from array import array
+from threading import Lock, Thread, Event
+
+from .push_client import AckHandle
+
+LOG = logging.getLogger("idigi_monitor_api.batching")
+
+NAN = float('nan')
+
+def parse_timestamp(timestamp):
+    """
+    Converts an iDigi timestamp (i.e. 2012-06-12T03:18:45.381Z) to seconds
+    since the epoch.
+
+    :param timestamp: The timestamp string of a message.
+    """
+    seconds = calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]),
+                                int(timestamp[8:10]), int(timestamp[11:13]),
+                                int(timestamp[14:16]), int(timestamp[17:19]),
+                                0, 0, 0))
+    if len(timestamp) > 20 and timestamp[19] == '.':
+        seconds += float('0' + timestamp[19:].rstrip('Z'))
+    return seconds
+
+class _PendingAck(object):
+    """
+    Acknowledges a payload once every batch holding its events has been
+    passed to the sink, or rejects it if the sink failed on any of them.
+    """
+
+    def __init__(self):
+        # One hold for adding the events, and one per batch holding some.
+        self.handle  = AckHandle()
+        self.__lock  = Lock()
+        self.__holds = 1
+        self.__ok    = True
+
+    def hold(self):
+        """
+        Waits for one more batch.
+        """
+        with self.__lock:
+            self.__holds += 1
+
+    def release(self, success):
+        """
+        Records a batch passed to the sink, or the events all added.
+
+        :param success: Whether the sink processed the batch.
+        """
+        with self.__lock:
+            self.__holds -= 1
+            self.__ok = self.__ok and success
+            if self.__holds > 0:
+                return
+        if self.__ok:
+            self.handle.ack()
+        else:
+            self.handle.nack()
+
+class DiaChannelBatch(object):
+    """
+    A batch of Dia channel events stored column-wise.  Row i of the batch
+    is made of element i of every column.
+
+    Device ids and channel names are interned: the devices and channels
+    columns hold indexes into device_table and channel_table, which are
+    shared by all batches of a batcher so indexes stay stable.
+    """
+
+    def __init__(self, device_table, channel_table):
+        """
+        Creates an empty DiaChannelBatch.
+
+        :param device_table: list of device ids indexed by devices.
+        :param channel_table: list of instance.channel names indexed by
+            channels.
+        """
+        self.device_table  = device_table
+        self.channel_table = channel_table
+        # Seconds since the epoch of each event.
+        self.timestamps    = array('d')
+        self.devices       = array('I')
+        self.channels      = array('I')
+        # Numeric value of each event, NaN if the value is not numeric.
+        self.values        = array('d')
+        # Raw dcdStringValue of each event.
+        self.strings       = []
+        # Time the first event was appended.
+        self.started       = None
+        # Payloads acknowledged once the batch is sunk, if the batcher 
+        # acknowledges after its sink.
+        self.acks          = []
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, timestamp, device, channel, value):
+        """
+        Appends an event to the batch.
+
+        :param timestamp: seconds since the epoch of the event.
+        :param device: index of the device id in device_table.
+        :param channel: index of the channel name in channel_table.
+        :param value: the dcdStringValue of the event.
+        """
+        if self.started is None:
+            self.started = time.time()
+        self.timestamps.append(timestamp)
+        self.devices.append(device)
+        self.channels.append(channel)
+        try:
+            self.values.append(float(value))
+        except (TypeError, ValueError):
+            self.values.append(NAN)
+        self.strings.append(value)
+
+    def rows(self):
+        """
+        Returns a generator of (timestamp, device_id, channel, string_value)
+        tuples, one per event.
+        """
+        device_table = self.device_table
+        channel_table = self.channel_table
+        for i in xrange(len(self.timestamps)):
+            yield (self.timestamps[i], device_table[self.devices[i]],
+                    channel_table[self.channels[i]], self.strings[i])
+
+    def as_numpy(self):
+        """
+        Returns a dict of the numeric columns as NumPy arrays.  The arrays
+        share memory with the batch.  Requires NumPy to be installed.
+        """
+        import numpy
+        return {'timestamps' : numpy.frombuffer(self.timestamps,
+                                                dtype=numpy.float64),
+                'devices'    : numpy.frombuffer(self.devices,
+                                                dtype=numpy.uint32),
+                'channels'   : numpy.frombuffer(self.channels,
+                                                dtype=numpy.uint32),
+                'values'     : numpy.frombuffer(self.values,
+                                                dtype=numpy.float64)}
+
+class DiaChannelBatcher(object):
+    """
+    A callable suitable as a session callback for a json formatted
+    DiaChannelDataFull monitor.  Events are added to the current batch,
+    which is handed to sink once it holds size events or is duration
+    seconds old, whichever comes first.
+
+    Messages are acknowledged once they are added to a batch, not when the
+    sink has processed it, unless ack_after_sink is set.  The callback then
+    returns an :class:`AckHandle` acknowledging the payload once every 
+    batch holding its events has been passed to the sink, or rejecting it 
+    if the sink raised, so iDigi redelivers it.  The session's 
+    max_in_flight must then leave room for a whole batch of payloads.
+    """
+
+    def __init__(self, sink, size=1000, duration=5.0, ack_after_sink=False):
+        """
+        Creates a DiaChannelBatcher.
+
+        :param sink: function called with each complete
+            :class:`DiaChannelBatch`.
+        :param size: Number of events after which a batch is complete.
+        :param duration: Seconds after which a non-empty batch is complete.
+        :param ack_after_sink: Whether payloads are acknowledged once their
+            batches are sunk rather than once added.
+        """
+        self.sink           = sink
+        self.size           = size
+        self.duration       = duration
+        self.ack_after_sink = ack_after_sink
+        self.device_table   = []
+        self.channel_table  = []
+        self.__device_ids   = {}
+        self.__channel_ids  = {}
+        self.__lock         = Lock()
+        self.__batch        = self.__new_batch()
+        self.__closed       = Event()
+
+        if duration is not None:
+            timer = Thread(target=self.__flush_expired)
+            timer.daemon = True
+            timer.start()
+
+    def __new_batch(self):
+        """
+        Returns a new empty batch using this batcher's intern tables.
+        """
+        return DiaChannelBatch(self.device_table, self.channel_table)
+
+    def __intern(self, ids, table, key):
+        """
+        Returns the index of key in table, adding it if not yet present.
+
+        :param ids: dict mapping keys to their index in table.
+        :param table: list of keys.
+        :param key: the key to intern.
+        """
+        index = ids.get(key)
+        if index is None:
+            index = ids[key] = len(table)
+            table.append(key)
+        return index
+
+    def __flush_expired(self):
+        """
+        Periodically hands the current batch to the sink if it is older
+        than duration.
+        """
+        while not self.__closed.is_set():
+            self.__closed.wait(self.duration / 4.0)
+            batch = None
+            with self.__lock:
+                if len(self.__batch) > 0 and \
+                        time.time() - self.__batch.started >= self.duration:
+                    batch = self.__batch
+                    self.__batch = self.__new_batch()
+            if batch is not None:
+                self.__emit(batch)
+
+    def __emit(self, batch):
+        """
+        Passes a batch to the sink, logging any exception it raises, then
+        completes the acknowledgements waiting for it.
+
+        :param batch: the complete batch.
+        """
+        success = False
+        try:
+            self.sink(batch)
+            success = True
+        except Exception, exception:
+            LOG.exception(exception)
+        for pending in batch.acks:
+            pending.release(success)
+
+    def add(self, msg, pending=None):
+        """
+        Adds a decoded Msg to the current batch.  Returns a complete batch
+        if adding the message completed it, otherwise None.
+
+        :param msg: a decoded DiaChannelDataFull Msg.
+        :param pending: The _PendingAck of the message's payload, if it is 
+            acknowledged after the sink.
+        """
+        data = msg['DiaChannelDataFull']
+        channel_id = data['id']
+        timestamp = parse_timestamp(msg['timestamp'])
+        with self.__lock:
+            device = self.__intern(self.__device_ids, self.device_table,
+                                    channel_id['devConnectwareId'])
+            channel = self.__intern(self.__channel_ids, self.channel_table,
+                                    "%s.%s" % (channel_id['ddInstanceName'],
+                                                channel_id['dcChannelName']))
+            self.__batch.append(timestamp, device, channel,
+                                data.get('dcdStringValue'))
+            acks = self.__batch.acks
+            if pending is not None and (not acks or acks[-1] is not pending):
+                pending.hold()
+                acks.append(pending)
+            if len(self.__batch) >= self.size:
+                batch = self.__batch
+                self.__batch = self.__new_batch()
+                return batch
+        return None
+
+    def __call__(self, data):
+        """
+        Session callback: decodes the payload and adds each
+        DiaChannelDataFull message in it to the current batch.  Returns 
+        True, or with ack_after_sink an AckHandle.
+
+        :param data: The payload of the PublishMessage, a string or an
+            mmap of a spilled payload.
+        """
+        import json
+        if not isinstance(data, str):
+            data = data[:]
+        msgs = json.loads(data)['Document']['Msg']
+        if isinstance(msgs, dict):
+            msgs = [msgs]
+        pending = _PendingAck() if self.ack_after_sink else None
+        for msg in msgs:
+            if 'DiaChannelDataFull' not in msg:
+                continue
+            batch = self.add(msg, pending)
+            if batch is not None:
+                self.__emit(batch)
+        if pending is None:
+            return True
+        pending.release(True)
+        return pending.handle
+
+    def flush(self):
+        """
+        Hands the current batch to the sink now if it is not empty.
+        """
+        with self.__lock:
+            batch = self.__batch
+            self.__batch = self.__new_batch()
+        if len(batch) > 0:
+            self.__emit(batch)
+
+    def close(self):
+        """
+        Stops the duration timer and flushes the current batch.
+        """
+        self.__closed.set()
+        self.flush()
@@ -0,0 +1,523 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Local Fan-out
+
+Lets a single push session feed any number of consumer processes on the
+same host.  A FanoutBroker is used as the session's callback and
+republishes every payload over a Unix domain socket to the connected
+FanoutSubscribers, each of which reads at its own offset.
+
+Subscribers may be durable: the broker then only lets the payload be
+acknowledged to iDigi once every durable subscriber has confirmed it, so
+iDigi redelivers anything a durable subscriber has not processed.
+"""
+import errno
+import fcntl
+import logging
+import os
+import select
+import socket
+import struct
+import time
+
+from threading import Condition, Thread
+
+LOG = logging.getLogger("idigi_monitor_api.broker")
+
+# Frames sent by the broker: type, offset and length, followed by length
+# bytes of payload for a MESSAGE.  A GAP tells a subscriber that length
+# payloads were dropped before offset because it fell too far behind.
+FRAME_HEADER = struct.Struct('!BQI')
+MESSAGE = 0x01
+GAP = 0x02
+
+# Frames sent by subscribers.  A HELLO carries flags, the offset to start
+# reading at and the length of the subscriber's name, followed by the name.
+# A CONFIRM carries the offset following the last payload processed.
+HELLO = struct.Struct('!BBQH')
+CONFIRM = struct.Struct('!BQ')
+HELLO_TYPE = 0x10
+CONFIRM_TYPE = 0x11
+
+# HELLO flag of durable subscribers.
+DURABLE = 0x01
+
+# Start offset meaning the newest payload, or for a known durable
+# subscriber the payload following the last one it confirmed.
+LATEST = 0xFFFFFFFFFFFFFFFF
+
+def _recv_exactly(sock, size):
+    """
+    Reads size bytes from a blocking socket.  Raises EOFError if the
+    connection is closed first.
+
+    :param sock: The socket to read.
+    :param size: Number of bytes to read.
+    """
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError("Connection closed.")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+class _Subscriber(object):
+    """
+    The broker side state of a connected subscriber.
+    """
+
+    def __init__(self, sock):
+        """
+        :param sock: The non blocking socket of the subscriber.
+        """
+        self.socket   = sock
+        # Set once the HELLO has been received.
+        self.name     = None
+        self.durable  = False
+        # Offset of the next payload to send.
+        self.offset   = None
+        # Unparsed received bytes, and the current frame and how much of 
+        # it was sent.
+        self.inbound  = ''
+        self.outbound = ''
+        self.sent     = 0
+        # Payloads dropped because the subscriber fell behind.
+        self.skipped  = 0
+
+class FanoutBroker(object):
+    """
+    A callable suitable as a session callback, which republishes each
+    payload to the subscribers connected to a Unix domain socket.
+
+    Payloads are numbered with consecutive offsets and kept in memory for
+    as long as a durable subscriber has not confirmed them, plus up to
+    history bytes of already confirmed ones for subscribers that lag or
+    reconnect.  A non durable subscriber that falls behind the oldest kept
+    payload skips ahead to it and is sent a GAP.
+
+    The callback returns True once every durable subscriber known to the
+    broker, connected or not, has confirmed the payload, or False after
+    confirm_timeout seconds so that iDigi redelivers it.  A redelivered
+    payload keeps the offset it was first published at.  While more than
+    max_unconfirmed bytes await confirmation, for instance because a
+    durable subscriber is disconnected, new payloads are refused at once.
+    Delivery is thus at least once.  Offsets restart at 0 when the broker 
+    is created.
+    """
+
+    def __init__(self, path, history=16777216, confirm_timeout=30.0,
+                max_unconfirmed=67108864):
+        """
+        Creates a FanoutBroker listening on path and starts its thread.
+
+        :param path: Filesystem path of the Unix domain socket.  An
+            existing socket file at path is replaced.
+        :param history: Bytes of confirmed payloads kept for lagging
+            subscribers.
+        :param confirm_timeout: Seconds the callback waits for durable
+            subscribers to confirm a payload.
+        :param max_unconfirmed: Bytes of payloads kept beyond history
+            before new payloads are refused.
+        """
+        self.path            = path
+        self.history         = history
+        self.confirm_timeout = confirm_timeout
+        self.max_unconfirmed = max_unconfirmed
+        # Kept payloads, __log[i] being that of offset __base + i.  Those
+        # before offset __first were evicted, and are removed from the list
+        # once they make up half of it.
+        self.__log           = []
+        self.__base          = 0
+        self.__first         = 0
+        self.__log_bytes     = 0
+        self.__next          = 0
+        # Payloads whose callback timed out -> their offset, to publish 
+        # them at the same offset when iDigi redelivers them.
+        self.__timed_out     = {}
+        # Name of every durable subscriber ever seen -> confirmed offset.
+        self.__durable       = {}
+        self.__subscribers   = {}
+        self.__condition     = Condition()
+        self.__closed        = False
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.__listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__listener.bind(path)
+        self.__listener.listen(16)
+        self.__listener.setblocking(0)
+        # Written to by the callback to wake the thread from select.
+        self.__wake_read, self.__wake_write = os.pipe()
+        for fd in (self.__wake_read, self.__wake_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, 
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self.__thread = Thread(target=self.__serve)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __confirmed(self):
+        """
+        Returns the lowest offset confirmed by all durable subscribers.
+        Must hold the condition.
+        """
+        if not self.__durable:
+            return self.__next
+        return min(self.__durable.itervalues())
+
+    def __evict(self):
+        """
+        Drops the oldest payloads that every durable subscriber has
+        confirmed while more than history bytes are kept.  Must hold the
+        condition.
+        """
+        confirmed = self.__confirmed()
+        while self.__first < confirmed and self.__log_bytes > self.history:
+            index = self.__first - self.__base
+            payload = self.__log[index]
+            self.__log[index] = None
+            self.__log_bytes -= len(payload)
+            if self.__timed_out.get(payload) == self.__first:
+                del self.__timed_out[payload]
+            self.__first += 1
+        evicted = self.__first - self.__base
+        if evicted > len(self.__log) // 2:
+            del self.__log[:evicted]
+            self.__base = self.__first
+
+    def __wake(self):
+        """
+        Interrupts the thread's select.
+        """
+        try:
+            os.write(self.__wake_write, 'x')
+        except OSError, err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def __call__(self, data):
+        """
+        Session callback: publishes the payload to all subscribers and
+        waits for durable subscribers to confirm it.
+
+        :param data: The payload of the PublishMessage.
+        """
+        # Copy, the payload may be an mmap closed once this returns.
+        payload = data[:]
+        with self.__condition:
+            offset = self.__timed_out.pop(payload, None)
+            if offset is None:
+                if self.__confirmed() < self.__next and \
+                        self.__log_bytes + len(payload) > \
+                        self.history + self.max_unconfirmed:
+                    LOG.warn("Refusing payload, %d bytes are awaiting " \
+                        "confirmation." % self.__log_bytes)
+                    return False
+                offset = self.__next
+                self.__next += 1
+                self.__log.append(payload)
+                self.__log_bytes += len(payload)
+                self.__evict()
+                published = True
+            else:
+                published = False
+        if published:
+            self.__wake()
+
+        deadline = time.time() + self.confirm_timeout
+        with self.__condition:
+            while self.__confirmed() <= offset:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self.__closed:
+                    LOG.warn("Payload %d not confirmed by durable " \
+                        "subscribers." % offset)
+                    if offset >= self.__first:
+                        self.__timed_out[payload] = offset
+                    return False
+                self.__condition.wait(remaining)
+        return True
+
+    def forget(self, name):
+        """
+        Stops waiting for a durable subscriber that is not coming back.
+
+        :param name: The name of the subscriber.
+        """
+        with self.__condition:
+            self.__durable.pop(name, None)
+            self.__evict()
+            self.__condition.notify_all()
+
+    def subscriber_stats(self):
+        """
+        Returns a dict mapping the name of every connected subscriber to a
+        dict of its next offset, lag in payloads, and payloads skipped.
+        """
+        with self.__condition:
+            return dict((subscriber.name,
+                        {'offset' : subscriber.offset,
+                        'lag' : self.__next - subscriber.offset,
+                        'skipped' : subscriber.skipped})
+                        for subscriber in self.__subscribers.values()
+                        if subscriber.name is not None)
+
+    def __drop(self, subscriber):
+        """
+        Closes and forgets a subscriber's connection.  A durable subscriber
+        is still waited for.
+        """
+        self.__subscribers.pop(subscriber.socket.fileno(), None)
+        subscriber.socket.close()
+        LOG.info("Subscriber %s disconnected." % subscriber.name)
+
+    def __receive(self, subscriber):
+        """
+        Reads and handles the frames sent by a subscriber.  Returns False
+        if it disconnected.
+        """
+        try:
+            data = subscriber.socket.recv(4096)
+        except socket.error, err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            return False
+        if not data:
+            return False
+
+        buf = subscriber.inbound + data
+        while buf:
+            if ord(buf[0]) == CONFIRM_TYPE:
+                if len(buf) < CONFIRM.size:
+                    break
+                _, offset = CONFIRM.unpack_from(buf)
+                buf = buf[CONFIRM.size:]
+                if subscriber.durable:
+                    with self.__condition:
+                        if offset > self.__durable.get(subscriber.name, 0):
+                            self.__durable[subscriber.name] = \
+                                min(offset, self.__next)
+                            self.__evict()
+                            self.__condition.notify_all()
+            elif ord(buf[0]) == HELLO_TYPE:
+                if len(buf) < HELLO.size:
+                    break
+                _, flags, start, length = HELLO.unpack_from(buf)
+                if len(buf) < HELLO.size + length:
+                    break
+                subscriber.name = buf[HELLO.size:HELLO.size + length]
+                buf = buf[HELLO.size + length:]
+                self.__hello(subscriber, flags, start)
+            else:
+                LOG.error("Invalid frame from subscriber %s." \
+                    % subscriber.name)
+                return False
+        subscriber.inbound = buf
+        return True
+
+    def __hello(self, subscriber, flags, start):
+        """
+        Registers a subscriber and sets its starting offset.
+        """
+        with self.__condition:
+            subscriber.durable = bool(flags & DURABLE)
+            if subscriber.durable:
+                confirmed = self.__durable.get(subscriber.name)
+                if confirmed is None:
+                    confirmed = self.__next if start == LATEST else start
+                    self.__durable[subscriber.name] = confirmed
+                if start == LATEST:
+                    start = confirmed
+            elif start == LATEST:
+                start = self.__next
+            subscriber.offset = min(start, self.__next)
+        LOG.info("Subscriber %s connected at offset %d%s." %
+            (subscriber.name, subscriber.offset,
+            " (durable)" if subscriber.durable else ""))
+
+    def __next_frame(self, subscriber):
+        """
+        Returns the next frame to send to a subscriber, or None if it is up
+        to date.
+        """
+        with self.__condition:
+            if subscriber.offset >= self.__next:
+                return None
+            first = self.__first
+            if subscriber.offset < first:
+                # Fell behind what is kept, skip ahead.
+                skipped = first - subscriber.offset
+                subscriber.skipped += skipped
+                subscriber.offset = first
+                return FRAME_HEADER.pack(GAP, first, skipped)
+            offset = subscriber.offset
+            payload = self.__log[offset - self.__base]
+            subscriber.offset += 1
+        return FRAME_HEADER.pack(MESSAGE, offset, len(payload)) + payload
+
+    def __send(self, subscriber):
+        """
+        Sends as much as the subscriber's socket accepts.  Returns False if
+        it disconnected.
+        """
+        while True:
+            if subscriber.sent == len(subscriber.outbound):
+                frame = self.__next_frame(subscriber)
+                if frame is None:
+                    return True
+                subscriber.outbound = frame
+                subscriber.sent = 0
+            try:
+                subscriber.sent += subscriber.socket.send(
+                    buffer(subscriber.outbound, subscriber.sent))
+            except socket.error, err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                return False
+            if subscriber.sent < len(subscriber.outbound):
+                # Socket buffer full, wait for select.
+                return True
+
+    def __serve(self):
+        """
+        Accepts subscribers, reads their frames and writes payloads to them
+        until the broker is closed.
+        """
+        while not self.__closed:
+            subscribers = self.__subscribers.values()
+            with self.__condition:
+                writers = [subscriber.socket for subscriber in subscribers
+                            if subscriber.offset is not None and
+                            (subscriber.sent < len(subscriber.outbound) or
+                            subscriber.offset < self.__next)]
+            readers = [self.__listener, self.__wake_read] + \
+                [subscriber.socket for subscriber in subscribers]
+            try:
+                readable, writable, _ = select.select(readers, writers, [],
+                                                        1.0)
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for sock in readable:
+                if sock is self.__wake_read:
+                    try:
+                        os.read(self.__wake_read, 4096)
+                    except OSError, err:
+                        if err.errno != errno.EAGAIN:
+                            raise
+                elif sock is self.__listener:
+                    try:
+                        connection, _ = self.__listener.accept()
+                    except socket.error:
+                        continue
+                    connection.setblocking(0)
+                    self.__subscribers[connection.fileno()] = \
+                        _Subscriber(connection)
+                else:
+                    subscriber = self.__subscribers.get(sock.fileno())
+                    if subscriber is not None and \
+                            not self.__receive(subscriber):
+                        self.__drop(subscriber)
+
+            for sock in writable:
+                subscriber = self.__subscribers.get(sock.fileno())
+                if subscriber is not None and not self.__send(subscriber):
+                    self.__drop(subscriber)
+
+    def close(self):
+        """
+        Disconnects all subscribers and removes the socket.  Callbacks
+        waiting for confirmations return False.
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__wake()
+        self.__thread.join()
+        for subscriber in self.__subscribers.values():
+            self.__drop(subscriber)
+        self.__listener.close()
+        os.close(self.__wake_read)
+        os.close(self.__wake_write)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class FanoutSubscriber(object):
+    """
+    Receives the payloads republished by a :class:`FanoutBroker`.
+    """
+
+    def __init__(self, path, name='', durable=False, start=LATEST):
+        """
+        Connects to a broker.
+
+        :param path: Filesystem path of the broker's socket.
+        :param name: Name identifying the subscriber.  Durable subscribers
+            must use the same name when reconnecting.
+        :param durable: Whether the broker waits for this subscriber's
+            confirmations before acknowledging payloads to iDigi.
+        :param start: Offset of the first payload to receive.  LATEST
+            starts with the next payload published, or for a known durable
+            subscriber resumes after the last payload it confirmed.
+        """
+        self.name    = name
+        self.durable = durable
+        # Payloads dropped by the broker because this subscriber lagged.
+        self.skipped = 0
+        self.socket  = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.socket.sendall(HELLO.pack(HELLO_TYPE, DURABLE if durable else 0,
+                                        start, len(name)) + name)
+
+    def receive(self):
+        """
+        Blocks until the next payload arrives and returns a tuple of its
+        offset and data.  Raises EOFError if the broker went away.
+        """
+        while True:
+            frame_type, offset, length = FRAME_HEADER.unpack(
+                _recv_exactly(self.socket, FRAME_HEADER.size))
+            if frame_type == GAP:
+                LOG.warn("Skipped %d payloads before offset %d." %
+                    (length, offset))
+                self.skipped += length
+                continue
+            return offset, _recv_exactly(self.socket, length)
+
+    def __iter__(self):
+        """
+        Yields (offset, data) tuples until the broker goes away.
+        """
+        while True:
+            try:
+                yield self.receive()
+            except EOFError:
+                return
+
+    def confirm(self, offset):
+        """
+        Confirms that every payload up to and including offset has been
+        processed.
+
+        :param offset: Offset of the last payload processed.
+        """
+        self.socket.sendall(CONFIRM.pack(CONFIRM_TYPE, offset + 1))
+
+    def close(self):
+        """
+        Disconnects from the broker.
+        """
+        self.socket.close()
@@ -0,0 +1,101 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Payload Codecs
+
+Decodes the payloads of PublishMessages according to the format_type of
+their monitor.  JSON is decoded with the fastest backend installed, falling
+back to the standard library.  A codec given to a session is run by the
+callback worker, so the session's callback receives decoded documents.
+"""
+import logging
+
+LOG = logging.getLogger("idigi_monitor_api.codec")
+
+# JSON modules in order of preference.  Each must provide loads.
+JSON_BACKENDS = ('ujson', 'yajl', 'simplejson', 'json')
+
+def json_backend(name=None):
+    """
+    Returns a tuple of the name and loads function of a JSON backend.
+
+    :param name: The module to use, or None for the first of JSON_BACKENDS
+        that can be imported.  Raises ImportError if it is not installed.
+    """
+    if name is not None:
+        return name, __import__(name).loads
+    for candidate in JSON_BACKENDS:
+        try:
+            return candidate, __import__(candidate).loads
+        except ImportError:
+            continue
+    # Unreachable, json is always importable.
+    raise ImportError("No JSON backend.")
+
+def _xml_loads(data):
+    """
+    Parses an XML document and returns its root Element.
+    """
+    try:
+        from xml.etree import cElementTree as ElementTree
+    except ImportError:
+        from xml.etree import ElementTree
+    return ElementTree.fromstring(data)
+
+class PayloadCodec(object):
+    """
+    Decodes payloads of one format type.  Instances are callable with a
+    payload and return the decoded document: a dict for json, the root
+    Element for xml.
+    """
+
+    def __init__(self, format_type='json', backend=None):
+        """
+        Creates a PayloadCodec.
+
+        :param format_type: The format of the monitor ('json' or 'xml').
+        :param backend: For json, the name of the module to decode with,
+            None for the fastest installed.
+        """
+        if format_type == 'json':
+            self.backend, self.__loads = json_backend(backend)
+        elif format_type == 'xml':
+            self.backend, self.__loads = 'xml.etree', _xml_loads
+        else:
+            raise ValueError("Unsupported format type %s." % format_type)
+        self.format_type = format_type
+        LOG.debug("Decoding %s with %s." % (format_type, self.backend))
+
+    def __call__(self, payload):
+        """
+        Returns the decoded document.
+
+        :param payload: The payload of a PublishMessage, a string or an
+            mmap of a spilled payload.
+        """
+        if not isinstance(payload, str):
+            payload = payload[:]
+        return self.__loads(payload)
+
+    def messages(self, document):
+        """
+        Returns the list of Msgs of a decoded document, whether it holds a
+        single message or a batch.
+
+        :param document: A document returned by this codec.
+        """
+        if self.format_type == 'xml':
+            return document.findall('Msg')
+        msgs = document['Document']['Msg']
+        if isinstance(msgs, dict):
+            return [msgs]
+        return msgs
@@ -0,0 +1,456 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+FileData Sink
+
+Writes files pushed by a FileData monitor to a local directory tree using
+a pool of background writer threads.  A payload is only acknowledged once
+every file in it has been written and synced to disk.
+
+Also provides a demultiplexer appending data from many devices into per
+device, size rotated log files.
+"""
+import binascii
+import errno
+import json
+import logging
+import os
+import time
+
+from collections import OrderedDict
+from Queue import Queue, Empty
+from threading import Condition, Event, Lock, Thread
+
+LOG = logging.getLogger("idigi_monitor_api.filedata")
+
+def _fsync_directory(path):
+    """
+    Syncs a directory, making the entries created in it durable.
+
+    :param path: The directory to sync.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class _Completion(object):
+    """
+    Tracks the files of one payload until they are all durable.
+    """
+
+    def __init__(self, count):
+        """
+        :param count: Number of files that must complete.
+        """
+        self.pending   = count
+        self.failed    = 0
+        self.condition = Condition()
+
+    def done(self, success):
+        """
+        Marks one file as complete.
+
+        :param success: Whether the file was written and synced.
+        """
+        with self.condition:
+            self.pending -= 1
+            if not success:
+                self.failed += 1
+            if self.pending == 0:
+                self.condition.notify_all()
+
+    def wait(self):
+        """
+        Blocks until every file has completed.  Returns True if all of them
+        succeeded.
+        """
+        with self.condition:
+            while self.pending > 0:
+                self.condition.wait()
+            return self.failed == 0
+
+class FileDataSink(object):
+    """
+    A callable suitable as a session callback for a json formatted FileData
+    monitor.  Each file is written to
+    dest_root/<fdPath>/<year>/<month>/<day>/<fdName>, dated by its
+    fdLastModifiedDate.
+
+    Files are written and fsynced by a bounded pool of writer threads.  The
+    directories of written files are then synced in batches, once per
+    directory per batch, by a single syncer thread.  The callback returns
+    True only when all files of the payload are durable, so iDigi
+    redelivers anything that was not.  Of several files of a payload with
+    the same path, only the last is written.
+    """
+
+    def __init__(self, dest_root, writers=4, queue_size=256, fsync=True,
+                sync_interval=0.01, match=None):
+        """
+        Creates a FileDataSink and starts its writer threads.
+
+        :param dest_root: Root directory to write files under.
+        :param writers: Number of writer threads.
+        :param queue_size: Maximum number of files waiting to be written.
+            Callbacks block when the queue is full.
+        :param fsync: Whether to fsync files and directories.  If False, a
+            file is complete once written.
+        :param sync_interval: Seconds the syncer waits to gather more
+            written files into a batch.
+        :param match: An optional function called with each decoded
+            FileData Msg, only messages for which it returns True are
+            written.
+        """
+        self.dest_root     = dest_root
+        self.fsync         = fsync
+        self.sync_interval = sync_interval
+        self.match         = match
+        # Directories known to exist.
+        self.__directories = set()
+        self.__dir_lock    = Lock()
+        self.__write_queue = Queue(queue_size)
+        self.__sync_queue  = Queue()
+
+        for _ in range(writers):
+            writer = Thread(target=self.__write)
+            writer.daemon = True
+            writer.start()
+
+        if fsync:
+            syncer = Thread(target=self.__sync)
+            syncer.daemon = True
+            syncer.start()
+
+    def __ensure_directory(self, path):
+        """
+        Creates path if it has not been seen before.  With fsync, the
+        parent of each directory created is synced before returning, as
+        the syncer only syncs the directories files are written to.
+
+        :param path: The directory to create.
+        """
+        if path in self.__directories:
+            return
+        with self.__dir_lock:
+            if path in self.__directories:
+                return
+            created = []
+            missing = path
+            while missing and not os.path.isdir(missing):
+                created.append(missing)
+                missing = os.path.dirname(missing)
+            try:
+                os.makedirs(path)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+            if self.fsync:
+                for directory in created:
+                    _fsync_directory(os.path.dirname(directory) or os.curdir)
+            self.__directories.add(path)
+
+    def __write(self):
+        """
+        Continually takes files off the write queue, writes and fsyncs
+        them, and hands them to the syncer.
+        """
+        while True:
+            directory, filename, data, completion = self.__write_queue.get()
+            try:
+                self.__ensure_directory(directory)
+                fd = os.open(filename,
+                            os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+                try:
+                    view = buffer(data)
+                    while view:
+                        view = view[os.write(fd, view):]
+                    if self.fsync:
+                        os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except Exception, exception:
+                LOG.exception(exception)
+                completion.done(False)
+            else:
+                if self.fsync:
+                    self.__sync_queue.put((directory, completion))
+                else:
+                    completion.done(True)
+            self.__write_queue.task_done()
+
+    def __sync(self):
+        """
+        Continually gathers written files and syncs each of their
+        directories once per batch before marking them complete.
+        """
+        while True:
+            batch = [self.__sync_queue.get()]
+            deadline = time.time() + self.sync_interval
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.__sync_queue.get(timeout=remaining))
+                except Empty:
+                    break
+
+            failed = set()
+            for directory in set(directory for directory, _ in batch):
+                try:
+                    _fsync_directory(directory)
+                except Exception, exception:
+                    LOG.exception(exception)
+                    failed.add(directory)
+
+            for directory, completion in batch:
+                completion.done(directory not in failed)
+
+    def path_for(self, filedata):
+        """
+        Returns a tuple of (directory, filename) a FileData resource is
+        written to.
+
+        :param filedata: The decoded FileData of a Msg.
+        """
+        fileid = filedata['id']
+        # fdLastModifiedDate is ISO 8601 (i.e. 2012-06-12T03:18:45.381Z),
+        # the date part is read directly instead of parsing the timestamp.
+        modified = filedata['fdLastModifiedDate']
+        directory = os.path.join(self.dest_root, fileid['fdPath'][1:],
+                                '%d/%d/%d' % (int(modified[0:4]),
+                                                int(modified[5:7]),
+                                                int(modified[8:10])))
+        return directory, os.path.join(directory, fileid['fdName'])
+
+    def __call__(self, data):
+        """
+        Session callback: queues every file in the payload to the writers
+        and blocks until they are durable.  Returns True if all were
+        written successfully.
+
+        :param data: The payload of the PublishMessage, a string or an
+            mmap of a spilled payload.
+        """
+        if not isinstance(data, str):
+            data = data[:]
+        msgs = json.loads(data)['Document']['Msg']
+        if isinstance(msgs, dict):
+            msgs = [msgs]
+
+        # Written concurrently, files of the same path would interleave, 
+        # only the last is kept.
+        files = OrderedDict()
+        for msg in msgs:
+            filedata = msg.get('FileData')
+            if filedata is None or 'id' not in filedata or \
+                    'fdData' not in filedata:
+                continue
+            if self.match is not None and not self.match(msg):
+                continue
+            try:
+                directory, filename = self.path_for(filedata)
+            except (KeyError, ValueError), exception:
+                # Malformed resource, it would fail on redelivery too.
+                LOG.exception(exception)
+                continue
+            files.pop(filename, None)
+            files[filename] = (directory, filedata['fdData'])
+            LOG.debug("Received FileData %s", msg['topic'])
+
+        if not files:
+            return True
+
+        completion = _Completion(len(files))
+        for filename, (directory, encoded) in files.iteritems():
+            try:
+                content = binascii.a2b_base64(encoded)
+            except binascii.Error, exception:
+                LOG.exception(exception)
+                completion.done(False)
+                continue
+            self.__write_queue.put((directory, filename, content,
+                                    completion))
+        return completion.wait()
+
+class DeviceLogDemux(object):
+    """
+    Appends data received from many devices to one log file per device,
+    dest_root/<device_id>.log, rotating it to <device_id>.log.1 and so on
+    once it would exceed max_bytes.
+
+    Data is buffered per device and written with a single write once
+    buffer_size bytes are pending or the oldest pending data is
+    flush_interval seconds old.  At most max_open files are kept open, the
+    least recently written one is closed when another needs opening.
+    """
+
+    def __init__(self, dest_root, max_bytes=10485760, backups=5,
+                buffer_size=65536, flush_interval=1.0, max_open=256):
+        """
+        Creates a DeviceLogDemux.
+
+        :param dest_root: Directory the log files are written to.
+        :param max_bytes: Size at which a device's log file is rotated.
+        :param backups: Number of rotated files kept per device.
+        :param buffer_size: Bytes buffered per device before writing.
+        :param flush_interval: Seconds after which buffered data is
+            written regardless of size.  None disables the flush thread.
+        :param max_open: Maximum number of open log files.
+        """
+        self.dest_root      = dest_root
+        self.max_bytes      = max_bytes
+        self.backups        = backups
+        self.buffer_size    = buffer_size
+        self.flush_interval = flush_interval
+        self.max_open       = max_open
+        # device id -> [list of pending chunks, pending size, first time].
+        self.__buffers      = {}
+        # device id -> [fd, file size], least recently used first.
+        self.__files        = OrderedDict()
+        self.__lock         = Lock()
+        self.__closed       = Event()
+
+        if not os.path.isdir(dest_root):
+            os.makedirs(dest_root)
+
+        if flush_interval is not None:
+            flusher = Thread(target=self.__flush_expired)
+            flusher.daemon = True
+            flusher.start()
+
+    def path_for(self, device_id):
+        """
+        Returns the path of the current log file of a device.
+
+        :param device_id: The id of the device.
+        """
+        return os.path.join(self.dest_root, "%s.log" % device_id)
+
+    def __open(self, device_id):
+        """
+        Returns the [fd, size] entry of a device's log file, opening it
+        and closing the least recently used file if needed.
+
+        :param device_id: The id of the device.
+        """
+        entry = self.__files.pop(device_id, None)
+        if entry is None:
+            if len(self.__files) >= self.max_open:
+                _, (fd, _) = self.__files.popitem(last=False)
+                os.close(fd)
+            fd = os.open(self.path_for(device_id),
+                        os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0666)
+            entry = [fd, os.fstat(fd).st_size]
+        # Re-insert to mark as most recently used.
+        self.__files[device_id] = entry
+        return entry
+
+    def __rotate(self, device_id, entry):
+        """
+        Closes a device's log file and shifts it and its backups by one.
+
+        :param device_id: The id of the device.
+        :param entry: The open [fd, size] entry of the device.
+        """
+        os.close(entry[0])
+        del self.__files[device_id]
+        path = self.path_for(device_id)
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                source = "%s.%d" % (path, i)
+                if os.path.exists(source):
+                    os.rename(source, "%s.%d" % (path, i + 1))
+            os.rename(path, path + ".1")
+        else:
+            os.remove(path)
+
+    def __flush_device(self, device_id):
+        """
+        Writes a device's buffered data.  Must hold the lock.  If writing 
+        fails, the data not written stays buffered.
+
+        :param device_id: The id of the device.
+        """
+        pending = self.__buffers[device_id]
+        chunks, size, _ = pending
+        entry = self.__open(device_id)
+        if entry[1] > 0 and entry[1] + size > self.max_bytes:
+            self.__rotate(device_id, entry)
+            entry = self.__open(device_id)
+        data = "".join(chunks)
+        view = buffer(data)
+        try:
+            while view:
+                written = os.write(entry[0], view)
+                entry[1] += written
+                view = view[written:]
+        finally:
+            if view:
+                pending[0] = [str(view)]
+                pending[1] = len(view)
+            else:
+                del self.__buffers[device_id]
+
+    def write(self, device_id, data):
+        """
+        Buffers data for a device, writing it out if the device's buffer is
+        full.
+
+        :param device_id: The id of the device.
+        :param data: The data to append to the device's log.
+        """
+        with self.__lock:
+            pending = self.__buffers.get(device_id)
+            if pending is None:
+                pending = self.__buffers[device_id] = [[], 0, time.time()]
+            pending[0].append(data)
+            pending[1] += len(data)
+            if pending[1] >= self.buffer_size:
+                self.__flush_device(device_id)
+
+    def flush(self, max_age=0):
+        """
+        Writes out the buffered data of every device whose oldest pending
+        data is at least max_age seconds old.
+
+        :param max_age: Minimum age in seconds of buffers to write.
+        """
+        with self.__lock:
+            now = time.time()
+            for device_id, pending in self.__buffers.items():
+                if now - pending[2] >= max_age:
+                    try:
+                        self.__flush_device(device_id)
+                    except (IOError, OSError), exception:
+                        LOG.exception(exception)
+
+    def __flush_expired(self):
+        """
+        Periodically writes out buffers older than flush_interval.
+        """
+        while not self.__closed.is_set():
+            self.__closed.wait(self.flush_interval / 2.0)
+            self.flush(self.flush_interval)
+
+    def close(self):
+        """
+        Writes out all buffered data and closes all files.
+        """
+        self.__closed.set()
+        self.flush()
+        with self.__lock:
+            while self.__files:
+                _, (fd, _) = self.__files.popitem()
+                os.close(fd)
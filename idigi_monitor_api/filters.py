@@ -0,0 +1,285 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Message Filters
+
+Declarative filters evaluated against the raw payload of a PublishMessage
+before it is decoded, so that messages a session is not interested in are
+never turned into Python objects.
+"""
+import bisect
+import re
+
+# Skips over everything up to the next structural bracket, stepping over
+# complete JSON strings (including escapes) so brackets inside them are not
+# counted.  Used to find message boundaries without decoding the document.
+_JSON_BRACKET = re.compile(r'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*([{}\[\]])')
+# Locates the start of the Msg member of a JSON Document.
+_JSON_MSG = re.compile(r'"Msg"\s*:\s*([\[{])')
+# Locates the end of the Msg array of a JSON Document.
+_JSON_MSG_END = re.compile(r'\]\s*}\s*}\s*$')
+# Candidate boundary between two messages in the Msg array.
+_JSON_SEPARATOR = re.compile(r'}\s*,\s*{')
+# The topic key present exactly once in every message.
+_JSON_TOPIC = re.compile(r'"topic"\s*:')
+# A single Msg element of an XML Document.
+_XML_MSG = re.compile(r'<Msg\b.*?</Msg>', re.DOTALL)
+
+# Patterns used to locate a field value within a message for each format.
+# Each pattern is formatted with the field name and an alternation of
+# accepted values.
+_FIELD_PATTERNS = {
+    'json' : {
+        'prefix'    : r'"%s"\s*:\s*"(?:%s)',
+        'attribute' : r'"%s"\s*:\s*"(?:%s)"',
+        'element'   : r'"%s"\s*:\s*"(?:%s)"',
+        'capture'   : r'"%s"\s*:\s*"([^"]*)"',
+    },
+    'xml' : {
+        'prefix'    : r'\b%s="(?:%s)',
+        'attribute' : r'\b%s="(?:%s)"',
+        'element'   : r'<%s>(?:%s)</',
+        'capture'   : r'<%s>([^<]*)</',
+    },
+}
+
+def _alternation(values):
+    """
+    Returns a regular expression alternation matching any of values
+    literally.
+
+    :param values: iterable of strings to match.
+    """
+    return '|'.join(re.escape(value) for value in values)
+
+def _topic_alternation(topics):
+    """
+    Returns a regular expression alternation matching any of topics, in
+    which '*' matches any run of characters within the topic.
+
+    :param topics: iterable of topic prefixes.
+    """
+    return '|'.join(re.escape(topic).replace(r'\*', r'[^"<]*')
+                    for topic in topics)
+
+class MessageFilter(object):
+    """
+    A MessageFilter restricts the messages delivered to a session's
+    callback.  Criteria are combined with AND, the values within a
+    criterion with OR.  A criterion that is not given matches every
+    message.
+
+    Matching is done with a byte level scan of the raw payload: the whole
+    payload is rejected outright if any criterion cannot match anywhere in
+    it, otherwise each message of a batched document is sliced out and
+    tested individually.  Only accepted messages are passed on, in a
+    document with the same envelope as the original.
+    """
+
+    def __init__(self, topics=None, operations=None, device_ids=None,
+                channels=None, format_type='json'):
+        """
+        Creates a MessageFilter.
+
+        :param topics: a list of topic prefixes (i.e. ['DeviceCore',
+            'FileData/~/00000000-00000000-00409DFF-FF49B68F']).  The
+            account id which iDigi prepends to the topic is ignored.  A '*'
+            matches any part of a topic, i.e. the device id in
+            'FileData/*/trace.log.gz'.
+        :param operations: a list of operations (i.e. ['INSERT', 'UPDATE']).
+        :param device_ids: a list of devConnectwareId values.
+        :param channels: a list of Dia channel names in the form
+            instance.channel (i.e. ['xbee.temperature']).
+        :param format_type: The format of the monitor ('json' or 'xml').
+        """
+        if format_type not in _FIELD_PATTERNS:
+            raise ValueError("Unsupported format type %s." % format_type)
+
+        self.format_type = format_type
+        self.topics      = topics
+        self.operations  = operations
+        self.device_ids  = device_ids
+        self.channels    = None
+
+        patterns = _FIELD_PATTERNS[format_type]
+        # Regular expressions which must all match a message for it to be
+        # accepted.
+        self.__matchers = []
+
+        if topics:
+            self.__matchers.append(re.compile(patterns['prefix'] %
+                ('topic', r'(?:\d+/)?(?:%s)' % _topic_alternation(topics))))
+        if operations:
+            self.__matchers.append(re.compile(patterns['attribute'] %
+                ('operation', _alternation(operations))))
+        if device_ids:
+            # iDigi reports device ids in upper case.
+            self.__matchers.append(re.compile(patterns['element'] %
+                ('devConnectwareId', 
+                    _alternation(device.upper() for device in device_ids))))
+
+        self.__instance = None
+        self.__channel = None
+        if channels:
+            self.channels = set(channels)
+            pairs = [channel.split('.', 1) for channel in channels]
+            # Cheap pre-checks on each half of the channel name, the exact
+            # pairing is verified by capturing both values.
+            self.__matchers.append(re.compile(patterns['element'] %
+                ('ddInstanceName', _alternation(set(p[0] for p in pairs)))))
+            self.__matchers.append(re.compile(patterns['element'] %
+                ('dcChannelName',
+                    _alternation(set(p[-1] for p in pairs)))))
+            self.__instance = re.compile(patterns['capture'] %
+                'ddInstanceName')
+            self.__channel = re.compile(patterns['capture'] %
+                'dcChannelName')
+
+    def match(self, message):
+        """
+        Returns True if the raw message matches all criteria of this filter.
+
+        :param message: the raw text of a single message.
+        """
+        for matcher in self.__matchers:
+            if matcher.search(message) is None:
+                return False
+        return self.__match_channel(message)
+
+    def __match_channel(self, message):
+        """
+        Returns True if the instance and channel names captured from the 
+        raw message form one of the channels of this filter.
+
+        :param message: the raw text of a single message.
+        """
+        if self.channels is None:
+            return True
+        instance = self.__instance.search(message)
+        channel = self.__channel.search(message)
+        return instance is not None and channel is not None and \
+            "%s.%s" % (instance.group(1), channel.group(1)) in self.channels
+
+    def __split_json(self, payload):
+        """
+        Returns a list of (start, end) offsets of each message in the Msg 
+        array of payload.  Returns None if the document is not a batched 
+        one.
+
+        :param payload: raw JSON document.
+        """
+        msg = _JSON_MSG.search(payload)
+        if msg is None or msg.group(1) != '[':
+            return None
+
+        start = msg.end()
+
+        # Fast path: every message carries exactly one topic key, so if the
+        # number of candidate separators is one less than the number of
+        # topics, the separators are the message boundaries.  Otherwise
+        # (i.e. a string value contains '},{') fall back to a bracket scan.
+        end = _JSON_MSG_END.search(payload, start)
+        if end is not None:
+            end = end.start()
+            separators = [separator.span() for separator in
+                            _JSON_SEPARATOR.finditer(payload, start, end)]
+            if len(separators) + 1 == \
+                    len(_JSON_TOPIC.findall(payload, start, end)):
+                # find rather than index, as payload may be an mmap.
+                begins = [payload.find('{', start)] + \
+                    [separator_end - 1 for _, separator_end in separators]
+                ends = [separator_start + 1 
+                        for separator_start, _ in separators] + \
+                    [payload.rfind('}', start, end) + 1]
+                return zip(begins, ends)
+
+        spans = []
+        depth = 0
+        message_start = start
+        for token in _JSON_BRACKET.finditer(payload, start):
+            char = token.group(1)
+            if char == '{' or char == '[':
+                if depth == 0:
+                    message_start = token.start(1)
+                depth += 1
+            else:
+                if depth == 0:
+                    # End of the Msg array.
+                    return spans
+                depth -= 1
+                if depth == 0:
+                    spans.append((message_start, token.end()))
+        return None
+
+    def __split_xml(self, payload):
+        """
+        Returns a list of (start, end) offsets of each Msg element of an XML
+        document.  Returns None if there are no Msg elements.
+
+        :param payload: raw XML document.
+        """
+        spans = [message.span() for message in _XML_MSG.finditer(payload)]
+        return spans or None
+
+    def apply(self, payload):
+        """
+        Filters a raw payload.  Returns the payload unchanged if every
+        message matches, a payload containing only the matching messages
+        if some do, or None if no message matches.
+
+        :param payload: The payload of the PublishMessage, a string or a 
+            read only mmap of a spilled payload.
+        """
+        if not self.__matchers:
+            return payload
+
+        # Whole payload pre-check: if a criterion matches nowhere in the
+        # document, no message in it can match.
+        for matcher in self.__matchers:
+            if matcher.search(payload) is None:
+                return None
+
+        if self.format_type == 'json':
+            spans = self.__split_json(payload)
+            separator = ','
+        else:
+            spans = self.__split_xml(payload)
+            separator = ''
+
+        if spans is None or len(spans) == 1:
+            # A single message document.
+            return payload if self.__match_channel(payload) else None
+
+        # Rather than searching each message, search the document once per
+        # criterion and map the hits back to the messages containing them.
+        begins = [begin for begin, _ in spans]
+        candidates = None
+        for matcher in self.__matchers:
+            hits = set(bisect.bisect_right(begins, hit.start()) - 1 
+                        for hit in matcher.finditer(payload, begins[0], 
+                                                    spans[-1][1]))
+            candidates = hits if candidates is None else candidates & hits
+            if not candidates:
+                return None
+
+        accepted = []
+        for index in sorted(candidates):
+            message = payload[spans[index][0]:spans[index][1]]
+            if self.__match_channel(message):
+                accepted.append(message)
+
+        if not accepted:
+            return None
+        if len(accepted) == len(spans):
+            return payload
+        return payload[:begins[0]] + separator.join(accepted) + \
+            payload[spans[-1][1]:]
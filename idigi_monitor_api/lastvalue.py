@@ -0,0 +1,421 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Last Value Cache
+
+Retains the latest value pushed by iDigi for each device (the DeviceCore
+connection status) and each Dia channel of a device (the DiaChannelDataFull
+value), so that they can be looked up without querying web services.
+
+The cache can be persisted to a memory-mapped file that is updated as
+values arrive, from which a restarted process warm-starts.
+"""
+import gc
+import logging
+import os
+import struct
+
+from itertools import izip
+from threading import Lock
+
+from .batching import parse_timestamp
+from .codec import PayloadCodec
+
+LOG = logging.getLogger("idigi_monitor_api.lastvalue")
+
+# File header: magic, format version and the value_size of its records.
+MAGIC = 'IDLV'
+VERSION = 1
+HEADER = struct.Struct('<4sHH')
+
+# Record header: timestamp in seconds since the epoch and the length of the
+# JSON encoded value that follows it, UNPERSISTED if it did not fit.
+RECORD = struct.Struct('<dH')
+UNPERSISTED = 0xFFFF
+
+# Number of records the file is first sized for.
+INITIAL_CAPACITY = 1024
+
+# Number of values added to a snapshot at a time.
+SNAPSHOT_CHUNK = 4096
+
+def _key(name):
+    """
+    Returns a device id or channel name as a str, the type keys are
+    interned as.
+    """
+    if isinstance(name, unicode):
+        return name.encode('utf-8')
+    return name
+
+class LastValueCache(object):
+    """
+    A callable suitable as a session callback for a json formatted
+    DeviceCore and/or DiaChannelDataFull monitor, keeping the latest value
+    of each device and channel:
+
+        cache = LastValueCache('/var/lib/dashboard/lastvalues')
+        client.create_session(cache, monitor_id)
+        cache.get('00000000-00000000-00409DFF-FF000001')
+        cache.get('00000000-00000000-00409DFF-FF000001', 'sensor.temperature')
+
+    A device's own value, its dpConnectionStatus, is kept under the None
+    channel and channel values under 'ddInstanceName.dcChannelName'.  Each
+    value is kept with the time it was reported, and only replaced by a
+    value reported at the same time or later.
+
+    Lookups are a pair of dict accesses.  Device ids and channel names are
+    interned, so each is held once however many values refer to it.
+    Records are immutable tuples replaced whole, so :meth:`items` and
+    :meth:`snapshot` never take the lock updates are made under.
+    """
+
+    def __init__(self, path=None, callback=None, value_size=128):
+        """
+        Creates a LastValueCache, loading the values persisted at path if
+        it exists.
+
+        :param path: File to persist values to, None to keep them in memory
+            only.  The keys are kept in path.keys.
+        :param callback: Optional session callback the payloads are then
+            passed to, its result is returned.
+        :param value_size: Bytes reserved in the file for the JSON encoding
+            of each value, less than UNPERSISTED.  Longer values are kept 
+            in memory but not persisted.
+        """
+        if not 0 <= value_size < UNPERSISTED:
+            # The length of a value is stored in 16 bits, UNPERSISTED 
+            # marking those that did not fit.
+            raise ValueError("value_size must be less than %d." % UNPERSISTED)
+        self.path          = path
+        self.callback      = callback
+        self.value_size    = value_size
+        # Interned device id and channel name of each record, and the
+        # (timestamp, value) record itself, by slot.
+        self.__keys        = []
+        self.__records     = []
+        # Slot of each record, by device and then channel.
+        self.__devices     = {}
+        # Number of slots loaded without a value.
+        self.__missing     = 0
+        self.__codec       = PayloadCodec('json')
+        self.__lock        = Lock()
+        # Persistence: the keys file, the mapped values file and the number
+        # of records it has room for.
+        self.__key_file    = None
+        self.__file        = None
+        self.__map         = None
+        self.__capacity    = 0
+        self.__unpersisted = 0
+        self.__encode      = None
+        if path is not None:
+            # Loading allocates a few objects per value and none are
+            # garbage, so collecting meanwhile only costs time.
+            collecting = gc.isenabled()
+            gc.disable()
+            try:
+                self.__open()
+            finally:
+                if collecting:
+                    gc.enable()
+
+    def __len__(self):
+        return len(self.__records)
+
+    def __record_size(self):
+        """
+        Returns the size in bytes of a record in the values file.
+        """
+        return RECORD.size + self.value_size
+
+    def __open(self):
+        """
+        Loads the persisted values, then opens the files for updating.
+        """
+        import json
+        import mmap
+        self.__encode = json.dumps
+        key_path = self.path + '.keys'
+        keys = []
+        if os.path.exists(key_path):
+            with open(key_path, 'rb') as key_file:
+                content = key_file.read()
+            # A line cut short by a crash is dropped.
+            complete = content.rfind('\n') + 1
+            keys = [line.split('\t') for line in
+                    content[:complete].splitlines()]
+            if complete < len(content):
+                with open(key_path, 'r+b') as key_file:
+                    key_file.truncate(complete)
+
+        if os.path.exists(self.path) and \
+                os.path.getsize(self.path) >= HEADER.size:
+            self.__file = open(self.path, 'r+b')
+            self.__map = mmap.mmap(self.__file.fileno(), 0)
+            magic, version, value_size = HEADER.unpack_from(self.__map, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("%s is not a last value file." % self.path)
+            self.value_size = value_size
+            self.__capacity = (len(self.__map) - HEADER.size) / \
+                self.__record_size()
+        else:
+            self.__file = open(self.path, 'w+b')
+            self.__grow(INITIAL_CAPACITY)
+            HEADER.pack_into(self.__map, 0, MAGIC, VERSION, self.value_size)
+
+        # Slots of the persisted values, their timestamps and encodings.
+        slots = []
+        timestamps = []
+        encoded = []
+        record_size = self.__record_size()
+        for slot in xrange(min(len(keys), self.__capacity)):
+            offset = HEADER.size + slot * record_size
+            timestamp, length = RECORD.unpack_from(self.__map, offset)
+            if 0 < length <= self.value_size:
+                offset += RECORD.size
+                slots.append(slot)
+                timestamps.append(timestamp)
+                encoded.append(self.__map[offset:offset + length])
+        try:
+            # Decoding them all at once is several times faster.
+            values = json.loads('[%s]' % ','.join(encoded))
+        except ValueError:
+            values = []
+            for index, value in enumerate(encoded):
+                try:
+                    values.append(json.loads(value))
+                except ValueError:
+                    # Written partially before a crash.
+                    values.append(None)
+                    slots[index] = None
+
+        records = [None] * len(keys)
+        for slot, timestamp, value in izip(slots, timestamps, values):
+            if slot is not None:
+                records[slot] = (timestamp, value)
+        for (device, channel), record in izip(keys, records):
+            # Slots without a value are kept so those after them keep theirs.
+            self.__add(intern(device), intern(channel) if channel else None,
+                        record)
+        self.__missing = records.count(None)
+        if keys:
+            LOG.info("Loaded %d values from %s, %d not persisted." % \
+                (len(keys) - self.__missing, self.path, self.__missing))
+        self.__key_file = open(key_path, 'ab')
+
+    def __grow(self, capacity):
+        """
+        Resizes the values file to hold capacity records and maps it again.
+        Must hold the lock.
+        """
+        if self.__map is not None:
+            self.__map.close()
+        import mmap
+        self.__file.truncate(HEADER.size + capacity * self.__record_size())
+        self.__map = mmap.mmap(self.__file.fileno(), 0)
+        self.__capacity = capacity
+
+    def __add(self, device, channel, record):
+        """
+        Adds a record for a new key and returns its slot.  Must hold the
+        lock, or be loading.
+        """
+        slot = len(self.__keys)
+        self.__keys.append((device, channel))
+        self.__records.append(record)
+        self.__devices.setdefault(device, {})[channel] = slot
+        return slot
+
+    def __persist(self, slot, record):
+        """
+        Writes a record to its slot of the values file.  Must hold the lock.
+        """
+        if slot >= self.__capacity:
+            self.__grow(max(slot + 1, self.__capacity * 2))
+        encoded = self.__encode(record[1])
+        offset = HEADER.size + slot * self.__record_size()
+        if len(encoded) > self.value_size:
+            self.__unpersisted += 1
+            RECORD.pack_into(self.__map, offset, record[0], UNPERSISTED)
+            return
+        # The value first, so that the header never describes bytes not 
+        # yet written.
+        self.__map[offset + RECORD.size:offset + RECORD.size +
+                    len(encoded)] = encoded
+        RECORD.pack_into(self.__map, offset, record[0], len(encoded))
+
+    def put(self, device, channel, timestamp, value):
+        """
+        Records the value of a device's channel reported at timestamp,
+        unless a value reported later is already recorded.  Returns True if
+        the value was recorded.
+
+        :param device: The devConnectwareId of the device.
+        :param channel: 'ddInstanceName.dcChannelName', or None for the
+            device's own value.
+        :param timestamp: Seconds since the epoch the value was reported at.
+        :param value: The value, any JSON serializable object.
+        """
+        device = _key(device)
+        channel = _key(channel)
+        record = (timestamp, value)
+        with self.__lock:
+            channels = self.__devices.get(device)
+            slot = None if channels is None else channels.get(channel)
+            if slot is None:
+                device = intern(device)
+                if channel is not None:
+                    channel = intern(channel)
+                slot = self.__add(device, channel, record)
+                if self.__key_file is not None:
+                    self.__key_file.write('%s\t%s\n' % (device,
+                                                        channel or ''))
+                    self.__key_file.flush()
+            else:
+                current = self.__records[slot]
+                if current is None:
+                    self.__missing -= 1
+                elif current[0] > timestamp:
+                    return False
+                self.__records[slot] = record
+            if self.__map is not None:
+                self.__persist(slot, record)
+        return True
+
+    def update(self, msg):
+        """
+        Records the value carried by a decoded DeviceCore or
+        DiaChannelDataFull Msg.  Returns True if a value was recorded.
+
+        :param msg: A decoded Msg.
+        """
+        if msg.get('operation') == 'DELETE':
+            return False
+        data = msg.get('DiaChannelDataFull')
+        if data is not None:
+            channel_id = data['id']
+            timestamp = data.get('dcdUpdateTime') or msg['timestamp']
+            return self.put(channel_id['devConnectwareId'],
+                            "%s.%s" % (channel_id['ddInstanceName'],
+                                        channel_id['dcChannelName']),
+                            parse_timestamp(timestamp),
+                            data.get('dcdStringValue'))
+        data = msg.get('DeviceCore')
+        if data is not None:
+            return self.put(data['devConnectwareId'], None,
+                            parse_timestamp(msg['timestamp']),
+                            data.get('dpConnectionStatus'))
+        return False
+
+    def __call__(self, data):
+        """
+        Session callback: records the values in a payload, or in a document
+        already decoded by the session's codec.
+
+        :param data: The payload of the PublishMessage.
+        """
+        document = data if isinstance(data, dict) else self.__codec(data)
+        for msg in self.__codec.messages(document):
+            self.update(msg)
+        if self.callback is not None:
+            return self.callback(data)
+        return True
+
+    def get(self, device, channel=None):
+        """
+        Returns the (timestamp, value) of a device's channel, or None if no
+        value is known.
+
+        :param device: The devConnectwareId of the device.
+        :param channel: 'ddInstanceName.dcChannelName', or None for the
+            device's own value.
+        """
+        channels = self.__devices.get(_key(device))
+        if channels is None:
+            return None
+        slot = channels.get(_key(channel))
+        if slot is None:
+            return None
+        return self.__records[slot]
+
+    def channels(self, device):
+        """
+        Returns a dict mapping each channel of a device with a known value,
+        None for the device's own value, to its (timestamp, value).
+
+        :param device: The devConnectwareId of the device.
+        """
+        records = self.__records
+        return dict((channel, records[slot]) for channel, slot
+                    in self.__devices.get(_key(device), {}).items()
+                    if records[slot] is not None)
+
+    def items(self):
+        """
+        Returns a generator of (device, channel, timestamp, value) tuples,
+        one per known value.  Values updated while iterating are seen either
+        before or after the update.
+        """
+        keys = self.__keys
+        records = self.__records
+        for slot in xrange(len(records)):
+            record = records[slot]
+            if record is not None:
+                device, channel = keys[slot]
+                yield device, channel, record[0], record[1]
+
+    def snapshot(self):
+        """
+        Returns a dict mapping each (device, channel) with a known value to
+        its (timestamp, value), as of a single point in time.
+        """
+        # Copying a list is atomic, and a key is added before its record.
+        records = list(self.__records)
+        keys = self.__keys[:len(records)]
+        # The dict is built in chunks from the copies, so that updates can
+        # proceed in between rather than wait for the GIL.
+        snapshot = {}
+        for start in xrange(0, len(records), SNAPSHOT_CHUNK):
+            snapshot.update(izip(keys[start:start + SNAPSHOT_CHUNK],
+                                records[start:start + SNAPSHOT_CHUNK]))
+        if self.__missing:
+            for key in [key for key, record in snapshot.iteritems()
+                        if record is None]:
+                del snapshot[key]
+        return snapshot
+
+    def sync(self):
+        """
+        Flushes the values file to disk.  Values are in the file as soon as
+        they are recorded, so this only matters if the machine, rather than
+        the process, may stop.
+        """
+        with self.__lock:
+            if self.__map is not None:
+                self.__map.flush()
+
+    def close(self):
+        """
+        Flushes and closes the files, the cache is then in memory only.
+        """
+        with self.__lock:
+            if self.__map is None:
+                return
+            if self.__unpersisted:
+                LOG.warn("%d values were longer than value_size (%d) and " \
+                    "were not persisted." % (self.__unpersisted,
+                    self.value_size))
+            self.__map.flush()
+            self.__map.close()
+            self.__file.close()
+            self.__key_file.close()
+            self.__map = self.__file = self.__key_file = None
@@ -17,30 +17,25 @@ iDigi.
 """
 import base64
 import errno
-import httplib
-import json
 import logging
+import math
 import os
 import socket
 import select
-import ssl
 import struct
 import time
-import urllib
-import zlib
 
-from xml.dom.minidom import getDOMImplementation
-from Queue import Queue, Empty
-from threading import Thread
+from collections import deque
+from Queue import Empty
+from threading import Condition, Event, Lock, Thread
+
+from .resolver import RESOLVER
 
 LOG = logging.getLogger("idigi_monitor_api")
 
 # Resolve modules local directory and get reference to default iDigi Cert.
 IDIGI_CRT = os.path.join(os.path.dirname(__file__), "idigi.crt")
 
-# Dom Implementation to work with
-DOM = getDOMImplementation()
-
 # Push Opcodes.
 CONNECTION_REQUEST = 0x01
 CONNECTION_RESPONSE = 0x02
@@ -61,6 +56,61 @@ STATUS_BAD_REQUEST = 400
 PUSH_OPEN_PORT = 3200
 PUSH_SECURE_PORT = 3201
 
+# Number of full batches a session in batch mode may have waiting for 
+# callback workers before the IO thread blocks.
+MAX_PENDING_BATCHES = 4
+
+# Priority lanes of sessions.  Lower values are served first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+# Default relative share of callback workers and writes given to each lane 
+# while all of them have work pending, indexed by priority.
+LANE_WEIGHTS = (4, 1)
+
+# Number of recent delivery latencies kept per lane for percentiles.
+LATENCY_SAMPLES = 1024
+
+# Offset of the payload in the body of a PublishMessage.
+PAYLOAD_OFFSET = 10
+
+# Bytes read from a socket, or from a spill file, at a time when a message 
+# body is spilled to disk.
+SPILL_CHUNK = 65536
+
+# Every how many uncompressed payloads one is sampled to estimate the 
+# effect of compressing them, and the bytes kept of its start.
+SAMPLE_INTERVAL = 16
+SAMPLE_SIZE = 65536
+
+# Default maximum number of messages of a session received but not yet
+# acknowledged or rejected.  Reading from the session's socket pauses while
+# the window is full.
+MAX_IN_FLIGHT = 1024
+
+# Smoothed utilization of the shared callback workers at or above which an 
+# autoscaling pool grows, and the utilization it sizes them for.  It only 
+# shrinks once SHRINK_AFTER consecutive evaluations found it oversized.
+GROW_UTILIZATION = 0.8
+TARGET_UTILIZATION = 0.6
+SHRINK_AFTER = 5
+
+# Environment variable a successor process finds handed off sessions in.
+HANDOFF_ENV = 'IDIGI_PUSH_HANDOFF'
+
+# Default seconds stopping waits for the callbacks of messages already read
+# and for their acknowledgements to be sent before closing the sessions.
+STOP_TIMEOUT = 10.0
+
+# Seconds before starting again a session that could not be restarted, 
+# doubled after each further failure up to MAX_RESTART_DELAY.
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+
+# Queued on the write queue to make the writer thread write what remains 
+# queued and exit.
+WRITER_STOP = (None, None)
+
 def push_client(username, password, **kwargs):
     """
     Constructs and returns a :class:`PushClient` instance.  Which can be 
@@ -74,9 +124,36 @@ def push_client(username, password, **kwargs):
     :param ca_certs: Path to a file containing Certificates.  If not provided, 
         the idigi.crt file provided with the module will be used.  In most 
         cases, the idigi.crt file should be acceptable.
+    :param reactor: A :class:`PushReactor` shared with other clients.
+    :param failover_hostnames: iDigi servers to connect to when hostname 
+        cannot be connected to.
     """
     return PushClient(username, password, **kwargs)
 
+def handoff_state(state=None):
+    """
+    Returns the list of sessions handed off by a predecessor process, as 
+    produced by :meth:`PushClient.hand_off`.  Each entry is a dict with a 
+    monitor_id key that can be passed to :meth:`PushClient.resume_session`, 
+    and the username of the client the session belonged to.
+
+    :param state: The state string returned by hand_off.  If not provided, 
+        it is read from the HANDOFF_ENV environment variable, which is then 
+        removed so it is not passed on to further processes.
+    """
+    if state is None:
+        state = os.environ.pop(HANDOFF_ENV, None)
+        if state is None:
+            return []
+    import json
+    return json.loads(state)
+
+def _remaining(deadline):
+    """
+    Returns the seconds left until deadline, None if deadline is None.
+    """
+    return None if deadline is None else max(0, deadline - time.time())
+
 def _read_msg_header(session):
     """
     Perform a read on input socket to consume headers and then return 
@@ -96,7 +173,7 @@ def _read_msg_header(session):
         if len(session.data) < 6:
             return INCOMPLETE
 
-    except ssl.SSLError:
+    except session.retry_errors:
         # This can happen when select gets triggered 
         # for an SSL socket and data has not yet been 
         # read.
@@ -114,25 +191,176 @@ def _read_msg(session):
     Perform a read on input socket to consume message and then return the
     payload and block_id in a tuple.
 
+    If the session has a spill file, only the fields preceding the payload 
+    are kept in session.data and the payload is appended to the file.
+
     :param session: Push Session to read data for.
     """
-    if len(session.data) == session.message_length:
+    received = len(session.data) + session.spilled
+    if received == session.message_length:
         # Data Already completely read.  Return
         return True
 
     try:
-        data = session.socket.recv(session.message_length - len(session.data))
+        if session.spill is None:
+            data = session.socket.recv(session.message_length - received)
+        elif len(session.data) < PAYLOAD_OFFSET:
+            data = session.socket.recv(PAYLOAD_OFFSET - len(session.data))
+        else:
+            data = session.socket.recv(min(SPILL_CHUNK, 
+                                        session.message_length - received))
+            if len(data) == 0:
+                raise PushException("No Data on Socket!")
+            session.spill.write(data)
+            session.spilled += len(data)
+            return session.spilled + PAYLOAD_OFFSET == session.message_length
         if len(data) == 0:
             raise PushException("No Data on Socket!")
         session.data += data  
-    except ssl.SSLError:
+    except session.retry_errors:
         # This can happen when select gets triggered 
         # for an SSL socket and data has not yet been 
         # read.  Wait for it to get triggered again.
         return False
 
     # Whether or not all data was read.
-    return  len(session.data) == session.message_length
+    return  len(session.data) + session.spilled == session.message_length
+
+def _map(spill):
+    """
+    Returns a read only mmap of the contents of a spill file and closes the 
+    file, or an empty string if it is empty.
+
+    :param spill: The spill file.
+    """
+    import mmap
+
+    try:
+        spill.flush()
+        if spill.tell() == 0:
+            return ''
+        return mmap.mmap(spill.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        # The mmap holds its own descriptor.
+        spill.close()
+
+def _spill_chunks(spill):
+    """
+    Returns an iterator over the contents of a spill file in SPILL_CHUNK 
+    sized strings, closing the file once exhausted.
+
+    :param spill: The spill file.
+    """
+    spill.seek(0)
+    try:
+        for chunk in iter(lambda: spill.read(SPILL_CHUNK), ''):
+            yield chunk
+    finally:
+        spill.close()
+
+def _inflate(chunks, threshold, spill_dir=None):
+    """
+    Decompresses a zlib stream.  Returns the data as a string if it is no 
+    larger than threshold bytes, otherwise it is written to a temporary 
+    file as it is inflated and an mmap of that file is returned.
+
+    :param chunks: iterable of strings making up the compressed stream.
+    :param threshold: Largest inflated size returned as a string, None to 
+        always return a string.
+    :param spill_dir: Directory of the temporary file, None for the 
+        system default.
+    """
+    import zlib
+
+    inflater = zlib.decompressobj()
+    output = []
+    size = 0
+    spill = None
+    for chunk in chunks:
+        while chunk:
+            # Bound the output of each step so a highly compressed chunk 
+            # cannot expand in memory.
+            data = inflater.decompress(chunk, threshold or 0)
+            chunk = inflater.unconsumed_tail
+            if spill is None and threshold is not None and \
+                    size + len(data) > threshold:
+                import tempfile
+                spill = tempfile.TemporaryFile(dir=spill_dir)
+                spill.write(''.join(output))
+                output = None
+            if spill is None:
+                output.append(data)
+                size += len(data)
+            else:
+                spill.write(data)
+
+    data = inflater.flush()
+    if spill is None and (threshold is None or 
+                            size + len(data) <= threshold):
+        output.append(data)
+        return ''.join(output)
+    if spill is None:
+        import tempfile
+        spill = tempfile.TemporaryFile(dir=spill_dir)
+        spill.write(''.join(output))
+    spill.write(data)
+    return _map(spill)
+
+def _set_keepalive(sock, keepalive):
+    """
+    Enables TCP keepalive on a socket, so that a peer which silently went 
+    away is detected by the kernel.
+
+    :param sock: The socket, before it is connected.
+    :param keepalive: Tuple of seconds idle before the first probe, seconds 
+        between probes and number of unanswered probes before the 
+        connection is reset, or None to leave keepalive off.  Options the 
+        platform does not support are skipped.
+    """
+    if keepalive is None:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in zip(('TCP_KEEPIDLE', 'TCP_KEEPINTVL', 'TCP_KEEPCNT'),
+                            keepalive):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), 
+                            value)
+
+def _wakeup_pipe():
+    """
+    Returns the read and write ends of a pipe used to wake a thread blocked 
+    in poll.  Both are non-blocking and not inherited by processes exec'd, 
+    i.e. the successor of a hand off.
+    """
+    import fcntl
+
+    ends = os.pipe()
+    for fd in ends:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return ends
+
+def _escape(value):
+    """
+    Returns value escaped for use as XML character data.
+
+    :param value: The string to escape.
+    """
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def _monitor_request(attrs):
+    """
+    Returns the XML of a Monitor request with an element for each item 
+    of attrs.
+
+    :param attrs: dict mapping Monitor tags (i.e. monBatchSize) to their 
+        string values.
+    """
+    return '<Monitor>%s</Monitor>' % ''.join(
+        '<%s>%s</%s>' % (tag, _escape(value), tag) 
+        for tag, value in attrs.items())
 
 class PushException(Exception):
     """
@@ -140,32 +368,468 @@ class PushException(Exception):
     """
     pass
 
+class SessionStats(object):
+    """
+    Counters describing the traffic received on a PushSession.  Updated by 
+    the IO thread and callback workers, read by anything tuning the 
+    session's monitor.
+    """
+
+    __slots__ = ('__lock', 'payloads', 'messages', 'payload_bytes', 
+                'compressed', 'wire_bytes', 'inflated_bytes', 'inflate_time',
+                'callbacks', 'callback_time', 'sampling', 'sample')
+
+    def __init__(self):
+        self.__lock        = Lock()
+        # Number of PublishMessages received.
+        self.payloads      = 0
+        # Number of Msgs aggregated in those PublishMessages.
+        self.messages      = 0
+        # Bytes of payload after decompression.
+        self.payload_bytes = 0
+        # Number of compressed PublishMessages, their size on the wire and 
+        # after decompression, and the seconds spent decompressing them.
+        self.compressed    = 0
+        self.wire_bytes    = 0
+        self.inflated_bytes = 0
+        self.inflate_time  = 0.0
+        # Number of callbacks invoked and the total seconds spent in them.
+        self.callbacks     = 0
+        self.callback_time = 0.0
+        # Whether a compression controller evaluates the session, and the 
+        # start of a recent uncompressed payload kept for it to estimate 
+        # what compressing would save and cost.
+        self.sampling      = False
+        self.sample        = None
+
+    def record_payload(self, messages, payload_bytes, wire_bytes=None, 
+                        inflate_time=None):
+        """
+        Records a received PublishMessage.
+
+        :param messages: Number of Msgs aggregated in the message.
+        :param payload_bytes: Size of the (decompressed) payload.
+        :param wire_bytes: Size of the payload as received, if it was 
+            compressed.
+        :param inflate_time: Seconds spent decompressing the payload, if it 
+            was compressed.
+        """
+        with self.__lock:
+            self.payloads += 1
+            self.messages += messages
+            self.payload_bytes += payload_bytes
+            if wire_bytes is not None:
+                self.compressed += 1
+                self.wire_bytes += wire_bytes
+                self.inflated_bytes += payload_bytes
+                self.inflate_time += inflate_time
+
+    def record_sample(self, payload):
+        """
+        Keeps the first SAMPLE_SIZE bytes of an uncompressed payload as the 
+        current sample.
+
+        :param payload: The payload of a PublishMessage.
+        """
+        self.sample = payload[:SAMPLE_SIZE]
+
+    def record_callback(self, elapsed):
+        """
+        Records a callback invocation.
+
+        :param elapsed: Seconds the callback took.
+        """
+        with self.__lock:
+            self.callbacks += 1
+            self.callback_time += elapsed
+
+    def snapshot(self):
+        """
+        Returns a dict of the current counter values.
+        """
+        with self.__lock:
+            return {'payloads' : self.payloads,
+                    'messages' : self.messages,
+                    'payload_bytes' : self.payload_bytes,
+                    'compressed' : self.compressed,
+                    'wire_bytes' : self.wire_bytes,
+                    'inflated_bytes' : self.inflated_bytes,
+                    'inflate_time' : self.inflate_time,
+                    'callbacks' : self.callbacks,
+                    'callback_time' : self.callback_time}
+
+class BufferBudget(object):
+    """
+    Accounts for the bytes of PublishMessages held in memory by all sessions 
+    of a client, from the time their header is read until their callback 
+    has returned.  Messages that do not fit within the limit are spilled to 
+    disk instead of being read into memory.
+
+    Also counts the callbacks a client has queued against its max_queued.
+    """
+
+    def __init__(self, limit=None):
+        """
+        :param limit: Maximum bytes held in memory, None for no limit.
+        """
+        self.__lock = Lock()
+        self.limit  = limit
+        self.used   = 0
+
+    def reserve(self, size):
+        """
+        Reserves size bytes if they fit within the limit.  Returns True if 
+        they were reserved.
+        """
+        with self.__lock:
+            if self.limit is not None and self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def charge(self, size):
+        """
+        Accounts for size bytes whether or not they fit within the limit.
+        """
+        with self.__lock:
+            self.used += size
+
+    def release(self, size):
+        """
+        Returns size reserved or charged bytes.
+        """
+        with self.__lock:
+            self.used -= size
+
+class LaneStats(object):
+    """
+    Delivery latency of the payloads of one priority lane, measured from 
+    the time a payload was fully read to the time its callback returned.
+    """
+
+    def __init__(self):
+        self.__lock        = Lock()
+        self.deliveries    = 0
+        self.total_latency = 0.0
+        self.max_latency   = 0.0
+        # Most recent latencies, for percentiles.
+        self.recent        = deque(maxlen=LATENCY_SAMPLES)
+
+    def record(self, latency):
+        """
+        Records the delivery of a payload.
+
+        :param latency: Seconds from receipt to callback completion.
+        """
+        with self.__lock:
+            self.deliveries += 1
+            self.total_latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+            self.recent.append(latency)
+
+    def snapshot(self):
+        """
+        Returns a dict of the delivery count, mean and maximum latency, and 
+        the 50th and 99th percentile of recent latencies.
+        """
+        with self.__lock:
+            recent = sorted(self.recent)
+            deliveries = self.deliveries
+            total = self.total_latency
+            maximum = self.max_latency
+
+        def percentile(fraction):
+            if not recent:
+                return 0.0
+            return recent[min(len(recent) - 1, int(len(recent) * fraction))]
+
+        return {'deliveries' : deliveries,
+                'mean_latency' : total / deliveries if deliveries else 0.0,
+                'max_latency' : maximum,
+                'p50_latency' : percentile(0.5),
+                'p99_latency' : percentile(0.99)}
+
+class AckHandle(object):
+    """
+    Returned by a callback that finishes processing its payload later,
+    i.e. once a downstream pipeline has committed it.  Any thread may then
+    call :meth:`ack`, or :meth:`nack` to leave the payload unacknowledged.
+    A callback may instead return any future with add_done_callback and
+    result methods, it is acknowledged if its result is true.
+    """
+
+    def __init__(self):
+        self.__lock      = Lock()
+        self.__success   = None
+        self.__listeners = []
+
+    @property
+    def done(self):
+        """
+        Whether ack or nack has been called.
+        """
+        return self.__success is not None
+
+    def ack(self):
+        """
+        Acknowledges the payload(s) the handle was returned for.
+        """
+        self.__complete(True)
+
+    def nack(self):
+        """
+        Rejects the payload(s) the handle was returned for, iDigi
+        redelivers them.
+        """
+        self.__complete(False)
+
+    def result(self):
+        """
+        Returns True if acknowledged, False if rejected, None if neither
+        yet.
+        """
+        return self.__success
+
+    def add_done_callback(self, function):
+        """
+        Calls function with this handle once it is done, immediately if it
+        already is.
+        """
+        with self.__lock:
+            if self.__success is None:
+                self.__listeners.append(function)
+                return
+        function(self)
+
+    def __complete(self, success):
+        with self.__lock:
+            if self.__success is not None:
+                raise ValueError("AckHandle already completed.")
+            self.__success = success
+            listeners = self.__listeners
+            self.__listeners = None
+        for function in listeners:
+            function(self)
+
+def _deferred(result):
+    """
+    Returns True if a callback result is an AckHandle or future to be
+    waited on rather than a status.
+    """
+    return hasattr(result, 'add_done_callback')
+
+def _succeeded(future):
+    """
+    Returns whether a completed AckHandle or future acknowledges its
+    payloads.  A future that raised or was cancelled does not.
+    """
+    try:
+        return bool(future.result())
+    except Exception, exception:
+        LOG.error("Deferred callback failed: %s" % exception)
+        return False
+
+class _Unacked(object):
+    """
+    A message of an AckWindow, pending until its callback's result is
+    known.
+    """
+
+    __slots__ = ('window', 'block_id', 'success')
+
+    def __init__(self, window, block_id):
+        self.window   = window
+        self.block_id = block_id
+        self.success  = None
+
+class AckWindow(object):
+    """
+    The messages received on one connection of a session that have not
+    been acknowledged yet, in the order they were received.  A message is
+    only acknowledged once every message received before it has been
+    acknowledged or rejected, so callbacks completing out of order still
+    acknowledge in order.
+    """
+
+    def __init__(self, limit=MAX_IN_FLIGHT):
+        """
+        :param limit: Number of messages after which the window is full.
+        """
+        self.__lock    = Condition()
+        self.__entries = deque()
+        self.limit     = limit
+        self.closed    = False
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def full(self):
+        """
+        Returns True if limit messages are in flight.
+        """
+        return len(self.__entries) >= self.limit
+
+    def open(self, block_id):
+        """
+        Adds a message just received and returns its entry.
+        """
+        entry = _Unacked(self, block_id)
+        with self.__lock:
+            self.__entries.append(entry)
+        return entry
+
+    def resolve(self, outcomes, send):
+        """
+        Records the outcome of messages, then calls send with the block ids
+        of the acknowledged messages no longer preceded by a pending one.
+        Nothing is sent once the window is closed.
+
+        :param outcomes: List of (entry returned by open, whether it is
+            acknowledged) tuples.
+        :param send: Called with a list of block ids to acknowledge.
+        """
+        block_ids = []
+        with self.__lock:
+            for entry, success in outcomes:
+                entry.success = success
+            head = self.__entries
+            while head and head[0].success is not None:
+                entry = head.popleft()
+                if entry.success:
+                    block_ids.append(entry.block_id)
+            if block_ids and not self.closed:
+                # Under the lock, so the connection cannot be replaced
+                # between the check and queueing the acknowledgements.
+                send(block_ids)
+            if not head:
+                self.__lock.notify_all()
+
+    def close(self):
+        """
+        Drops the acknowledgements still to come, their connection has
+        gone.
+        """
+        with self.__lock:
+            self.closed = True
+            self.__lock.notify_all()
+
+    def wait_empty(self, timeout=None):
+        """
+        Waits up to timeout seconds for every message to be acknowledged or
+        rejected.  Returns True if none remain.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.__lock:
+            while self.__entries and not self.closed:
+                remaining = None if deadline is None \
+                    else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.__lock.wait(remaining)
+            return not self.__entries
+
 class PushSession(object):
     """
     A PushSession is responsible for establishing a socket connection
     with iDigi to receive events generated by Devices connected to 
     iDigi.
     """
+
+    __slots__ = ('callback', 'monitor_id', 'client', 'message_filter', 
+                'socket', 'fileno', 'data', 'message_length', 'retry_errors',
+                '_stats', 'batch_size', 'batch_wait', 'pending', 'scheduled',
+                'priority', 'spill', 'spilled', 'reserved', 'idle_timeout', 
+                'last_activity', 'codec', 'acks', 'max_in_flight', 
+                'on_connect')
+
+    # Logger shared by all sessions, the monitor id is passed as context.
+    _LOG = logging.getLogger("push_session")
     
-    def __init__(self, callback, monitor_id, client):
+    def __init__(self, callback, monitor_id, client, message_filter=None,
+                batch_size=1, batch_wait=0.05, priority=PRIORITY_NORMAL,
+                idle_timeout=None, codec=None, max_in_flight=MAX_IN_FLIGHT,
+                on_connect=None):
         """
         Creates a PushSession for use with interacting with iDigi's
         Push Functionality.
         
         :param callback: The callback function to invoke when data received.  
-            Must have 1 required parameter that will contain the payload.
+            Must have 1 required parameter that will contain the payload, 
+            or the list of payloads if batch_size is greater than 1.
         :param monitor_id: The id of the Monitor to observe.
         :param client: The client object this session is derived from.
+        :param message_filter: An optional :class:`MessageFilter` applied to 
+            payloads before they are passed to the callback.
+        :param batch_size: Maximum number of payloads passed to the callback 
+            in one call.
+        :param batch_wait: Seconds to wait for a batch to fill before calling 
+            back with the payloads received so far.
+        :param priority: The lane the session's payloads and acknowledgements 
+            are queued in, PRIORITY_HIGH or PRIORITY_NORMAL.
+        :param idle_timeout: Seconds without receiving any data after which 
+            the connection is assumed dead and restarted, None to never.
+        :param codec: An optional :class:`PayloadCodec` decoding payloads 
+            before they are passed to the callback.
+        :param max_in_flight: Maximum number of messages received but not
+            yet acknowledged or rejected.
+        :param on_connect: Called with the session each time its connection
+            is established.
         """
-        self.callback    = callback
-        self.monitor_id  = monitor_id
-        self.client      = client
-        self.socket      = None
-        self.log         = logging.getLogger("push_session[%s]" % monitor_id)
+        self.callback       = callback
+        self.monitor_id     = monitor_id
+        self.client         = client
+        self.message_filter = message_filter
+        self.socket         = None
+        # File descriptor of socket, kept to unregister it once closed.
+        self.fileno         = None
+        # Exceptions raised by reads on the socket that only mean the read 
+        # should be retried once select triggers again.
+        self.retry_errors   = ()
+        self._stats         = None
+        self.batch_size     = batch_size
+        self.batch_wait     = batch_wait
+        # Payloads waiting for a callback worker in batch mode, created on 
+        # first use, and whether the session is queued to a worker.
+        self.pending        = None
+        self.scheduled      = False
+        self.priority       = priority
+        self.idle_timeout   = idle_timeout
+        self.codec          = codec
+        # Messages of the current connection awaiting acknowledgement, 
+        # created once a message is received on it.
+        self.acks           = None
+        self.max_in_flight  = max_in_flight
+        self.on_connect     = on_connect
+        # Time data was last received, or the session last (re)started.
+        self.last_activity  = time.time()
 
         # Received protocol data holders.
         self.data           = ""
         self.message_length = 0
+        # Temporary file the payload of the current message is written to 
+        # when it is not read into memory, and the bytes written to it.
+        self.spill          = None
+        self.spilled        = 0
+        # Bytes of the client's BufferBudget held by the current message.
+        self.reserved       = 0
+
+    @property
+    def log(self):
+        """
+        A logger adapter adding this session's monitor id to records.
+        """
+        return logging.LoggerAdapter(self._LOG, 
+                                    {'monitor_id' : self.monitor_id})
+
+    @property
+    def stats(self):
+        """
+        The :class:`SessionStats` of this session, created on first use.
+        """
+        if self._stats is None:
+            self._stats = SessionStats()
+        return self._stats
         
     def send_connection_request(self):
         """
@@ -227,11 +891,11 @@ ConnectionResponse Type (%d)." % (response_type, CONNECTION_RESPONSE))
             if status_code != STATUS_OK:
                 raise PushException("Connection Response Status Code (%d) is \
 not STATUS_OK (%d)." % (status_code, STATUS_OK))
-        except Exception, exception:
-            # Likely a socket exception, close it and raise an exception.
+        except Exception:
+            # Likely a socket exception, close it and raise it again.
             self.socket.close()
             self.socket = None
-            raise exception
+            raise
 
     def start(self):
         """
@@ -244,13 +908,15 @@ not STATUS_OK (%d)." % (status_code, STATUS_OK))
             raise Exception("Socket already established for %s." % self)
         
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.client.hostname, PUSH_OPEN_PORT))
+            self.socket, _ = self.client.connect(PUSH_OPEN_PORT)
             self.socket.setblocking(0)
-        except Exception, exception:
-            self.socket.close()
-            self.socket = None
-            raise exception
+            self.fileno = self.socket.fileno()
+        except Exception:
+            # connect may fail before there is a socket to close.
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
+            raise
         
         self.send_connection_request()
             
@@ -259,10 +925,31 @@ not STATUS_OK (%d)." % (status_code, STATUS_OK))
         Closes the socket associated with this session and puts Session 
         into a state such that it can be re-established later.
         """
+        # Acknowledgements still to come are for this connection only.
+        if self.acks is not None:
+            self.acks.close()
+            self.acks = None
         if self.socket is not None:
             self.socket.close()
             self.socket = None
-            self.data = None
+            self.client.sessions.stopped(self)
+        self.discard_message()
+
+    def discard_message(self):
+        """
+        Drops the partially received message, if any.
+        """
+        # Reset rather than set to None, so a restarted session can read 
+        # the next header.
+        self.data = ""
+        self.message_length = 0
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+            self.spilled = 0
+        if self.reserved:
+            self.client.buffers.release(self.reserved)
+            self.reserved = 0
 
 class SecurePushSession(PushSession):
     """
@@ -270,8 +957,13 @@ class SecurePushSession(PushSession):
     in SSL.  It expects the certificate to match any of those in the passed
     in ca_certs member file.
     """
+
+    __slots__ = ('ca_certs',)
     
-    def __init__(self, callback, monitor_id, client, ca_certs=None):
+    def __init__(self, callback, monitor_id, client, ca_certs=None, 
+                message_filter=None, batch_size=1, batch_wait=0.05, 
+                priority=PRIORITY_NORMAL, idle_timeout=None, codec=None,
+                max_in_flight=MAX_IN_FLIGHT, on_connect=None):
         """
         Creates a PushSession wrapped in SSL for use with interacting with 
         iDigi's Push Functionality.
@@ -284,8 +976,20 @@ class SecurePushSession(PushSession):
         :param ca_certs: Path to a file containing Certificates.  
             If not provided, the idigi.crt file provided with the module will 
             be used.  In most cases, the idigi.crt file should be acceptable.
+        :param message_filter: An optional :class:`MessageFilter` applied to 
+            payloads before they are passed to the callback.
+        :param batch_size: Maximum number of payloads passed to the callback 
+            in one call.
+        :param batch_wait: Seconds to wait for a batch to fill.
+        :param priority: The lane of the session.
+        :param idle_timeout: Seconds without data before restarting.
+        :param codec: An optional :class:`PayloadCodec`.
+        :param max_in_flight: Maximum number of unacknowledged messages.
+        :param on_connect: Called with the session when it connects.
         """
-        PushSession.__init__(self, callback, monitor_id, client)
+        PushSession.__init__(self, callback, monitor_id, client,
+                            message_filter, batch_size, batch_wait, priority,
+                            idle_timeout, codec, max_in_flight, on_connect)
         # Fall back on idigi.crt in the same path as this module if not 
         # specified.
         self.ca_certs = ca_certs if ca_certs is not None else IDIGI_CRT
@@ -299,10 +1003,14 @@ class SecurePushSession(PushSession):
             % self.monitor_id)
         if self.socket is not None:
             raise Exception("Socket already established for %s." % self)
+
+        # ssl is only imported once a secure session is needed.
+        import ssl
+        self.retry_errors = (ssl.SSLError,)
         
         try:
-            # Create socket, wrap in SSL and connect.
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Connect, then wrap in SSL, which performs the handshake.
+            self.socket, _ = self.client.connect(PUSH_SECURE_PORT)
             # Validate that certificate server uses matches what we expect.
             if self.ca_certs is not None:
                 self.socket = ssl.wrap_socket(self.socket, 
@@ -310,242 +1018,1165 @@ class SecurePushSession(PushSession):
                                                 ca_certs=self.ca_certs)
             else:
                 self.socket = ssl.wrap_socket(self.socket)
-
-            self.socket.connect((self.client.hostname, PUSH_SECURE_PORT))
             self.socket.setblocking(0)
-        except Exception, exception:
-            self.socket.close()
-            self.socket = None
-            raise exception
+            self.fileno = self.socket.fileno()
+        except Exception:
+            # connect may fail before there is a socket to close.
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
+            raise
             
         self.send_connection_request()
 
-class CallbackWorkerPool(object):
+class SessionTable(object):
     """
-    A Worker Pool implementation that creates a number of predefined threads
-    used for invoking Session callbacks.
+    The active PushSessions of a client indexed by socket file descriptor.  
+    Adding and removing a session are O(1), and sessions that stop report 
+    themselves so that removing dead sessions does not scan the table.
+
+    Sockets are watched with poll where available, so the number of sessions 
+    is not limited by select's FD_SETSIZE.  Sessions that cannot be read 
+    from for now are paused, their sockets are not watched until resumed.
+
+    A pipe is watched alongside the sockets so that other threads can wake 
+    a poll in progress, see :meth:`wake`, and the IO thread can block until 
+    there is something to do rather than poll on a timer.
     """
 
-    def __consume_queue(self):
+    def __init__(self):
+        self.__sessions = {}
+        # Paused sessions, by file descriptor.
+        self.__paused   = {}
+        # (fd, session) pairs of sessions stopped since the last cleanup.
+        self.__stopped  = deque()
+        self.__poller   = select.poll() if hasattr(select, 'poll') else None
+        # Ends of the wakeup pipe, and whether a byte was written to it 
+        # since the last poll drained it.  The lock keeps the flag and the 
+        # pipe in step.
+        self.__wakeup_read, self.__wakeup_write = _wakeup_pipe()
+        self.__woken    = False
+        self.__wake_lock = Lock()
+        if self.__poller is not None:
+            self.__poller.register(self.__wakeup_read, select.POLLIN)
+
+    def __len__(self):
+        return len(self.__sessions)
+
+    def __contains__(self, fd):
+        return fd in self.__sessions
+
+    def get(self, fd):
         """
-        Continually blocks until data is on the internal queue, then calls 
-        the session's registered callback and sends a PublishMessageReceived 
-        if callback returned True.
+        Returns the session whose socket has file descriptor fd, or None.
         """
-        while True:
-            session, block_id, data = self.__queue.get()
-            try:
-                if session.callback(data):
-                    # Send a Successful PublishMessageReceived with the 
-                    # block id sent in request
-                    if self.__write_queue is not None:
-                        response_message = struct.pack('!HHH', 
-                                            PUBLISH_MESSAGE_RECEIVED, 
-                                            block_id, 200)
-                        self.__write_queue.put((session.socket, 
-                            response_message))
-            except Exception, exception:
-                self.log.exception(exception)
+        return self.__sessions.get(fd)
 
-            self.__queue.task_done()
+    def values(self):
+        """
+        Returns a list of all sessions.
+        """
+        return self.__sessions.values()
 
+    def add(self, session):
+        """
+        Adds a started session.
 
-    def __init__(self, write_queue=None, size=1):
+        :param session: The session, its socket must be connected.
         """
-        Creates a Callback Worker Pool for use in invoking Session Callbacks 
-        when data is received by a push client.
+        self.__sessions[session.fileno] = session
+        self.__paused.pop(session.fileno, None)
+        if self.__poller is not None:
+            self.__poller.register(session.fileno, 
+                                    select.POLLIN | select.POLLPRI)
 
-        :param write_queue: Queue used for queueing up socket write events 
-            for when a payload message is received and processed.
-        :param size: The number of worker threads to invoke callbacks.
+    def remove(self, fd):
         """
-        # Used to queue up PublishMessageReceived events to be sent back to 
-        # the iDigi server.
-        self.__write_queue = write_queue
-        # Used to queue up sessions and data to callback with.
-        self.__queue = Queue(size)
-        # Number of workers to create.
-        self.size = size
-        self.log  = logging.getLogger('callback_worker_pool')
+        Removes the session with file descriptor fd, if any.
+        """
+        session = self.__sessions.pop(fd, None)
+        if session is not None and self.__poller is not None and \
+                self.__paused.pop(fd, None) is None:
+            try:
+                self.__poller.unregister(fd)
+            except KeyError:
+                pass
+        return session
 
-        for _ in range(size): 
-            worker = Thread(target=self.__consume_queue)
-            worker.daemon = True
-            worker.start()
+    def pause(self, session):
+        """
+        Stops watching the socket of a session until it is resumed.
 
-    def queue_callback(self, session, block_id, data):
+        :param session: A session in the table.
         """
-        Queues up a callback event to occur for a session with the given 
-        payload data.  Will block if the queue is full.
+        if session.fileno in self.__paused:
+            return
+        self.__paused[session.fileno] = session
+        if self.__poller is not None:
+            self.__poller.unregister(session.fileno)
 
-        :param session: the session with a defined callback function to call.
-        :param block_id: the block_id of the message received.
-        :param data: the data payload of the message received.
+    def resume(self, session):
         """
-        self.__queue.put((session, block_id, data))
+        Watches the socket of a paused session again.
 
-class PushClient(object):
-    """
-    A Client for the 'Push' feature in iDigi.
-    """
-    
-    def __init__(self, username, password, hostname='developer.idigi.com', 
-                secure=True, ca_certs=None, workers=1):
+        :param session: A paused session.
         """
-        Creates a Push Client for use in creating monitors and creating sessions 
-        for them.
-        
-        :param username: Username to authenticate with.
-        :param password: Password to authenticate with.
-        :param hostname: Hostname of iDigi server to connect to.
-        :param secure: Whether or not to create a secure SSL wrapped session.
-        :param ca_certs: Path to a file containing Certificates.  
-            If not provided, the idigi.crt file provided with the module will 
-            be used.  In most cases, the idigi.crt file should be acceptable.
-        :param workers: Number of workers threads to process callback calls.
+        if self.__paused.pop(session.fileno, None) is not None and \
+                self.__poller is not None:
+            self.__poller.register(session.fileno, 
+                                    select.POLLIN | select.POLLPRI)
+
+    def paused(self):
         """
-        self.hostname     = hostname
-        self.username     = username
-        self.password     = password
-        self.secure       = secure
-        self.ca_certs     = ca_certs
-        
-        # A dict mapping Sockets to their PushSessions
-        self.sessions          = {}
-        # IO thread is used monitor sockets and consume data.
-        self.__io_thread       = None
-        # Writer thread is used to send data on sockets.
-        self.__writer_thread   = None
-        # Write queue is used to queue up data to write to sockets.
-        self.__write_queue     = Queue()
-        # A pool that monitors callback events and invokes them.
-        self.__callback_pool   = CallbackWorkerPool(self.__write_queue, 
-                                                    size=workers)
+        Returns a list of the paused sessions.
+        """
+        return self.__paused.values()
 
-        self.closed            = False
-        self.log               = logging.getLogger('push_client')
+    def has_paused(self):
+        """
+        Returns True if any session is paused.
+        """
+        return bool(self.__paused)
 
-        self.headers           = {
-            'Authorization': 'Basic ' \
-            + base64.encodestring('%s:%s' %
-                (self.username,self.password))[:-1]
-        }
+    def stopped(self, session):
+        """
+        Records that a session's socket was closed, it is removed on the 
+        next call to clean.
 
-    def get_http_connection(self):
+        :param session: The stopped session.
         """
-        Returns a HTTPConnection or HTTPSConnection (depending on whether or 
-        not secure is set) to be used for interfacing with iDigi web services.
+        self.__stopped.append((session.fileno, session))
+        # Sessions may be stopped from any thread, have the IO thread clean 
+        # up rather than keep watching a closed socket.
+        self.wake()
+
+    def wake(self):
+        """
+        Makes the poll in progress, or the next one, return at once.  May be 
+        called from any thread.
         """
-        return httplib.HTTPSConnection(self.hostname) if self.secure \
-            else httplib.HTTPConnection(self.hostname)
+        with self.__wake_lock:
+            if self.__woken:
+                return
+            self.__woken = True
+            try:
+                os.write(self.__wakeup_write, '\0')
+            except (OSError, TypeError):
+                # Pipe full, so a wakeup is pending anyway, or closed.
+                pass
 
+    def __drain_wakeup(self):
+        """
+        Empties the wakeup pipe after a poll returned for it.
+        """
+        # Cleared with the byte read, so a wake from now on writes again.  
+        # One made before is seen by the caller, which checks for work 
+        # after polling.
+        with self.__wake_lock:
+            self.__woken = False
+            try:
+                os.read(self.__wakeup_read, 512)
+            except OSError:
+                pass
 
-    def create_monitor(self, topics, batch_size=1, batch_duration=0, 
-        compression='gzip', format_type='json'):
+    def close(self):
         """
-        Creates a Monitor instance in iDigi for a given list of topics.
-        
-        :param topics: a string list of topics (i.e. ['DeviceCore[U]', 
-                  'FileDataCore']).
-        :param batch_size: How many Msgs received before sending data.
-        :param batrch_duration: How long to wait before sending batch if it 
-            does not exceed batch_size.
-        :param compression: Compression value (i.e. 'gzip').
-        :param format_type: What format server should send data in (i.e. 
-            'xml' or 'json').
-        
-        Returns a string of the created Monitor Id (i.e. 9001)
+        Closes the wakeup pipe, once no session is to be polled anymore.
+        """
+        read, write = self.__wakeup_read, self.__wakeup_write
+        if read is None:
+            return
+        self.__wakeup_read = self.__wakeup_write = None
+        if self.__poller is not None:
+            self.__poller.unregister(read)
+        os.close(read)
+        os.close(write)
+
+    def clean(self):
+        """
+        Removes the sessions recorded as stopped that have not been 
+        restarted since.
         """
-        # Create Monitor Request XML.
-        monitor_req = DOM.createDocument(None, "Monitor", None)
-        root = monitor_req.documentElement
+        while self.__stopped:
+            fd, session = self.__stopped.popleft()
+            if self.__sessions.get(fd) is session and session.socket is None:
+                self.remove(fd)
 
-        attrs = { 'monTopic' : ','.join(topics), 
-                    'monBatchSize' : str(batch_size),
-                    'monBatchDuration' : str(batch_duration),
-                    'monFormatType' : format_type,
-                    'monTransportType' : 'tcp',
-                    'monCompression' : compression }
+    def poll(self, timeout=None):
+        """
+        Waits up to timeout seconds for sockets to become readable, or for 
+        :meth:`wake` to be called.  Returns a list of the file descriptors of 
+        the readable sockets.
 
-        for tag, value in attrs.items():
-            element = monitor_req.createElement(tag)
-            element.appendChild(monitor_req.createTextNode(value))
-            root.appendChild(element)
+        :param timeout: Seconds to wait, None to wait until woken.
+        """
+        if self.__poller is None:
+            ready = select.select([fd for fd in self.__sessions 
+                                    if fd not in self.__paused] + 
+                                    [self.__wakeup_read], 
+                                [], [], timeout)[0]
+            if self.__wakeup_read in ready:
+                self.__drain_wakeup()
+                ready.remove(self.__wakeup_read)
+            return ready
+
+        ready = []
+        for fd, event in self.__poller.poll(
+                None if timeout is None else timeout * 1000):
+            if fd == self.__wakeup_read:
+                self.__drain_wakeup()
+            elif event & select.POLLNVAL:
+                # Closed behind our back, forget it.
+                self.remove(fd)
+            else:
+                ready.append(fd)
+        return ready
 
-        request = root.toxml()
+class LaneQueue(object):
+    """
+    A queue made of one FIFO per priority lane, with the interface of 
+    Queue.Queue.  While several lanes have items, gets take from them in 
+    proportion to their weights using smooth weighted round robin, so lower 
+    priority lanes are slowed but never starved.
+    """
 
-        # POST Monitor Request.
-        connection = self.get_http_connection()
-        connection.request('POST', '/ws/Monitor', request, self.headers)
-        response = connection.getresponse()
-        try:
-            if response.status == 201:
-                location = response.getheader('location').split('/')[-1]
-                return location
+    def __init__(self, weights=LANE_WEIGHTS, maxsize=0):
+        """
+        :param weights: Relative share of gets given to each lane.
+        :param maxsize: Maximum number of items per lane, 0 for unbounded.
+        """
+        self.weights      = weights
+        self.maxsize      = maxsize
+        self.__lanes      = [deque() for _ in weights]
+        # Running credit of each lane for the weighted round robin.
+        self.__credits    = [0] * len(weights)
+        self.__unfinished = 0
+        self.__mutex      = Lock()
+        self.__not_empty  = Condition(self.__mutex)
+        self.__not_full   = Condition(self.__mutex)
+        self.__all_done   = Condition(self.__mutex)
+
+    def qsize(self, lane=None):
+        """
+        Returns the number of items in lane, or in all lanes.
+        """
+        with self.__mutex:
+            if lane is None:
+                return sum(len(items) for items in self.__lanes)
+            return len(self.__lanes[lane])
+
+    def full(self, lane):
+        """
+        Returns True if a put to lane would block.
+        """
+        return self.maxsize > 0 and len(self.__lanes[lane]) >= self.maxsize
+
+    def wait_for_room(self, lanes, timeout):
+        """
+        Waits up to timeout seconds for any of lanes to not be full.
+
+        :param lanes: Iterable of lanes.
+        :param timeout: Seconds to wait.
+        """
+        with self.__not_full:
+            if all(self.full(lane) for lane in lanes):
+                self.__not_full.wait(timeout)
+
+    def put(self, item, lane=0):
+        """
+        Puts item at the end of lane, blocking while the lane is full.
+        """
+        with self.__not_full:
+            while self.full(lane):
+                self.__not_full.wait()
+            self.__lanes[lane].append(item)
+            self.__unfinished += 1
+            # Getters may be restricted to some lanes, wake all of them.
+            self.__not_empty.notify_all()
+
+    def __next_lane(self, lanes):
+        """
+        Returns the lane to get from next among the non empty lanes, or 
+        None if they are all empty.  Must hold the mutex.
+        """
+        chosen = None
+        total = 0
+        for lane in lanes:
+            if not self.__lanes[lane]:
+                continue
+            self.__credits[lane] += self.weights[lane]
+            total += self.weights[lane]
+            if chosen is None or \
+                    self.__credits[lane] > self.__credits[chosen]:
+                chosen = lane
+        if chosen is not None:
+            self.__credits[chosen] -= total
+        return chosen
+
+    def get(self, block=True, timeout=None, lanes=None):
+        """
+        Removes and returns an item, raising Empty if none is available 
+        within timeout seconds.
+
+        :param block: Whether to wait for an item.
+        :param timeout: Maximum seconds to wait, None to wait forever.
+        :param lanes: The lanes to take from, all lanes if None.
+        """
+        if lanes is None:
+            lanes = range(len(self.__lanes))
+        with self.__not_empty:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while True:
+                lane = self.__next_lane(lanes)
+                if lane is not None:
+                    break
+                if not block:
+                    raise Empty
+                if timeout is None:
+                    self.__not_empty.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    self.__not_empty.wait(remaining)
+            item = self.__lanes[lane].popleft()
+            self.__not_full.notify_all()
+            return item
+
+    def get_nowait(self, lanes=None):
+        """
+        Removes and returns an item if one is available, else raises Empty.
+        """
+        return self.get(False, lanes=lanes)
+
+    def task_done(self):
+        """
+        Indicates that processing of a got item is complete.
+        """
+        with self.__all_done:
+            self.__unfinished -= 1
+            if self.__unfinished <= 0:
+                self.__all_done.notify_all()
+
+    def join(self):
+        """
+        Blocks until every item put has been got and processed.
+        """
+        with self.__all_done:
+            while self.__unfinished > 0:
+                self.__all_done.wait()
+
+class TimerWheel(object):
+    """
+    A hashed timer wheel.  Deadlines are hashed into one of size slots by 
+    the tick they fall in, so scheduling and cancelling are O(1) and 
+    expiring only looks at the slots of the ticks elapsed since the last 
+    call, whatever the number of timers.  Timers expire at the end of their 
+    tick, at most tick seconds late.
+    """
+
+    def __init__(self, tick=1.0, size=512):
+        """
+        :param tick: Seconds covered by each slot.
+        :param size: Number of slots.  Deadlines further than size ticks 
+            away stay in their slot for more than one turn of the wheel.
+        """
+        self.tick      = tick
+        self.__slots   = [{} for _ in xrange(size)]
+        # Key -> index of the slot holding it.
+        self.__where   = {}
+        # Last tick that was expired.
+        self.__current = int(time.time() / tick) - 1
+        # No slot of a tick before this one holds a timer.
+        self.__next    = None
+
+    def __len__(self):
+        return len(self.__where)
+
+    def schedule(self, key, deadline):
+        """
+        Schedules key to expire at deadline, replacing any timer it had.
+
+        :param key: Any hashable object.
+        :param deadline: Time in seconds since the epoch.
+        """
+        self.cancel(key)
+        tick = max(int(deadline / self.tick), self.__current + 1)
+        index = tick % len(self.__slots)
+        self.__slots[index][key] = deadline
+        self.__where[key] = index
+        if self.__next is None or tick < self.__next:
+            self.__next = tick
+
+    def next_expiry(self):
+        """
+        Returns the earliest time at which :meth:`expire` may have timers 
+        to remove, or None if there are none.  Cancelled timers are not 
+        accounted for, so there may be none to remove by then.
+        """
+        if not self.__where:
+            return None
+        return (self.__next + 1) * self.tick
+
+    def cancel(self, key):
+        """
+        Cancels the timer of key, if any.
+        """
+        index = self.__where.pop(key, None)
+        if index is not None:
+            del self.__slots[index][key]
+
+    def expire(self, now):
+        """
+        Removes and returns the keys whose deadline has passed.
+
+        :param now: The current time in seconds since the epoch.
+        """
+        tick = int(now / self.tick)
+        expired = []
+        size = len(self.__slots)
+        # Only whole ticks are expired, so a slot is never left holding a 
+        # timer due before its next turn.
+        for current in xrange(self.__current + 1, 
+                            min(tick, self.__current + 1 + size)):
+            slot = self.__slots[current % size]
+            if not slot:
+                continue
+            for key, deadline in slot.items():
+                if deadline <= now:
+                    del slot[key]
+                    del self.__where[key]
+                    expired.append(key)
+        self.__current = max(self.__current, tick - 1)
+        if self.__next is not None and self.__next <= self.__current:
+            # Find the next slot holding a timer, at most once a tick.
+            self.__next = None
+            for current in xrange(self.__current + 1, 
+                                self.__current + 1 + size):
+                if self.__slots[current % size]:
+                    self.__next = current
+                    break
+        return expired
+
+class CallbackWorkerPool(object):
+    """
+    A Worker Pool implementation that creates a number of predefined threads
+    used for invoking Session callbacks.
+
+    Callbacks are queued in the lane of their session's priority.  Workers
+    serve the lanes in proportion to their weights, and reserved workers
+    only ever serve PRIORITY_HIGH sessions, so bulk traffic cannot occupy
+    every worker.
+
+    Every message is entered in its session's :class:`AckWindow` when it
+    is queued, and acknowledged through it once its callback's result, or
+    the AckHandle or future the callback returned, is known.
+
+    If max_size is greater than size, the shared workers are scaled
+    between the two from their utilization (the share of time they spent
+    in callbacks) and the depth of the queue, see :meth:`scale`.
+    """
+
+    def __send_acks(self, session, block_ids):
+        """
+        Queues Successful PublishMessageReceived messages with the block ids 
+        sent in requests, as a single write.
+
+        :param session: the session the messages were received on.
+        :param block_ids: the block_ids of the messages received.
+        """
+        if self.__write_queue is not None and block_ids:
+            response_message = ''.join(struct.pack('!HHH', 
+                                        PUBLISH_MESSAGE_RECEIVED, 
+                                        block_id, 200) 
+                                        for block_id in block_ids)
+            self.__write_queue.put((session.socket, response_message), 
+                                    session.priority)
+
+    def __settle(self, session, outcomes):
+        """
+        Records the outcomes of messages and queues the acknowledgements
+        this releases.  An outcome that is an AckHandle or future is
+        recorded once it completes, from the thread completing it.
+
+        :param session: the session the messages were received on.
+        :param outcomes: list of (AckWindow entry, callback result) tuples.
+        """
+        settled = {}
+        deferred = {}
+        for entry, result in outcomes:
+            if _deferred(result):
+                # A handle returned for a whole batch completes all of its
+                # entries at once.
+                deferred.setdefault(id(result), (result, []))[1].append(entry)
             else:
-                raise Exception("Monitor Could not be Created (%d): %s" \
-                    % (response.status, response.read()))
-        finally:
-            connection.close()
+                # Entries of a batch may straddle a restart of the session.
+                settled.setdefault(entry.window, []).append(
+                    (entry, bool(result)))
+
+        send = lambda block_ids: self.__send_acks(session, block_ids)
+        for window, resolved in settled.iteritems():
+            window.resolve(resolved, send)
+        for future, entries in deferred.itervalues():
+            future.add_done_callback(lambda future, entries=entries:
+                self.__complete(session, entries, future))
+
+    def __complete(self, session, entries, future):
+        """
+        Records the outcome of the messages whose callback returned an 
+        AckHandle or future once it completes.
+        """
+        self.__settle(session, [(entry, _succeeded(future)) 
+                                for entry in entries])
+        self.__wake()
 
+    def __wake(self):
+        """
+        Lets the IO thread know a callback completed, so that it reads again 
+        from sessions paused while throttled.
+        """
+        if self.__wakeup is not None:
+            self.__wakeup()
 
-    def delete_monitor(self, monitor_id):
+    def __release(self, payload):
         """
-        Attempts to Delete a Monitor from iDigi.  Throws exception if 
-        Monitor does not exist.
+        Frees a payload whose callback has returned: returns its bytes to 
+        the buffer budget, or closes it if it was spilled to disk.
+        """
+        if isinstance(payload, str):
+            if self.__buffers is not None:
+                self.__buffers.release(len(payload))
+        else:
+            payload.close()
 
-        :param monitor_id: id of the Monitor (i.e. 1000).
+    def __invoke(self, session, entry, payload, received):
         """
+        Calls the session's registered callback with a single payload and
+        sends a PublishMessageReceived if callback returned True, or once the
+        AckHandle or future it returned completes successfully.  Payloads
+        rejected entirely by the session's message filter are acknowledged
+        without calling back.
 
-        connection = self.get_http_connection()
-        connection.request('DELETE', '/ws/Monitor/%s' % monitor_id, 
-                            headers=self.headers)
-        response = connection.getresponse()
+        :param entry: the message's entry in the session's AckWindow.
+        """
+        result = False
+        try:
+            data = payload
+            if session.message_filter is not None:
+                data = session.message_filter.apply(data)
+
+            if data is None:
+                result = True
+            else:
+                if session.codec is not None:
+                    data = session.codec(data)
+                start = time.time()
+                result = session.callback(data)
+                end = time.time()
+                session.stats.record_callback(end - start)
+                self.lane_stats[session.priority].record(end - received)
+        finally:
+            self.__settle(session, [(entry, result)])
+            self.__release(payload)
+            session.client.quota.release(1)
+            self.__wake()
 
+    def __take_batch(self, session):
+        """
+        Waits until the session has batch_size payloads pending or its oldest 
+        pending payload has waited batch_wait seconds, then removes and 
+        returns up to batch_size of them.  Returns an empty list if nothing 
+        is pending.
+        """
+        with self.__pending:
+            pending = session.pending
+            if not pending:
+                session.scheduled = False
+                return []
+            while len(pending) < session.batch_size:
+                remaining = pending[0][2] + session.batch_wait - time.time()
+                if remaining <= 0:
+                    break
+                self.__pending.wait(remaining)
+            batch = [pending.popleft() 
+                        for _ in xrange(min(session.batch_size, len(pending)))]
+            # Room was made for the IO thread.
+            self.__pending.notify_all()
+        # The session may be paused until its pending batches are taken.
+        self.__wake()
+        return batch
+
+    def __invoke_batch(self, session, batch):
+        """
+        Calls the session's registered callback once with the list of 
+        payloads in batch and sends PublishMessageReceived messages for all
+        of them if it returned True, or for those whose entry is true if it
+        returned a list of per payload statuses.  An AckHandle or future,
+        returned for the batch or as the status of a payload, is waited on.
+
+        :param session: the session the payloads were received on.
+        :param batch: list of (AckWindow entry, data, received time) tuples.
+        """
+        outcomes = []
+        entries = []
+        payloads = []
+        received = []
+        for entry, data, received_at in batch:
+            if session.message_filter is not None:
+                data = session.message_filter.apply(data)
+            if data is None:
+                outcomes.append((entry, True))
+                continue
+            if session.codec is not None:
+                try:
+                    data = session.codec(data)
+                except Exception, exception:
+                    # Left unacknowledged for iDigi to redeliver.
+                    self.log.exception(exception)
+                    outcomes.append((entry, False))
+                    continue
+            entries.append(entry)
+            payloads.append(data)
+            received.append(received_at)
+
+        result = False
         try:
-            if response.status != 200:
-                raise Exception("Monitor Could not be Deleted (%s): %s" \
-                    % (response.status, response.read()))
+            if payloads:
+                start = time.time()
+                result = session.callback(payloads)
+                end = time.time()
+                session.stats.record_callback(end - start)
+                lane_stats = self.lane_stats[session.priority]
+                for received_at in received:
+                    lane_stats.record(end - received_at)
         finally:
-            connection.close()
-        
-    def get_monitor(self, topics):
+            if isinstance(result, (list, tuple)):
+                # Payloads without a status are not acknowledged.
+                statuses = list(result[:len(entries)])
+                statuses.extend([False] * (len(entries) - len(statuses)))
+                outcomes.extend(zip(entries, statuses))
+            else:
+                outcomes.extend((entry, result) for entry in entries)
+            self.__settle(session, outcomes)
+            for _, payload, _ in batch:
+                self.__release(payload)
+            session.client.quota.release(len(batch))
+            self.__wake()
+
+    def __consume_queue(self, lanes=None):
         """
-        Attempts to find a Monitor in iDigi that matches the input list of 
-        topics.
-        
-        :param topics: a string list of topics 
-            (i.e. ['DeviceCore[U]', 'FileDataCore']).
-        
-        Returns a monitor ID if found, otherwise None.
+        Continually blocks until data is on the internal queue, then invokes 
+        the session's registered callback.  For sessions in batch mode the 
+        queue holds the session only, and its pending payloads are passed to 
+        the callback in batches until none are left.  A shared worker exits 
+        when it gets the None session queued to shrink the pool.
+
+        :param lanes: The lanes to serve, all lanes if None.
         """
-        # Query for Monitor conditionally by monTopic.
-        params = {'condition' : "monTopic='%s'" % ','.join(topics)}
-        url = '/ws/Monitor/.json?' + urllib.urlencode([(key, params[key]) \
-            for key in params])
-        
-        connection = self.get_http_connection()
-        connection.request('GET', url, headers=self.headers)
+        shared = lanes is None
+        while True:
+            session, entry, data, received = self.__queue.get(lanes=lanes)
+            if session is None:
+                with self.__scale_lock:
+                    self.__retiring -= 1
+                    self.size -= 1
+                self.__queue.task_done()
+                return
+            start = time.time()
+            try:
+                if session.batch_size > 1:
+                    while True:
+                        batch = self.__take_batch(session)
+                        if not batch:
+                            break
+                        self.__invoke_batch(session, batch)
+                else:
+                    self.__invoke(session, entry, data, received)
+            except Exception, exception:
+                self.log.exception(exception)
 
-        response = connection.getresponse()
+            self.__queue.task_done()
+            if shared:
+                with self.__scale_lock:
+                    self.__busy += time.time() - start
 
-        try:
-            content = response.read()
+    def __start_worker(self, lanes=None):
+        """
+        Starts a worker thread serving lanes.
+        """
+        worker = Thread(target=self.__consume_queue, args=(lanes,))
+        worker.daemon = True
+        worker.start()
 
-            if response.status != 200:
-                raise Exception("Monitor Could not be Retrieved (%s): %s" \
-                    % (response.status, content))
 
-            monitor_data = json.loads(content)
+    def __init__(self, write_queue=None, size=1, reserved=0, 
+                weights=LANE_WEIGHTS, buffers=None, max_size=None,
+                scale_interval=1.0, wakeup=None):
+        """
+        Creates a Callback Worker Pool for use in invoking Session Callbacks 
+        when data is received by a push client.
+
+        :param write_queue: :class:`LaneQueue` used for queueing up socket 
+            write events for when a payload message is received and 
+            processed.
+        :param size: The number of worker threads to invoke callbacks.
+        :param reserved: How many of the workers only invoke callbacks of 
+            PRIORITY_HIGH sessions.
+        :param weights: Relative share of the other workers given to each 
+            lane.
+        :param buffers: The :class:`BufferBudget` payloads held in memory 
+            are released to once their callback has returned.
+        :param max_size: The number of worker threads the pool may grow to,
+            None to keep size workers.
+        :param scale_interval: Seconds between evaluations of the pool's
+            utilization.
+        :param wakeup: Called, from the worker's thread, each time callbacks 
+            complete and their acknowledgements are queued.
+        """
+        if reserved >= size:
+            raise ValueError("At least one worker must not be reserved.")
+        if max_size is None:
+            max_size = size
+        if max_size < size:
+            raise ValueError("max_size must be at least size.")
+
+        # Used to queue up PublishMessageReceived events to be sent back to 
+        # the iDigi server.
+        self.__write_queue = write_queue
+        # Used to queue up sessions and data to callback with.
+        self.__queue = LaneQueue(weights, max_size)
+        self.__buffers = buffers
+        self.__wakeup = wakeup
+        # Guards the pending payloads of sessions in batch mode.
+        self.__pending = Condition()
+        # Number of workers running, and the bounds it is scaled within.
+        self.size           = size
+        self.min_size       = size
+        self.max_size       = max_size
+        self.reserved       = reserved
+        self.scale_interval = scale_interval
+        # Smoothed share of time the shared workers spend in callbacks.
+        self.utilization    = 0.0
+        # Delivery latency of each lane.
+        self.lane_stats     = [LaneStats() for _ in weights]
+        self.log            = logging.getLogger('callback_worker_pool')
+
+        # Guards the fields below, updated by workers and scale.
+        self.__scale_lock   = Lock()
+        # Seconds shared workers spent in callbacks since the last scale.
+        self.__busy         = 0.0
+        # Number of workers asked to exit that have not yet.
+        self.__retiring     = 0
+        # Consecutive evaluations that found the pool oversized.
+        self.__calm         = 0
+        self.__last_scale   = time.time()
+
+        for i in range(size): 
+            self.__start_worker((PRIORITY_HIGH,) if i < reserved else None)
+
+    def join(self):
+        """
+        Blocks until every queued callback has been invoked.
+        """
+        self.__queue.join()
+
+    def next_scale(self):
+        """
+        Returns the time at which :meth:`scale` next needs to evaluate the 
+        pool, or None while there is no need to: the pool is of fixed size, 
+        or is at its minimum size with nothing queued so that it can only 
+        grow once callbacks are queued again.  The utilization is then only 
+        updated when the IO thread wakes for other reasons.
+        """
+        if self.max_size == self.min_size or (self.size == self.min_size and 
+                not self.__retiring and not self.__queue.qsize()):
+            return None
+        return self.__last_scale + self.scale_interval
+
+    def scale(self, now):
+        """
+        Measures the utilization of the shared workers and resizes an 
+        autoscaling pool if scale_interval has passed since it was last 
+        evaluated.  Called periodically by the IO thread.
+
+        The pool grows as soon as the smoothed utilization of its shared 
+        workers reaches GROW_UTILIZATION or callbacks are queued for every 
+        one of them, straight to the size that brings utilization back to 
+        TARGET_UTILIZATION.  It only shrinks after SHRINK_AFTER consecutive 
+        evaluations found it larger than that size, and then by half the 
+        difference, so a bursty load does not make it oscillate.
+
+        :param now: The current time.
+        """
+        elapsed = now - self.__last_scale
+        if elapsed < self.scale_interval:
+            return
+
+        with self.__scale_lock:
+            busy = self.__busy
+            self.__busy = 0.0
+            self.__last_scale = now
+            shared = self.size - self.reserved - self.__retiring
+            # A callback running longer than the interval is only counted 
+            # when it returns, so the sample can exceed 1.
+            sample = min(1.0, busy / (elapsed * shared))
+            self.utilization = 0.5 * sample + 0.5 * self.utilization
+            queued = self.__queue.qsize()
+            if self.max_size == self.min_size:
+                return
+            # Shared workers needed to run at the target utilization.
+            needed = max(self.min_size - self.reserved, int(math.ceil(
+                shared * self.utilization / TARGET_UTILIZATION)))
+
+            grow = shrink = 0
+            if self.utilization >= GROW_UTILIZATION or queued >= shared:
+                self.__calm = 0
+                grow = min(self.max_size - self.size, max(1, needed - shared))
+                self.size += grow
+            elif needed < shared:
+                self.__calm += 1
+                if self.__calm >= SHRINK_AFTER:
+                    self.__calm = 0
+                    shrink = max(1, (shared - needed) // 2)
+                    self.__retiring += shrink
+            else:
+                self.__calm = 0
+
+        if grow:
+            self.log.info("Growing callback workers by %d to %d, " \
+                "utilization %.2f, %d queued." % (grow, self.size, 
+                self.utilization, queued))
+            for _ in xrange(grow):
+                self.__start_worker()
+        elif shrink:
+            self.log.info("Shrinking callback workers by %d from %d, " \
+                "utilization %.2f." % (shrink, self.size, self.utilization))
+            for _ in xrange(shrink):
+                # Only shared workers take from the normal lane.
+                self.__queue.put((None, None, None, None), PRIORITY_NORMAL)
+
+    def stats(self):
+        """
+        Returns a dict of the number of workers running, the bounds it is
+        scaled within, the smoothed utilization of the shared workers and
+        the number of callbacks queued.
+        """
+        return {'size' : self.size,
+                'min_size' : self.min_size,
+                'max_size' : self.max_size,
+                'utilization' : self.utilization,
+                'queued' : self.__queue.qsize()}
+
+    def throttled(self, session):
+        """
+        Returns True if session's AckWindow is full, its client has 
+        max_queued callbacks queued or, in batch mode, MAX_PENDING_BATCHES 
+        batches are pending, so that it must not be read from until 
+        callbacks complete.
+
+        :param session: the session data was received on.
+        """
+        quota = session.client.quota
+        acks = session.acks
+        pending = session.pending
+        return (acks is not None and acks.full()) or \
+            (quota.limit is not None and quota.used >= quota.limit) or \
+            (pending is not None and 
+                len(pending) >= MAX_PENDING_BATCHES * session.batch_size)
+
+    def has_room(self, session):
+        """
+        Returns True if queueing a callback for session would not block and 
+        it is not throttled.
+
+        :param session: the session data was received on.
+        """
+        if self.throttled(session):
+            return False
+        return session.batch_size > 1 or \
+            not self.__queue.full(session.priority)
+
+    def wait_for_room(self, priorities, timeout):
+        """
+        Waits up to timeout seconds for the queue of any of priorities to 
+        have room.
+        """
+        self.__queue.wait_for_room(priorities, timeout)
+
+    def queue_callback(self, session, block_id, data):
+        """
+        Queues up a callback event to occur for a session with the given 
+        payload data.  Will block if the queue is full, or for sessions in 
+        batch mode if MAX_PENDING_BATCHES batches are already pending.
+
+        :param session: the session with a defined callback function to call.
+        :param block_id: the block_id of the message received.
+        :param data: the data payload of the message received.
+        """
+        received = time.time()
+        if session.acks is None:
+            session.acks = AckWindow(session.max_in_flight)
+        entry = session.acks.open(block_id)
+        session.client.quota.charge(1)
+        if session.batch_size <= 1:
+            self.__queue.put((session, entry, data, received),
+                            session.priority)
+            return
+
+        with self.__pending:
+            if session.pending is None:
+                session.pending = deque()
+            while len(session.pending) >= \
+                    MAX_PENDING_BATCHES * session.batch_size:
+                self.__pending.wait()
+            session.pending.append((entry, data, received))
+            schedule = not session.scheduled
+            session.scheduled = True
+            # Wake a worker waiting for this session's batch to fill.
+            self.__pending.notify_all()
+
+        if schedule:
+            self.__queue.put((session, None, None, None), session.priority)
+
+class PushReactor(object):
+    """
+    The IO thread, writer thread and callback workers serving the sessions 
+    of one or more :class:`PushClient` instances.  Every client creates its 
+    own unless given one, a service with many accounts shares a single 
+    reactor between their clients so that threads, select loops and the 
+    buffer budget do not multiply with the number of accounts:
+
+        reactor = PushReactor(workers=8, max_workers=32)
+        clients = [push_client(username, password, reactor=reactor, 
+                                max_queued=256)
+                    for username, password in accounts]
+
+    Settings of the connection (credentials, hostname, spilling) remain 
+    those of each session's client.
+    """
+
+    def __init__(self, workers=1, reserved_workers=0, 
+                lane_weights=LANE_WEIGHTS, max_buffered=None, 
+                max_workers=None, scale_interval=1.0):
+        """
+        :param workers: Number of workers threads to process callback calls.
+        :param reserved_workers: Number of those workers dedicated to 
+            sessions created with PRIORITY_HIGH.
+        :param lane_weights: Relative share of the shared workers and of 
+            socket writes given to each priority lane while several lanes 
+            have work pending.
+        :param max_buffered: Maximum bytes of payloads held in memory across 
+            all sessions, None for no limit.
+        :param max_workers: If greater than workers, the number of callback
+            workers grows up to max_workers under load and shrinks back to
+            workers when idle.
+        :param scale_interval: Seconds between evaluations of callback
+            worker utilization when scaling.
+        """
+        # Table of PushSessions indexed by their socket's file descriptor.
+        self.sessions          = SessionTable()
+        # Bytes of payloads held in memory by all sessions.
+        self.buffers           = BufferBudget(max_buffered)
+        # Idle deadlines of sessions with an idle_timeout.
+        self.__idle_timers     = TimerWheel()
+        self.__idle_lock       = Lock()
+        # Sessions that could not be restarted, by the time of their next 
+        # attempt, and the delay before it.  Only used by the IO thread.
+        self.__restart_timers  = TimerWheel()
+        self.__restart_delays  = {}
+        # IO thread is used monitor sockets and consume data.
+        self.__io_thread       = None
+        # Writer thread is used to send data on sockets.
+        self.__writer_thread   = None
+        # Guards starting the threads, sessions may be registered by the 
+        # clients from any thread.
+        self.__start_lock      = Lock()
+        # (function, Event) pairs of calls the IO thread is to make between 
+        # reads, whether it is running to make them, and the lock guarding 
+        # both.
+        self.__io_calls        = []
+        self.__io_running      = False
+        self.__io_lock         = Lock()
+        # Clients being detached, whose sessions are no longer read from.
+        self.__draining        = set()
+        # Write queue is used to queue up data to write to sockets, in the 
+        # lane of the session's priority.
+        self.__write_queue     = LaneQueue(lane_weights)
+        # A pool that monitors callback events and invokes them.
+        self.__callback_pool   = CallbackWorkerPool(self.__write_queue, 
+                                                    size=workers, 
+                                                    reserved=reserved_workers,
+                                                    weights=lane_weights,
+                                                    buffers=self.buffers,
+                                                    max_size=max_workers,
+                                                    scale_interval=
+                                                        scale_interval,
+                                                    wakeup=
+                                                        self.__wake_paused)
+
+        self.closed            = False
+        # Set when sessions are being handed off to another process, so the
+        # IO thread leaves their sockets open when it stops.
+        self.__handing_off     = False
+        self.log               = logging.getLogger('push_client')
+
+    def lane_stats(self):
+        """
+        Returns a dict mapping each priority lane to a snapshot of its 
+        :class:`LaneStats`.
+        """
+        return dict((priority, stats.snapshot()) for priority, stats 
+                    in enumerate(self.__callback_pool.lane_stats))
+
+    def worker_stats(self):
+        """
+        Returns a dict of the current number of callback workers, the
+        bounds it is scaled within, their utilization and the number of
+        callbacks queued.
+        """
+        return self.__callback_pool.stats()
+
+    def register(self, session, connected=False):
+        """
+        Starts serving a session whose socket is connected, starting the 
+        IO and writer threads if they are not running.
+
+        :param session: The session.
+        :param connected: Whether the session has just connected, in which 
+            case its on_connect is called.
+        """
+        self.sessions.add(session)
+        self.__watch_idle(session)
+        if connected:
+            self.__connected(session)
+        self.__start()
+        # The IO thread only watches the new socket from its next poll.
+        self.sessions.wake()
+
+    def detach(self, client, timeout=STOP_TIMEOUT):
+        """
+        Stops the sessions of a client, leaving those of the reactor's other 
+        clients running.  Reading from them stops at once, then the 
+        callbacks of the messages already read are invoked and their 
+        acknowledgements sent before they are closed.  Blocks until they are 
+        closed, waiting timeout seconds at most for the callbacks and 
+        acknowledgements.
+
+        :param client: The :class:`PushClient`.
+        :param timeout: Seconds to wait, None to wait as long as it takes.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        # The sessions are paused and stopped by the IO thread, between 
+        # reads.
+        self.__call_io(lambda: self.__pause_client(client))
+        sessions = [session for session in self.sessions.values() 
+                    if session.client is client]
+        if self.__drain(sessions, deadline):
+            self.__flush_writes(deadline)
+        self.__call_io(lambda: self.__stop_client(client))
+
+    def __pause_client(self, client):
+        """
+        Stops reading from the sessions of a client being detached.
+        """
+        self.__draining.add(client)
+        for session in self.sessions.values():
+            if session.client is client and session.socket is not None:
+                self.sessions.pause(session)
+
+    def __stop_client(self, client):
+        """
+        Stops the sessions of a client being detached.
+        """
+        for session in self.sessions.values():
+            if session.client is client:
+                session.stop()
+        for session in self.__restart_delays.keys():
+            if session.client is client:
+                del self.__restart_delays[session]
+                self.__restart_timers.cancel(session)
+        self.sessions.clean()
+        self.__draining.discard(client)
+
+    def __call_io(self, function):
+        """
+        Has the IO thread call function between reads and waits for it to 
+        return, or calls it from this thread if the IO thread is not running.
+        """
+        done = Event()
+        with self.__io_lock:
+            inline = not self.__io_running
+            if not inline:
+                self.__io_calls.append((function, done))
+        if inline:
+            function()
+            return
+        self.sessions.wake()
+        done.wait()
+
+    def __run_io_calls(self):
+        """
+        Makes the calls queued by :meth:`__call_io`.
+        """
+        with self.__io_lock:
+            calls = self.__io_calls
+            self.__io_calls = []
+        for function, done in calls:
+            try:
+                function()
+            except Exception, err:
+                self.log.exception(err)
+            finally:
+                done.set()
+
+    def __drain(self, sessions, deadline):
+        """
+        Waits until deadline for the messages read from sessions to be 
+        acknowledged or rejected, which requires their callbacks to have 
+        returned.  Returns True if none remain.
+
+        :param deadline: Time to wait until, None for no limit.
+        """
+        drained = True
+        for session in sessions:
+            acks = session.acks
+            if session.socket is None or acks is None:
+                continue
+            if not acks.wait_empty(_remaining(deadline)):
+                self.log.warn("%d messages of Monitor %s still " \
+                    "unacknowledged when stopped." % (len(acks),
+                    session.monitor_id))
+                drained = False
+        return drained
+
+    def __flush_writes(self, deadline):
+        """
+        Waits until deadline for the writer thread to write what is queued.
+
+        :param deadline: Time to wait until, None for no limit.
+        """
+        writer = self.__writer_thread
+        if writer is None or not writer.is_alive():
+            return
+        # Each lane is written in order, a marker behind the writes of every 
+        # lane is reached once they are all written.
+        markers = []
+        for lane in xrange(len(self.__write_queue.weights)):
+            marker = Event()
+            self.__write_queue.put((None, marker), lane)
+            markers.append(marker)
+        for marker in markers:
+            marker.wait(_remaining(deadline))
+
+    def __wake_paused(self):
+        """
+        Wakes the IO thread if sessions are paused, a callback completing 
+        may have ended their throttling.
+        """
+        if self.sessions.has_paused():
+            self.sessions.wake()
 
-            # If no matching Monitor found, return None.
-            if monitor_data['resultSize'] == '0': 
-                return None
-            # Otherwise grab the first found monitor's id.
-            return monitor_data['items'][0]['monId']
-        finally:
-            connection.close()
-        
     def __restart_session(self, session):
         """
         Restarts and re-establishes session.
@@ -557,37 +2188,153 @@ class PushClient(object):
         if session.socket is not None:
             self.log.info("Attempting restart session for Monitor Id %s."
              % session.monitor_id)
-            del self.sessions[session.socket.fileno()]
+            self.sessions.remove(session.fileno)
             session.stop()
+            self.__reconnect(session)
+
+    def __reconnect(self, session):
+        """
+        Starts a stopped session and serves it again.  If it cannot be 
+        started, another attempt is scheduled RESTART_DELAY seconds later, 
+        twice as long after each further failure.
+
+        :param session: The stopped session.
+        """
+        try:
             session.start()
-            self.sessions[session.socket.fileno()] = session
+        except Exception, err:
+            delay = min(self.__restart_delays.get(session, 
+                        RESTART_DELAY / 2) * 2, MAX_RESTART_DELAY)
+            self.__restart_delays[session] = delay
+            self.__restart_timers.schedule(session, time.time() + delay)
+            self.log.error("Could not restart session for Monitor %s, " \
+                "retrying in %d seconds: %s" % (session.monitor_id, delay, 
+                err))
+            return
+        self.__restart_delays.pop(session, None)
+        session.last_activity = time.time()
+        self.sessions.add(session)
+        self.__watch_idle(session)
+        self.__connected(session)
+
+    def __retry_restarts(self, now):
+        """
+        Starts again the sessions that could not be restarted and are due 
+        for another attempt.
+
+        :param now: The current time.
+        """
+        for session in self.__restart_timers.expire(now):
+            if session.client.closed or session.client in self.__draining:
+                # Stopped meanwhile.
+                self.__restart_delays.pop(session, None)
+                continue
+            self.log.info("Attempting restart session for Monitor Id %s."
+                % session.monitor_id)
+            self.__reconnect(session)
+
+    def __connected(self, session):
+        """
+        Calls the on_connect callback of a session that just connected.
+
+        :param session: The session.
+        """
+        if session.on_connect is None:
+            return
+        try:
+            session.on_connect(session)
+        except Exception, exception:
+            session.log.exception(exception)
+
+    def __watch_idle(self, session):
+        """
+        Schedules the idle deadline of a session with an idle_timeout.
+
+        :param session: The session to watch.
+        """
+        if session.idle_timeout:
+            with self.__idle_lock:
+                self.__idle_timers.schedule(session, 
+                    session.last_activity + session.idle_timeout)
+
+    def __restart_idle(self, now):
+        """
+        Restarts the sessions that have not received data for longer than 
+        their idle_timeout.  Timers are not moved when data arrives: an 
+        expired timer of a session that received data since is simply 
+        scheduled again from its last activity.
+
+        :param now: The current time.
+        """
+        with self.__idle_lock:
+            expired = self.__idle_timers.expire(now)
+        for session in expired:
+            if session.socket is None or session.client in self.__draining:
+                # Stopped or being stopped, stop watching it.
+                continue
+            if session.last_activity + session.idle_timeout > now:
+                self.__watch_idle(session)
+                continue
+            self.log.warn("No data for %d seconds from Monitor %s, " \
+                "restarting session." % (now - session.last_activity, 
+                session.monitor_id))
+            session.last_activity = now
+            self.__watch_idle(session)
+            try:
+                self.__restart_session(session)
+            except Exception, err:
+                self.log.exception(err)
+
+    def __admit(self, session):
+        """
+        Decides where the body of the PublishMessage whose header was just 
+        read is received: in memory if it is no larger than spill_threshold 
+        and fits within the buffer budget, otherwise in a temporary file.
+
+        :param session: The session the header was read on.
+        """
+        length = session.message_length
+        threshold = session.client.spill_threshold
+        if (threshold is None or length - PAYLOAD_OFFSET <= threshold) and \
+                self.buffers.reserve(length):
+            session.reserved = length
+        else:
+            import tempfile
+            session.spill = tempfile.TemporaryFile(
+                dir=session.client.spill_dir)
+            session.spilled = 0
 
     def __writer(self):
         """
-        Indefinitely checks the writer queue for data to write
-        to socket.
+        Writes the data queued on the write queue to its socket, blocking 
+        while there is none, until WRITER_STOP is queued.  What is still 
+        queued then is written before returning.
         """
-        while not self.closed:
+        stopping = False
+        while True:
             try:
-                sock, data = self.__write_queue.get(timeout=0.1)
-                self.__write_queue.task_done()
-                sock.send(data)
+                if stopping:
+                    sock, data = self.__write_queue.get_nowait()
+                else:
+                    sock, data = self.__write_queue.get()
             except Empty:
-                pass # nothing to write after timeout
+                return
+            self.__write_queue.task_done()
+            if sock is None:
+                if data is None:
+                    stopping = True
+                elif not isinstance(data, str):
+                    # A marker of __flush_writes, the writes queued before 
+                    # it in its lane are done.
+                    data.set()
+                # Otherwise the session stopped before its acknowledgement 
+                # could be sent, iDigi redelivers the message.
+                continue
+            try:
+                sock.send(data)
             except socket.error, err:
                 if err.errno == errno.EBADF:
-                    self.__clean_dead_sessions()
-
-    def __clean_dead_sessions(self):
-        """
-        Traverses sessions to determine if any sockets
-        were removed (indicates a stopped session).  
-        In these cases, remove the session.
-        """
-        for sck in self.sessions.keys():
-            session = self.sessions[sck]
-            if session.socket is None:
-                del self.sessions[sck]
+                    self.sessions.clean()
 
     def __select(self):
         """
@@ -599,16 +2346,52 @@ class PushClient(object):
         try:
             while not self.closed:
                 try:
-                    inputready = \
-                        select.select(self.sessions.keys(), [], [], 0.1)[0]
-                    for sock in inputready:
-                        session = self.sessions[sock]
-                        sck = session.socket
+                    if self.__io_calls:
+                        self.__run_io_calls()
+                    self.sessions.clean()
+                    # Resume the sessions paused while throttled once they 
+                    # are not, the callback pool wakes the poll when 
+                    # callbacks complete.
+                    now = time.time()
+                    for session in self.sessions.paused():
+                        if session.client in self.__draining:
+                            # Being detached, not to be read from again.
+                            continue
+                        if self.__callback_pool.throttled(session):
+                            # Not idle, only not read from.
+                            session.last_activity = now
+                        else:
+                            self.sessions.resume(session)
+                    ready = self.sessions.poll(self.__poll_timeout(now))
+                    now = time.time()
+                    if len(ready) > 1:
+                        # Serve higher priority sessions first.
+                        ready.sort(key=lambda fd: getattr(
+                            self.sessions.get(fd), 'priority', 
+                            PRIORITY_NORMAL))
+                    # Priorities whose callback queue was full.
+                    deferred = set()
+                    for fd in ready:
+                        session = self.sessions.get(fd)
                         
-                        if sck is None:
+                        if session is None or session.socket is None:
                             # Socket has since been deleted, continue
                             continue
 
+                        session.last_activity = now
+                        if self.__callback_pool.throttled(session):
+                            # Rather than have every poll return at once for 
+                            # it, stop watching the session until callbacks 
+                            # or acknowledgements catch up.
+                            self.sessions.pause(session)
+                            continue
+                        if not self.__callback_pool.has_room(session):
+                            # Leave the data in the socket until the lane 
+                            # drains rather than blocking reads of sessions 
+                            # in other lanes.
+                            deferred.add(session.priority)
+                            continue
+
                         # If no defined message length, nothing has been 
                         # consumed yet, parse the header.
                         if session.message_length == 0:
@@ -630,6 +2413,14 @@ class PushClient(object):
                                     "not match PublishMessage (%x)" \
                                     % (response_type, PUBLISH_MESSAGE))
                                 continue
+                            elif session.message_length < PAYLOAD_OFFSET:
+                                self.log.error("Invalid PublishMessage " \
+                                    "length %d for Monitor %s." % \
+                                    (session.message_length, 
+                                    session.monitor_id))
+                                self.__restart_session(session)
+                                continue
+                            self.__admit(session)
 
                         try:
                             if not _read_msg(session):
@@ -640,10 +2431,10 @@ class PushClient(object):
                             # otherwise it was closed when it shouldn't
                             # have been restart it.
                             session.data = ""
-                            session.message_length = 0
+                            session.discard_message()
 
                             if session.socket is None:
-                                del self.sessions[sck]
+                                self.sessions.remove(fd)
                             else:
                                 self.log.exception(err)	
                                 self.__restart_session(session)
@@ -652,85 +2443,716 @@ class PushClient(object):
                         # We received full payload, 
                         # clear session data and parse it.
                         data = session.data
+                        spill = session.spill
+                        reserved = session.reserved
+                        wire_bytes = session.message_length - PAYLOAD_OFFSET
                         session.data = ""
                         session.message_length = 0
+                        session.spill = None
+                        session.spilled = 0
+                        session.reserved = 0
                         block_id = struct.unpack('!H', data[0:2])[0]
+                        aggregate_count = struct.unpack('!H', data[2:4])[0]
                         compression = struct.unpack('!B', data[4:5])[0]
-                        payload = data[10:]
-
-                        if compression == 0x01:
-                            # Data is compressed, uncompress it.
-                            payload = zlib.decompress(payload)
+                        try:
+                            if spill is None:
+                                payload = data[PAYLOAD_OFFSET:]
+                            del data
+
+                            if compression == 0x01:
+                                # Data is compressed, uncompress it.
+                                start = time.time()
+                                payload = _inflate(
+                                    [payload] if spill is None 
+                                    else _spill_chunks(spill), 
+                                    session.client.spill_threshold,
+                                    session.client.spill_dir)
+                                session.stats.record_payload(aggregate_count,
+                                    len(payload), wire_bytes, 
+                                    time.time() - start)
+                            else:
+                                if spill is not None:
+                                    payload = _map(spill)
+                                session.stats.record_payload(aggregate_count,
+                                                            len(payload))
+                                if session.stats.sampling and \
+                                        session.stats.payloads % \
+                                        SAMPLE_INTERVAL == 1 and \
+                                        isinstance(payload, str):
+                                    session.stats.record_sample(payload)
+                        finally:
+                            # The payload is accounted for instead of the 
+                            # message it was read from until its callback 
+                            # returns.
+                            self.buffers.release(reserved)
+                        if isinstance(payload, str):
+                            self.buffers.charge(len(payload))
                        
                         # Enqueue payload into a callback queue to be
                         # invoked.
                         self.__callback_pool.queue_callback(session, 
                             block_id, payload)
+
+                    if deferred:
+                        self.__callback_pool.wait_for_room(deferred, 0.01)
+
+                    self.__restart_idle(now)
+                    self.__retry_restarts(now)
+                    self.__callback_pool.scale(now)
                 except select.error, err:
                     # Evaluate sessions if we get a bad file descriptor, if 
                     # socket is gone, delete the session.
                     if err.args[0] == errno.EBADF:
-                        self.__clean_dead_sessions()
+                        self.sessions.clean()
                 except Exception, err:
                     self.log.exception(err)
         finally:
-            for session in self.sessions.values():
-                if session is not None: 
-                    session.stop()
-    
-    def __init_threads(self):
+            # The sessions are closed by stop once drained, or kept open 
+            # when handed off.
+            with self.__io_lock:
+                self.__io_running = False
+            self.__run_io_calls()
+
+    def __poll_timeout(self, now):
+        """
+        Returns the seconds the IO thread may block in poll for: until the 
+        next idle deadline, restart attempt or evaluation of the callback 
+        pool's size, None if none is due.  Sessions registered, callbacks 
+        completing and stopping wake it before.
+
+        :param now: The current time.
+        """
+        with self.__idle_lock:
+            idle = self.__idle_timers.next_expiry()
+        due = [expiry for expiry in (idle, 
+                                    self.__restart_timers.next_expiry(),
+                                    self.__callback_pool.next_scale())
+                if expiry is not None]
+        if not due:
+            return None
+        return max(0, min(due) - now)
+
+    def __start(self):
         """
         Initializes the IO and Writer threads
         """
-        if self.__io_thread is None:
-            self.__io_thread = Thread(target=self.__select)
-            self.__io_thread.start()
+        with self.__start_lock:
+            if self.__io_thread is None:
+                with self.__io_lock:
+                    self.__io_running = True
+                self.__io_thread = Thread(target=self.__select)
+                self.__io_thread.start()
+
+            if self.__writer_thread is None:
+                self.__writer_thread = Thread(target=self.__writer)
+                self.__writer_thread.start()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """
+        Stops all session activity.  Reading stops at once, then the 
+        callbacks of the messages already read are invoked and their 
+        acknowledgements sent before the sessions are closed.  Blocks until 
+        the IO and writer threads exit, waiting timeout seconds at most for 
+        the callbacks and acknowledgements, after which the sessions are 
+        closed regardless.
+
+        :param timeout: Seconds to wait, None to wait as long as it takes.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        self.closed = True
+        if self.__io_thread is not None:
+            self.log.info("Waiting for I/O thread to stop...")
+            self.sessions.wake()
+            self.__io_thread.join(_remaining(deadline))
+
+        # All data read has been queued, run the callbacks and send the 
+        # resulting acknowledgements.
+        self.__drain(self.sessions.values(), deadline)
+        if self.__writer_thread is not None:
+            self.log.info("Waiting for Writer Thread to stop...")
+            self.__write_queue.put(WRITER_STOP, PRIORITY_NORMAL)
+            # Not bounded by the deadline: sockets are non-blocking, so 
+            # writing what is queued does not take long.
+            self.__writer_thread.join()
+
+        for session in self.sessions.values():
+            session.stop()
+        self.sessions.clean()
+        running = [thread for thread in (self.__io_thread, 
+                                        self.__writer_thread) 
+                    if thread is not None and thread.is_alive()]
+        if running:
+            self.log.warn("%d threads still running after %s seconds, " \
+                "sessions closed regardless." % (len(running), timeout))
+        else:
+            self.sessions.close()
+            self.log.info("All worker threads stopped.")
+
+    def hand_off(self, ack_timeout=30):
+        """
+        Stops this reactor while keeping the sockets of its sessions open, 
+        see :meth:`PushClient.hand_off`.  Returns the state string, whose 
+        entries also record the username of each session's client.
+        """
+        import fcntl
+        import json
+
+        self.log.info("Handing off %d sessions." % len(self.sessions))
+        self.__handing_off = True
+        self.closed = True
+        # The IO thread may be blocked in poll on idle sessions.
+        self.sessions.wake()
+        if self.__io_thread is not None:
+            self.__io_thread.join()
+        # All data read has been queued, run the callbacks and send the 
+        # resulting acknowledgements.
+        self.__callback_pool.join()
+        deadline = time.time() + ack_timeout
+        for session in self.sessions.values():
+            acks = session.acks
+            if acks is None:
+                continue
+            if not acks.wait_empty(max(0, deadline - time.time())):
+                self.log.warn("%d messages of Monitor %s still " \
+                    "unacknowledged at hand off." % (len(acks),
+                    session.monitor_id))
+        if self.__writer_thread is not None:
+            self.__write_queue.put(WRITER_STOP, PRIORITY_NORMAL)
+            self.__writer_thread.join()
+        while True:
+            try:
+                sock, data = self.__write_queue.get_nowait()
+            except Empty:
+                break
+            self.__write_queue.task_done()
+            if sock is not None:
+                sock.setblocking(1)
+                sock.sendall(data)
+                sock.setblocking(0)
+
+        state = []
+        for session in self.sessions.values():
+            if session.socket is None:
+                continue
+            if isinstance(session, SecurePushSession) or \
+                    session.spill is not None:
+                # Neither SSL state nor a partially spilled message can be 
+                # handed over, the successor starts these anew.
+                session.stop()
+                state.append({'monitor_id' : session.monitor_id, 
+                                'username' : session.client.username,
+                                'fd' : None})
+                continue
+            fd = session.socket.fileno()
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+            state.append({'monitor_id' : session.monitor_id, 
+                            'username' : session.client.username,
+                            'fd' : fd, 
+                            'data' : base64.b64encode(session.data),
+                            'message_length' : session.message_length})
+        return json.dumps(state)
+
+class PushClient(object):
+    """
+    A Client for the 'Push' feature in iDigi.
+    """
+    
+    def __init__(self, username, password, hostname='developer.idigi.com', 
+                secure=True, ca_certs=None, workers=1, reserved_workers=0,
+                lane_weights=LANE_WEIGHTS, spill_threshold=None, 
+                max_buffered=None, spill_dir=None, keepalive=(60, 10, 6),
+                idle_timeout=None, max_workers=None, scale_interval=1.0,
+                reactor=None, max_queued=None, failover_hostnames=(), 
+                resolver=None):
+        """
+        Creates a Push Client for use in creating monitors and creating sessions 
+        for them.
+        
+        :param username: Username to authenticate with.
+        :param password: Password to authenticate with.
+        :param hostname: Hostname of iDigi server to connect to.
+        :param secure: Whether or not to create a secure SSL wrapped session.
+        :param ca_certs: Path to a file containing Certificates.  
+            If not provided, the idigi.crt file provided with the module will 
+            be used.  In most cases, the idigi.crt file should be acceptable.
+        :param workers: Number of workers threads to process callback calls.
+        :param reserved_workers: Number of those workers dedicated to 
+            sessions created with PRIORITY_HIGH.
+        :param lane_weights: Relative share of the shared workers and of 
+            socket writes given to each priority lane while several lanes 
+            have work pending.
+        :param spill_threshold: Size in bytes above which a payload is 
+            written to a temporary file as it is received, and passed to the 
+            callback as a read only mmap of that file rather than a string.  
+            The mmap is closed once the callback returns.  None to never 
+            spill payloads because of their size.
+        :param max_buffered: Maximum bytes of payloads held in memory across 
+            all sessions, None for no limit.  Payloads that would exceed it 
+            are spilled regardless of their size.
+        :param spill_dir: Directory for spilled payloads, None for the 
+            system default.
+        :param keepalive: TCP keepalive settings of session sockets, a tuple 
+            of seconds idle before probing, seconds between probes and 
+            number of probes, or None to disable keepalive.
+        :param idle_timeout: Default idle_timeout of sessions, see 
+            :meth:`create_session`.
+        :param max_workers: If greater than workers, the number of callback
+            workers grows up to max_workers under load and shrinks back to
+            workers when idle.
+        :param scale_interval: Seconds between evaluations of callback
+            worker utilization when scaling.
+        :param reactor: A :class:`PushReactor` shared with other clients to 
+            serve this client's sessions.  If not provided the client 
+            creates its own, and workers, reserved_workers, lane_weights, 
+            max_buffered, max_workers and scale_interval are passed to it, 
+            they are otherwise ignored.
+        :param max_queued: Maximum number of callbacks of this client's 
+            sessions queued or running at once, reading from its sessions 
+            pauses at the limit.  Keeps a busy client from occupying every 
+            worker of a shared reactor.  None for no limit.
+        :param failover_hostnames: iDigi servers to connect to, in order, 
+            when none of the addresses of hostname can be connected to.
+        :param resolver: The :class:`Resolver` caching the addresses of 
+            the servers and their connect times.  If not provided, one 
+            resolver is shared by all clients.
+        """
+        self.hostname        = hostname
+        self.failover_hostnames = list(failover_hostnames)
+        self.resolver        = resolver if resolver is not None else RESOLVER
+        self.username        = username
+        self.password        = password
+        self.secure          = secure
+        self.ca_certs        = ca_certs
+        self.spill_threshold = spill_threshold
+        self.spill_dir       = spill_dir
+        self.keepalive       = keepalive
+        self.idle_timeout    = idle_timeout
+        
+        # The reactor serving the sessions, and whether it is this client's.
+        self.__owns_reactor    = reactor is None
+        if reactor is None:
+            reactor = PushReactor(workers, reserved_workers, lane_weights, 
+                                    max_buffered, max_workers, scale_interval)
+        self.reactor           = reactor
+        # Table of PushSessions indexed by their socket's file descriptor, 
+        # holding those of every client of the reactor.
+        self.sessions          = reactor.sessions
+        # Bytes of payloads held in memory by all sessions of the reactor.
+        self.buffers           = reactor.buffers
+        # Callbacks of this client's sessions queued or running.
+        self.quota             = BufferBudget(max_queued)
+        # Format type of monitors, by monitor id.
+        self.__formats         = {}
+
+        self.closed            = False
+        self.log               = logging.getLogger('push_client')
+
+        self.headers           = {
+            'Authorization': 'Basic ' \
+            + base64.encodestring('%s:%s' %
+                (self.username,self.password))[:-1]
+        }
+
+    def session_stats(self):
+        """
+        Returns a dict mapping the monitor id of every active session of 
+        this client to a snapshot of its :class:`SessionStats`.
+        """
+        return dict((session.monitor_id, session.stats.snapshot())
+                    for session in self.sessions.values() 
+                    if session.client is self)
+
+    def lane_stats(self):
+        """
+        Returns a dict mapping each priority lane of the reactor to a 
+        snapshot of its :class:`LaneStats`.
+        """
+        return self.reactor.lane_stats()
+
+    def worker_stats(self):
+        """
+        Returns a dict of the current number of callback workers of the 
+        reactor, the bounds it is scaled within, their utilization and the 
+        number of callbacks queued.
+        """
+        return self.reactor.worker_stats()
+
+    def connect(self, port):
+        """
+        Returns a socket connected to port of hostname, or of the first 
+        failover hostname that accepts the connection, and the hostname it 
+        is connected to.  Connections are made through the client's 
+        resolver, see :class:`Resolver`.
+
+        :param port: The port to connect to.
+        """
+        keepalive = self.keepalive
+        return self.resolver.connect([self.hostname] + 
+                                    self.failover_hostnames, port, 
+                                    setup=lambda sock: _set_keepalive(sock, 
+                                                                keepalive))
+
+    def get_http_connection(self, hostname=None):
+        """
+        Returns a HTTPConnection or HTTPSConnection (depending on whether or 
+        not secure is set) to be used for interfacing with iDigi web services.
+
+        The connection is to hostname, unless every address it resolves to 
+        recently failed to connect and a failover hostname's did not.  It 
+        connects through the client's resolver, see :class:`Resolver`.
+
+        :param hostname: Host (and optional :port) to connect to instead, 
+            without failover.
+        """
+        import httplib
+        connection_class = httplib.HTTPSConnection if self.secure \
+            else httplib.HTTPConnection
+        hostnames = [self.hostname] + self.failover_hostnames \
+            if hostname is None else [hostname]
+        connections = [connection_class(name) for name in hostnames]
+        connection = ([candidate for candidate in connections 
+                        if self.resolver.healthy(candidate.host, 
+                                                candidate.port)] 
+                    or connections)[0]
+        connection._create_connection = self.resolver.create_connection
+        return connection
+
+
+    def create_monitor(self, topics, batch_size=1, batch_duration=0, 
+        compression='gzip', format_type='json'):
+        """
+        Creates a Monitor instance in iDigi for a given list of topics.
+        
+        :param topics: a string list of topics (i.e. ['DeviceCore[U]', 
+                  'FileDataCore']).
+        :param batch_size: How many Msgs received before sending data.
+        :param batrch_duration: How long to wait before sending batch if it 
+            does not exceed batch_size.
+        :param compression: Compression value (i.e. 'gzip').
+        :param format_type: What format server should send data in (i.e. 
+            'xml' or 'json').
+        
+        Returns a string of the created Monitor Id (i.e. 9001)
+        """
+        request = _monitor_request({ 'monTopic' : ','.join(topics), 
+                    'monBatchSize' : str(batch_size),
+                    'monBatchDuration' : str(batch_duration),
+                    'monFormatType' : format_type,
+                    'monTransportType' : 'tcp',
+                    'monCompression' : compression })
+
+        # POST Monitor Request.
+        connection = self.get_http_connection()
+        connection.request('POST', '/ws/Monitor', request, self.headers)
+        response = connection.getresponse()
+        try:
+            if response.status == 201:
+                location = response.getheader('location').split('/')[-1]
+                self.__formats[location] = format_type
+                return location
+            else:
+                raise Exception("Monitor Could not be Created (%d): %s" \
+                    % (response.status, response.read()))
+        finally:
+            connection.close()
+
+
+    def update_monitor(self, monitor_id, batch_size=None, 
+        batch_duration=None, compression=None):
+        """
+        Updates parameters of an existing Monitor in iDigi.  Parameters 
+        that are not given are left unchanged.
+
+        :param monitor_id: id of the Monitor (i.e. 1000).
+        :param batch_size: How many Msgs received before sending data.
+        :param batch_duration: How long to wait before sending batch if it 
+            does not exceed batch_size.
+        :param compression: Compression value (i.e. 'gzip').
+        """
+        attrs = {}
+        if batch_size is not None:
+            attrs['monBatchSize'] = str(batch_size)
+        if batch_duration is not None:
+            attrs['monBatchDuration'] = str(batch_duration)
+        if compression is not None:
+            attrs['monCompression'] = compression
+
+        connection = self.get_http_connection()
+        connection.request('PUT', '/ws/Monitor/%s' % monitor_id, 
+                            _monitor_request(attrs), self.headers)
+        response = connection.getresponse()
 
-        if self.__writer_thread is None:
-            self.__writer_thread = Thread(target=self.__writer)
-            self.__writer_thread.start()
+        try:
+            if response.status != 200:
+                raise Exception("Monitor Could not be Updated (%s): %s" \
+                    % (response.status, response.read()))
+        finally:
+            connection.close()
+
+    def get_monitor_format(self, monitor_id):
+        """
+        Returns the format type ('json' or 'xml') of a Monitor.  Formats 
+        of monitors created by this client are known without a request.
 
-           
-    def create_session(self, callback, monitor_id):
+        :param monitor_id: id of the Monitor (i.e. 1000).
+        """
+        format_type = self.__formats.get(str(monitor_id))
+        if format_type is not None:
+            return format_type
+
+        import json
+
+        connection = self.get_http_connection()
+        connection.request('GET', '/ws/Monitor/%s.json' % monitor_id, 
+                            headers=self.headers)
+        response = connection.getresponse()
+
+        try:
+            content = response.read()
+            if response.status != 200:
+                raise Exception("Monitor Could not be Retrieved (%s): %s" \
+                    % (response.status, content))
+            format_type = json.loads(content)['items'][0]['monFormatType']
+        finally:
+            connection.close()
+
+        self.__formats[str(monitor_id)] = format_type
+        return format_type
+
+    def codec_for(self, monitor_id, backend=None):
+        """
+        Returns a :class:`PayloadCodec` for the format of a Monitor.
+
+        :param monitor_id: id of the Monitor (i.e. 1000).
+        :param backend: For json monitors, the name of the module to decode 
+            with, None for the fastest installed.
+        """
+        from .codec import PayloadCodec
+        return PayloadCodec(self.get_monitor_format(monitor_id), backend)
+
+    def delete_monitor(self, monitor_id):
+        """
+        Attempts to Delete a Monitor from iDigi.  Throws exception if 
+        Monitor does not exist.
+
+        :param monitor_id: id of the Monitor (i.e. 1000).
+        """
+
+        connection = self.get_http_connection()
+        connection.request('DELETE', '/ws/Monitor/%s' % monitor_id, 
+                            headers=self.headers)
+        response = connection.getresponse()
+
+        try:
+            if response.status != 200:
+                raise Exception("Monitor Could not be Deleted (%s): %s" \
+                    % (response.status, response.read()))
+        finally:
+            connection.close()
+        
+    def get_monitor(self, topics):
+        """
+        Attempts to find a Monitor in iDigi that matches the input list of 
+        topics.
+        
+        :param topics: a string list of topics 
+            (i.e. ['DeviceCore[U]', 'FileDataCore']).
+        
+        Returns a monitor ID if found, otherwise None.
+        """
+        import json
+        import urllib
+
+        # Query for Monitor conditionally by monTopic.
+        params = {'condition' : "monTopic='%s'" % ','.join(topics)}
+        url = '/ws/Monitor/.json?' + urllib.urlencode([(key, params[key]) \
+            for key in params])
+        
+        connection = self.get_http_connection()
+        connection.request('GET', url, headers=self.headers)
+
+        response = connection.getresponse()
+
+        try:
+            content = response.read()
+
+            if response.status != 200:
+                raise Exception("Monitor Could not be Retrieved (%s): %s" \
+                    % (response.status, content))
+
+            monitor_data = json.loads(content)
+
+            # If no matching Monitor found, return None.
+            if monitor_data['resultSize'] == '0': 
+                return None
+            # Otherwise grab the first found monitor's id.
+            return monitor_data['items'][0]['monId']
+        finally:
+            connection.close()
+        
+    def create_session(self, callback, monitor_id, message_filter=None,
+                        batch_size=1, batch_wait=0.05, 
+                        priority=PRIORITY_NORMAL, idle_timeout=None,
+                        codec=None, max_in_flight=MAX_IN_FLIGHT,
+                        on_connect=None):
         """
         Creates and Returns a PushSession instance based on the input monitor
         and callback.  When data is received, callback will be invoked.
         If neither monitor or monitor_id are specified, throws an Exception.
         
-        :param callback: Callback function to call when PublishMessage 
-            messages are received. Expects 1 argument which will contain the 
-            payload of the pushed message.  Additionally, expects 
-            function to return True if callback was able to process 
-            the message, False or None otherwise.
+        :param callback: Callback function to call when PublishMessage
+            messages are received. Expects 1 argument which will contain the
+            payload of the pushed message.  Additionally, expects
+            function to return True if callback was able to process
+            the message, False or None otherwise.  A callback finishing
+            later may instead return an :class:`AckHandle` or a future, the
+            message is acknowledged once that completes successfully.  The
+            payload is released when the callback returns, so a spilled
+            (mmap) payload must be copied first.
         :param monitor_id: The id of the Monitor, will be queried 
             to understand parameters of the monitor.
+        :param message_filter: An optional :class:`MessageFilter`.  Messages 
+            it rejects are dropped before the payload is decoded and are 
+            not passed to callback.
+        :param batch_size: If greater than 1, callback is instead called 
+            with a list of up to batch_size payloads.  Returning True 
+            acknowledges all of them, returning a list of booleans, one per 
+            payload, acknowledges only those that are True.
+        :param batch_wait: Seconds to wait for batch_size payloads to arrive 
+            before calling back with those received so far.
+        :param priority: PRIORITY_HIGH to have the session's payloads read, 
+            called back and acknowledged ahead of PRIORITY_NORMAL sessions.
+        :param idle_timeout: Seconds without receiving any data after which 
+            the connection is assumed dead and restarted.  iDigi only sends 
+            when there are events, so this should be a few times the longest 
+            expected gap between batches (i.e. the monitor's 
+            monBatchDuration on a busy monitor).  Defaults to the client's 
+            idle_timeout, 0 disables it.
+        :param codec: An optional :class:`PayloadCodec`, or True for one 
+            matching the format of the monitor.  Payloads are then decoded 
+            by the callback worker and callback receives the decoded
+            documents instead.
+        :param max_in_flight: Maximum number of messages received but not
+            yet acknowledged or rejected, reading from the session pauses
+            while this many are outstanding.  Acknowledgements are always
+            sent in the order messages were received.
+        :param on_connect: Called with the session once it has connected, 
+            and again each time it reconnects after the connection was lost 
+            (i.e. to recover the events missed meanwhile, see 
+            :class:`GapBackfill`).  It is called from the IO thread and 
+            must not block.
         """
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        if codec is True:
+            codec = self.codec_for(monitor_id)
         self.log.info("Creating Session for Monitor %s." % monitor_id)
-        session = SecurePushSession(callback, monitor_id, self, self.ca_certs) \
-            if self.secure else PushSession(callback, monitor_id, self)
+        session = SecurePushSession(callback, monitor_id, self, self.ca_certs,
+                                    message_filter, batch_size, batch_wait,
+                                    priority, idle_timeout, codec,
+                                    max_in_flight, on_connect) \
+            if self.secure else PushSession(callback, monitor_id, self,
+                                            message_filter, batch_size,
+                                            batch_wait, priority,
+                                            idle_timeout, codec,
+                                            max_in_flight, on_connect)
 
         session.start()
-        self.sessions[session.socket.fileno()] = session
-        
-        self.__init_threads()
+        self.reactor.register(session, connected=True)
         return session
     
-    def stop_all(self):
+    def stop_all(self, timeout=STOP_TIMEOUT):
         """
-        Stops all session activity.  Blocks until io and writer thread dies.
+        Stops all session activity.  Reading stops at once, then the 
+        callbacks of the messages already read are invoked and their 
+        PublishMessageReceived messages sent before the sessions are 
+        closed.  Blocks until io and writer thread dies, or timeout seconds 
+        at most, after which the sessions are closed regardless.  When the 
+        client shares its reactor, only this client's sessions are stopped 
+        and the reactor keeps serving the other clients.
+
+        :param timeout: Seconds to wait, None to wait as long as it takes.
         """
-        if self.__io_thread is not None:
-            self.log.info("Waiting for I/O thread to stop...")
-            self.closed = True
-            
-            while self.__io_thread.is_alive():
-                time.sleep(1)
-
-        if self.__writer_thread is not None:
-            self.log.info("Waiting for Writer Thread to stop...")
-            self.closed = True
-
-            while self.__writer_thread.is_alive():
-                time.sleep(1)
+        self.closed = True
+        if self.__owns_reactor:
+            self.reactor.stop(timeout)
+            return
+        self.reactor.detach(self, timeout)
+        self.log.info("Stopped the sessions of %s." % self.username)
+
+    def hand_off(self, ack_timeout=30):
+        """
+        Stops this client while keeping the sockets of its sessions open so 
+        that a successor process can resume them without a new 
+        ConnectionRequest.  Returns a state string describing the sessions.
+
+        Callbacks already queued are invoked and their
+        PublishMessageReceived messages are sent before returning, waiting
+        up to ack_timeout seconds for deferred acknowledgements.  Partially 
+        read messages are recorded in the state and completed by the 
+        successor.  The sockets are made inheritable, so the successor must 
+        be started by exec (or as a child process that does not close 
+        descriptors) with the state in its HANDOFF_ENV environment variable:
+
+            os.environ[HANDOFF_ENV] = client.hand_off()
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+        SSL connection state cannot be transferred between processes, so 
+        secure sessions are closed and only their monitor id is recorded, 
+        :meth:`resume_session` starts a new session for them.
+
+        If the client shares its reactor, the sessions of all the reactor's 
+        clients are handed off, each entry of the state records the 
+        username of its client.
+        """
+        return self.reactor.hand_off(ack_timeout)
 
-        self.log.info("All worker threads stopped.")
\ No newline at end of file
+    def resume_session(self, callback, handoff, message_filter=None,
+                        batch_size=1, batch_wait=0.05, 
+                        priority=PRIORITY_NORMAL, idle_timeout=None,
+                        codec=None, max_in_flight=MAX_IN_FLIGHT,
+                        on_connect=None):
+        """
+        Resumes a session handed off by a predecessor process and returns 
+        it.  Sessions that could not be handed off are started anew.
+
+        :param callback: Callback function, as for :meth:`create_session`.
+        :param handoff: An entry of the list returned by 
+            :func:`handoff_state`.
+        :param message_filter: An optional :class:`MessageFilter`.
+        :param batch_size: As for :meth:`create_session`.
+        :param batch_wait: As for :meth:`create_session`.
+        :param priority: As for :meth:`create_session`.
+        :param idle_timeout: As for :meth:`create_session`.
+        :param codec: As for :meth:`create_session`.
+        :param max_in_flight: As for :meth:`create_session`.
+        :param on_connect: As for :meth:`create_session`, it is not called 
+            when the connection handed off is resumed.
+        """
+        monitor_id = handoff['monitor_id']
+        if handoff['fd'] is None:
+            return self.create_session(callback, monitor_id, message_filter,
+                                        batch_size, batch_wait, priority,
+                                        idle_timeout, codec, max_in_flight,
+                                        on_connect)
+
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        if codec is True:
+            codec = self.codec_for(monitor_id)
+        self.log.info("Resuming Session for Monitor %s." % monitor_id)
+        session = PushSession(callback, monitor_id, self, message_filter,
+                                batch_size, batch_wait, priority,
+                                idle_timeout, codec, max_in_flight,
+                                on_connect)
+        # fromfd duplicates the descriptor, close the inherited one.
+        session.socket = socket.fromfd(handoff['fd'], socket.AF_INET, 
+                                        socket.SOCK_STREAM)
+        os.close(handoff['fd'])
+        session.socket.setblocking(0)
+        session.fileno = session.socket.fileno()
+        session.data = base64.b64decode(handoff['data'])
+        session.message_length = handoff['message_length']
+        self.reactor.register(session)
+        return session
\ No newline at end of file
@@ -0,0 +1,379 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Endpoint Resolution
+
+Resolves the hostnames of iDigi servers with a cache, and connects to them
+by racing connection attempts across their addresses, preferring those
+that connected fastest before and avoiding those that recently failed.
+"""
+import errno
+import logging
+import os
+import select
+import socket
+import time
+
+from threading import Lock, Thread
+
+LOG = logging.getLogger("idigi_monitor_api.resolver")
+
+# Weight of the latest connect time in an address's smoothed connect time.
+CONNECT_TIME_WEIGHT = 0.3
+
+# Seconds before a failed lookup of a hostname with cached addresses is
+# tried again.
+RETRY_LOOKUP = 5.0
+
+# Errors of a non-blocking connect still in progress.
+IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+class AddressStats(object):
+    """
+    Connect statistics of one address and port.
+    """
+
+    __slots__ = ('connect_time', 'connects', 'failures', 'failed_at')
+
+    def __init__(self):
+        # Smoothed seconds taken to connect, None until connected once.
+        self.connect_time = None
+        self.connects     = 0
+        # Consecutive failures, and when the last one happened.
+        self.failures     = 0
+        self.failed_at    = 0
+
+    def snapshot(self):
+        """
+        Returns the statistics as a dict.
+        """
+        return {'connect_time' : self.connect_time,
+                'connects' : self.connects,
+                'failures' : self.failures,
+                'failed_at' : self.failed_at}
+
+class Resolver(object):
+    """
+    A cache of the addresses hostnames resolve to, and of how connecting
+    to each went.  One resolver is shared by all clients unless they are
+    given their own.
+
+    Addresses are cached for ttl seconds.  Once expired, they keep being
+    used while they are looked up again in the background, so a slow or
+    unavailable DNS server does not hold up connecting.
+
+    :meth:`connect` tries the addresses of a hostname, IPv4 and IPv6, in
+    order of their smoothed connect time, moving those that failed within
+    penalty seconds last.  If an attempt has not connected within
+    attempt_delay seconds the next one is started alongside it, and the
+    first to connect is used (RFC 6555, happy eyeballs), so an unreachable
+    address costs attempt_delay rather than a full connect timeout.
+    """
+
+    def __init__(self, ttl=300.0, attempt_delay=0.25, timeout=30.0,
+                penalty=60.0):
+        """
+        :param ttl: Seconds resolved addresses are cached for.
+        :param attempt_delay: Seconds to wait for an attempt to connect
+            before starting the next one.
+        :param timeout: Seconds to wait for the addresses of a hostname to
+            connect.
+        :param penalty: Seconds an address that failed to connect is tried
+            after all others.
+        """
+        self.ttl           = ttl
+        self.attempt_delay = attempt_delay
+        self.timeout       = timeout
+        self.penalty       = penalty
+        # Hostname -> (expiry, [(family, sockaddr)]).  Ports of the
+        # sockaddrs are those of the connection being made.
+        self.__cache       = {}
+        self.__refreshing  = set()
+        # (host, port) of an address -> AddressStats.
+        self.__stats       = {}
+        self.__lock        = Lock()
+
+    def stats(self):
+        """
+        Returns a dict mapping the (host, port) of each address connected
+        to, or tried, to a snapshot of its :class:`AddressStats`.
+        """
+        with self.__lock:
+            return dict((address, stats.snapshot())
+                        for address, stats in self.__stats.items())
+
+    def __lookup(self, hostname):
+        """
+        Resolves a hostname and caches its addresses.
+        """
+        addresses = []
+        for family, _, _, _, sockaddr in socket.getaddrinfo(hostname, None,
+                                            0, socket.SOCK_STREAM):
+            if (family, sockaddr) not in addresses:
+                addresses.append((family, sockaddr))
+        with self.__lock:
+            self.__cache[hostname] = (time.time() + self.ttl, addresses)
+        return addresses
+
+    def __refresh(self, hostname):
+        """
+        Resolves a hostname whose cached addresses expired, keeping them a
+        while longer if it fails.
+        """
+        try:
+            self.__lookup(hostname)
+        except socket.error, exception:
+            LOG.warn("Could not resolve %s, still using its previous " \
+                "addresses: %s" % (hostname, exception))
+            with self.__lock:
+                _, addresses = self.__cache[hostname]
+                self.__cache[hostname] = (time.time() + RETRY_LOOKUP,
+                                            addresses)
+        finally:
+            with self.__lock:
+                self.__refreshing.discard(hostname)
+
+    def resolve(self, hostname):
+        """
+        Returns the (family, sockaddr) of each address of hostname, from
+        the cache if there.  Raises socket.gaierror if it cannot be
+        resolved.
+
+        :param hostname: Hostname or address.
+        """
+        with self.__lock:
+            entry = self.__cache.get(hostname)
+            if entry is None:
+                refresh = False
+            else:
+                expiry, addresses = entry
+                refresh = expiry <= time.time() and \
+                    hostname not in self.__refreshing
+                if refresh:
+                    self.__refreshing.add(hostname)
+        if entry is None:
+            return self.__lookup(hostname)
+        if refresh:
+            thread = Thread(target=self.__refresh, args=(hostname,))
+            thread.daemon = True
+            thread.start()
+        return addresses
+
+    def __failing(self, stats, now):
+        """
+        Returns whether an address failed within penalty seconds.  Must
+        hold the lock.
+        """
+        return stats is not None and stats.failures > 0 and \
+            now - stats.failed_at < self.penalty
+
+    def healthy(self, hostname, port):
+        """
+        Returns False if every cached address of hostname failed to connect
+        on port within penalty seconds, True otherwise.  Does not resolve
+        hostname.
+
+        :param hostname: Hostname or address.
+        :param port: Port connected to.
+        """
+        now = time.time()
+        with self.__lock:
+            entry = self.__cache.get(hostname)
+            if not entry or not entry[1]:
+                return True
+            return not all(self.__failing(
+                            self.__stats.get((sockaddr[0], port)), now)
+                        for _, sockaddr in entry[1])
+
+    def rank(self, addresses, port):
+        """
+        Returns addresses in the order they are to be tried: those that did
+        not recently fail first, fastest first, then alternating between
+        families so that one broken family only delays the other by
+        attempt_delay.
+
+        :param addresses: (family, sockaddr) tuples.
+        :param port: Port connected to.
+        """
+        now = time.time()
+        with self.__lock:
+            def key(address):
+                stats = self.__stats.get((address[1][0], port))
+                if stats is None or stats.connect_time is None:
+                    # Unknown addresses are tried after those known to be
+                    # fast, and in the order they were resolved in.
+                    return (self.__failing(stats, now), self.attempt_delay)
+                return (self.__failing(stats, now), stats.connect_time)
+            ordered = sorted(addresses, key=key)
+        ranked = []
+        while ordered:
+            ranked.append(ordered.pop(0))
+            for index, address in enumerate(ordered):
+                if address[0] != ranked[-1][0]:
+                    ranked.append(ordered.pop(index))
+                    break
+        return ranked
+
+    def __record(self, address, connect_time=None):
+        """
+        Records a connect to address, that took connect_time seconds or
+        failed if None.
+        """
+        with self.__lock:
+            stats = self.__stats.get(address)
+            if stats is None:
+                stats = self.__stats[address] = AddressStats()
+            if connect_time is None:
+                stats.failures += 1
+                stats.failed_at = time.time()
+                return
+            stats.connects += 1
+            stats.failures = 0
+            if stats.connect_time is None:
+                stats.connect_time = connect_time
+            else:
+                stats.connect_time += CONNECT_TIME_WEIGHT * \
+                    (connect_time - stats.connect_time)
+
+    def __race(self, addresses, port, timeout, setup):
+        """
+        Connects to the first of addresses to accept a connection on port,
+        starting attempts attempt_delay apart.  Returns the connected
+        socket, in blocking mode.
+        """
+        deadline = time.time() + timeout
+        queue = list(addresses)
+        # File descriptor -> (socket, address, time started).
+        pending = {}
+        next_attempt = 0
+        error = None
+        try:
+            while queue or pending:
+                now = time.time()
+                if queue and (now >= next_attempt or not pending):
+                    family, sockaddr = queue.pop(0)
+                    address = (sockaddr[0], port)
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                    try:
+                        if setup is not None:
+                            setup(sock)
+                        sock.setblocking(0)
+                        code = sock.connect_ex((sockaddr[0], port) + \
+                                                tuple(sockaddr[2:]))
+                    except socket.error, exception:
+                        code = exception.errno or errno.EINVAL
+                    if code == 0:
+                        self.__record(address, time.time() - now)
+                        sock.setblocking(1)
+                        return sock
+                    if code in IN_PROGRESS:
+                        pending[sock.fileno()] = (sock, address, now)
+                        next_attempt = now + self.attempt_delay
+                    else:
+                        sock.close()
+                        self.__record(address)
+                        error = socket.error(code, os.strerror(code))
+                    continue
+                if now >= deadline:
+                    break
+                wait = deadline - now
+                if queue:
+                    wait = min(wait, next_attempt - now)
+                for fd in _wait_writable(pending.keys(), max(wait, 0)):
+                    sock, address, started = pending.pop(fd)
+                    code = sock.getsockopt(socket.SOL_SOCKET,
+                                            socket.SO_ERROR)
+                    if code == 0:
+                        self.__record(address, time.time() - started)
+                        sock.setblocking(1)
+                        return sock
+                    sock.close()
+                    self.__record(address)
+                    error = socket.error(code, os.strerror(code))
+                    # A failed attempt does not hold up the next one.
+                    next_attempt = 0
+            for sock, address, _ in pending.values():
+                self.__record(address)
+            raise error or socket.timeout("timed out")
+        finally:
+            for sock, _, _ in pending.values():
+                sock.close()
+
+    def connect(self, hostnames, port, timeout=None, setup=None):
+        """
+        Connects to the first of hostnames that any of its addresses
+        accepts a connection from, trying those whose addresses all failed
+        recently last.  Returns the connected socket, in blocking mode, and
+        the hostname connected to.  Raises socket.error if none connected.
+
+        :param hostnames: Hostnames, in order of preference (i.e. a primary
+            server followed by failover servers).
+        :param port: Port to connect to.
+        :param timeout: Seconds to wait for the addresses of each hostname,
+            defaults to the resolver's timeout.
+        :param setup: Optional function called with each socket before it
+            is connected, i.e. to set socket options.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        ordered = [hostname for hostname in hostnames
+                    if self.healthy(hostname, port)] + \
+            [hostname for hostname in hostnames
+                if not self.healthy(hostname, port)]
+        errors = []
+        for hostname in ordered:
+            try:
+                addresses = self.rank(self.resolve(hostname), port)
+                return self.__race(addresses, port, timeout, setup), hostname
+            except socket.error, exception:
+                LOG.warn("Could not connect to %s:%d: %s" % (hostname, port,
+                                                            exception))
+                errors.append("%s: %s" % (hostname, exception))
+        raise socket.error("Could not connect on port %d to %s." % (port,
+                            ', '.join(errors)))
+
+    def create_connection(self, address,
+                        timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                        source_address=None):
+        """
+        A replacement for socket.create_connection (i.e. of an httplib
+        connection's) that connects through the resolver.
+        """
+        def setup(sock):
+            if source_address:
+                sock.bind(source_address)
+        connect_timeout = None
+        if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT and \
+                timeout is not None:
+            connect_timeout = timeout
+        sock, _ = self.connect([address[0]], address[1], connect_timeout,
+                                setup)
+        if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(timeout)
+        return sock
+
+def _wait_writable(fds, timeout):
+    """
+    Waits up to timeout seconds for any of fds to be writable or in error,
+    and returns those that are.  Uses poll where available, so descriptors
+    above select's FD_SETSIZE can be waited on.
+    """
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLOUT)
+        return [fd for fd, _ in poller.poll(timeout * 1000)]
+    _, writable, errored = select.select([], fds, fds, timeout)
+    return set(writable) | set(errored)
+
+# Resolver shared by clients that are not given one.
+RESOLVER = Resolver()
@@ -0,0 +1,137 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+A local push server for tests, and a client whose sessions connect to it.
+"""
+import socket
+import struct
+import sys
+import threading
+import zlib
+
+from Queue import Queue
+
+import idigi_monitor_api
+from idigi_monitor_api.push_client import CONNECTION_RESPONSE, \
+    PUBLISH_MESSAGE, STATUS_OK
+
+# The module, as the package's push_client attribute is the function.
+PUSH_CLIENT = sys.modules['idigi_monitor_api.push_client']
+
+def recv_exactly(sock, size):
+    """
+    Reads size bytes from a blocking socket, raising EOFError if it closes.
+    """
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+class PushConnection(object):
+    """
+    The server side of one push session.
+    """
+
+    def __init__(self, sock, monitor_id):
+        self.sock       = sock
+        self.monitor_id = monitor_id
+
+    def publish(self, payload, block_id=1, compress=False):
+        """
+        Sends a PublishMessage holding payload.
+        """
+        if compress:
+            payload = zlib.compress(payload)
+        body = struct.pack('!HHBBI', block_id, 1, int(compress), 0,
+                            len(payload)) + payload
+        self.sock.sendall(struct.pack('!HI', PUBLISH_MESSAGE, len(body)) +
+                            body)
+
+    def read_ack(self):
+        """
+        Returns the block id and status of the next PublishMessageReceived.
+        """
+        _, block_id, status = struct.unpack('!HHH', recv_exactly(self.sock, 6))
+        return block_id, status
+
+    def close(self):
+        self.sock.close()
+
+class PushServer(object):
+    """
+    Accepts push sessions on an ephemeral port of the loopback interface,
+    answering their ConnectionRequests, and queues a :class:`PushConnection`
+    for each.  The first refuse ConnectionRequests are answered by closing
+    the connection instead.
+    """
+
+    def __init__(self, timeout=10):
+        """
+        :param timeout: Seconds socket operations wait before failing.
+        """
+        self.timeout     = timeout
+        self.refuse      = 0
+        self.connections = Queue()
+        self.listener    = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.port        = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.__accept)
+        thread.daemon = True
+        thread.start()
+
+    def __accept(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+                sock.settimeout(self.timeout)
+                _, length = struct.unpack('!HI', recv_exactly(sock, 6))
+                monitor_id = struct.unpack('!I',
+                                            recv_exactly(sock, length)[-4:])[0]
+                if self.refuse:
+                    self.refuse -= 1
+                    sock.close()
+                    continue
+                sock.sendall(struct.pack('!HIHH', CONNECTION_RESPONSE, 4,
+                                        STATUS_OK, 0))
+            except (EOFError, socket.error):
+                return
+            self.connections.put(PushConnection(sock, monitor_id))
+
+    def accept(self):
+        """
+        Returns the next session connected.
+        """
+        return self.connections.get(timeout=self.timeout)
+
+    def client(self, **kwargs):
+        """
+        Returns an insecure PushClient whose sessions connect to this
+        server.
+        """
+        PUSH_CLIENT.PUSH_OPEN_PORT = self.port
+        return idigi_monitor_api.push_client('test', 'test',
+                                            hostname='127.0.0.1',
+                                            secure=False, **kwargs)
+
+    def close(self):
+        try:
+            # Wakes the accepting thread.
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.listener.close()
+        PUSH_CLIENT.PUSH_OPEN_PORT = 3200
@@ -0,0 +1,76 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of the in order release of acknowledgements by AckWindow.
+"""
+import threading
+import unittest
+
+from idigi_monitor_api.push_client import AckHandle, AckWindow
+
+class AckWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+
+    def test_in_order(self):
+        window = AckWindow()
+        entries = [window.open(block_id) for block_id in xrange(1, 5)]
+        # Held back behind the first message.
+        window.resolve([(entries[1], True), (entries[3], True)], 
+                        self.sent.append)
+        self.assertEqual(self.sent, [])
+        window.resolve([(entries[0], True)], self.sent.append)
+        self.assertEqual(self.sent, [[1, 2]])
+        window.resolve([(entries[2], True)], self.sent.append)
+        self.assertEqual(self.sent, [[1, 2], [3, 4]])
+        self.assertEqual(len(window), 0)
+
+    def test_rejected_not_sent(self):
+        window = AckWindow()
+        entries = [window.open(block_id) for block_id in xrange(1, 4)]
+        window.resolve([(entries[0], False), (entries[2], True)], 
+                        self.sent.append)
+        self.assertEqual(self.sent, [])
+        window.resolve([(entries[1], True)], self.sent.append)
+        # The rejected message does not hold back those after it.
+        self.assertEqual(self.sent, [[2, 3]])
+
+    def test_full(self):
+        window = AckWindow(limit=2)
+        first = window.open(1)
+        window.open(2)
+        self.assertTrue(window.full())
+        window.resolve([(first, True)], self.sent.append)
+        self.assertFalse(window.full())
+
+    def test_closed(self):
+        window = AckWindow()
+        entry = window.open(1)
+        window.close()
+        window.resolve([(entry, True)], self.sent.append)
+        self.assertEqual(self.sent, [])
+        self.assertTrue(window.wait_empty(0))
+
+    def test_wait_empty(self):
+        window = AckWindow()
+        entry = window.open(1)
+        self.assertFalse(window.wait_empty(0.05))
+        handle = AckHandle()
+        handle.add_done_callback(lambda handle: window.resolve(
+            [(entry, handle.result())], self.sent.append))
+        threading.Timer(0.05, handle.ack).start()
+        self.assertTrue(window.wait_empty(5))
+        self.assertEqual(self.sent, [[1]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of the payload sampling for the compression controller.
+"""
+import unittest
+
+from idigi_monitor_api.adaptive import CompressionController
+
+from push_server import PUSH_CLIENT, PushServer
+
+class SampleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = PushServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_sampled_only_when_managed(self):
+        payload = 'x' * (PUSH_CLIENT.SAMPLE_SIZE + 1000)
+        client = self.server.client()
+        controller = CompressionController(client, interval=3600)
+        try:
+            session = client.create_session(lambda data: True, 1)
+            conn = self.server.accept()
+            conn.publish(payload, block_id=1)
+            self.assertEqual(conn.read_ack(), (1, 200))
+            self.assertTrue(session.stats.sample is None)
+
+            controller.manage(session, compression='none')
+            for block_id in xrange(2, PUSH_CLIENT.SAMPLE_INTERVAL + 2):
+                conn.publish(payload, block_id=block_id)
+                self.assertEqual(conn.read_ack(), (block_id, 200))
+            self.assertEqual(session.stats.sample, 
+                            payload[:PUSH_CLIENT.SAMPLE_SIZE])
+
+            controller.unmanage(session)
+            self.assertTrue(session.stats.sample is None)
+        finally:
+            controller.close()
+            client.stop_all()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of the panes and windows of WindowAggregator.
+"""
+import unittest
+
+from idigi_monitor_api.aggregation import WindowAggregator
+
+DEVICE = '00000000-00000000-00409DFF-FF000001'
+CHANNEL = 'sensor.temperature'
+
+class WindowAggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.results = []
+
+    def sink(self, results):
+        self.results.extend((result.start, result.end, result.count,
+                            result.min, result.max, result.mean, 
+                            result.last) for result in results)
+
+    def test_tumbling(self):
+        late = []
+        aggregator = WindowAggregator(self.sink, size=10, 
+                                        late=lambda *event: late.append(event))
+        aggregator.add(DEVICE, CHANNEL, 1, 1.0)
+        # Newest by timestamp, not by arrival.
+        aggregator.add(DEVICE, CHANNEL, 5, 3.0)
+        aggregator.add(DEVICE, CHANNEL, 4, 2.0)
+        self.assertEqual(self.results, [])
+        aggregator.add(DEVICE, CHANNEL, 12, 7.0)
+        self.assertEqual(self.results, [(0, 10, 3, 1.0, 3.0, 2.0, 3.0)])
+
+        self.assertFalse(aggregator.add(DEVICE, CHANNEL, 3, 5.0))
+        self.assertEqual(late, [(DEVICE, CHANNEL, 3, 5.0)])
+        self.assertEqual(aggregator.stats()['late'], 1)
+
+        aggregator.close()
+        self.assertEqual(self.results[1:], [(10, 20, 1, 7.0, 7.0, 7.0, 7.0)])
+        self.assertEqual(len(aggregator), 0)
+
+    def test_lateness(self):
+        aggregator = WindowAggregator(self.sink, size=10, lateness=5)
+        aggregator.add(DEVICE, CHANNEL, 1, 1.0)
+        aggregator.add(DEVICE, CHANNEL, 12, 2.0)
+        # Still within lateness of the latest event.
+        self.assertTrue(aggregator.add(DEVICE, CHANNEL, 9, 3.0))
+        self.assertEqual(self.results, [])
+        aggregator.add(DEVICE, CHANNEL, 15, 4.0)
+        self.assertEqual(self.results, [(0, 10, 2, 1.0, 3.0, 2.0, 3.0)])
+
+    def test_sliding(self):
+        aggregator = WindowAggregator(self.sink, size=30, slide=10)
+        aggregator.add(DEVICE, CHANNEL, 5, 5.0)
+        aggregator.add(DEVICE, CHANNEL, 15, 1.0)
+        aggregator.add(DEVICE, CHANNEL, 25, 9.0)
+        aggregator.add(DEVICE, CHANNEL, 35, 4.0)
+        self.assertEqual(self.results, 
+                        [(-20, 10, 1, 5.0, 5.0, 5.0, 5.0),
+                         (-10, 20, 2, 1.0, 5.0, 3.0, 1.0),
+                         (0, 30, 3, 1.0, 9.0, 5.0, 9.0)])
+        del self.results[:]
+
+        # The panes leaving the window take their minimum and maximum 
+        # with them.
+        aggregator.advance(100)
+        self.assertEqual(self.results,
+                        [(10, 40, 3, 1.0, 9.0, 14 / 3.0, 4.0),
+                         (20, 50, 2, 4.0, 9.0, 6.5, 4.0),
+                         (30, 60, 1, 4.0, 4.0, 4.0, 4.0)])
+        # Forgotten once its windows are emitted.
+        self.assertEqual(len(aggregator), 0)
+
+    def test_sliding_gap(self):
+        aggregator = WindowAggregator(self.sink, size=20, slide=10)
+        aggregator.add(DEVICE, CHANNEL, 5, 1.0)
+        aggregator.add(DEVICE, CHANNEL, 45, 2.0)
+        # Windows without values are not emitted.
+        self.assertEqual(self.results, 
+                        [(-10, 10, 1, 1.0, 1.0, 1.0, 1.0),
+                         (0, 20, 1, 1.0, 1.0, 1.0, 1.0)])
+        aggregator.close()
+        self.assertEqual(self.results[2:],
+                        [(30, 50, 1, 2.0, 2.0, 2.0, 2.0),
+                         (40, 60, 1, 2.0, 2.0, 2.0, 2.0)])
+
+    def test_max_keys(self):
+        aggregator = WindowAggregator(self.sink, size=10, max_keys=1)
+        self.assertTrue(aggregator.add(DEVICE, CHANNEL, 1, 1.0))
+        self.assertFalse(aggregator.add(DEVICE, 'other.channel', 1, 1.0))
+        self.assertEqual(aggregator.stats()['dropped'], 1)
+        aggregator.advance(10)
+        # Room once the first key is forgotten.
+        self.assertTrue(aggregator.add(DEVICE, 'other.channel', 11, 1.0))
+
+    def test_slide_divides_size(self):
+        self.assertRaises(ValueError, WindowAggregator, self.sink, size=30,
+                            slide=7)
+
+if __name__ == '__main__':
+    unittest.main()
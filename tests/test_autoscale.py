@@ -0,0 +1,115 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of the autoscaling of the callback worker pool.
+"""
+import threading
+import time
+import unittest
+
+from idigi_monitor_api.push_client import BufferBudget, CallbackWorkerPool, \
+    MAX_IN_FLIGHT, PRIORITY_NORMAL, SHRINK_AFTER, SessionStats
+
+class _Client(object):
+
+    def __init__(self):
+        self.quota = BufferBudget()
+
+class _Session(object):
+    """
+    The attributes of a PushSession the pool uses.
+    """
+
+    def __init__(self, callback):
+        self.callback       = callback
+        self.client         = _Client()
+        self.stats          = SessionStats()
+        self.acks           = None
+        self.max_in_flight  = MAX_IN_FLIGHT
+        self.batch_size     = 1
+        self.priority       = PRIORITY_NORMAL
+        self.message_filter = None
+        self.codec          = None
+        self.socket         = None
+
+class ScaleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.session = _Session(lambda data: self.release.wait(10))
+        self.now = 0
+
+    def tearDown(self):
+        self.release.set()
+
+    def scale(self, pool):
+        # As if scale_interval had passed since the last evaluation.
+        self.now = max(self.now, time.time()) + pool.scale_interval
+        pool.scale(self.now)
+
+    def wait_size(self, pool, size):
+        deadline = time.time() + 5
+        while pool.stats()['size'] != size:
+            self.assertTrue(time.time() < deadline, pool.stats())
+            time.sleep(0.01)
+
+    def queue(self, pool, count):
+        # Each lane holds up to max_size callbacks, beyond the running ones.
+        for block_id in xrange(count):
+            pool.queue_callback(self.session, block_id, '{}')
+
+    def test_fixed_size(self):
+        pool = CallbackWorkerPool(size=1)
+        self.queue(pool, 2)
+        self.assertEqual(pool.next_scale(), None)
+        self.scale(pool)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_grow_on_queue_depth(self):
+        pool = CallbackWorkerPool(size=1, max_size=3)
+        # Nothing to scale for while idle.
+        self.assertEqual(pool.next_scale(), None)
+        self.queue(pool, 4)
+        self.assertTrue(pool.next_scale() is not None)
+        self.scale(pool)
+        self.assertEqual(pool.stats()['size'], 2)
+        self.scale(pool)
+        self.scale(pool)
+        # Bounded by max_size.
+        self.assertEqual(pool.stats()['size'], 3)
+
+    def test_shrink_when_idle(self):
+        pool = CallbackWorkerPool(size=1, max_size=3)
+        self.queue(pool, 4)
+        self.scale(pool)
+        self.scale(pool)
+        self.assertEqual(pool.stats()['size'], 3)
+        self.release.set()
+        pool.join()
+
+        # Only after SHRINK_AFTER evaluations found it oversized.
+        for _ in xrange(SHRINK_AFTER - 1):
+            self.scale(pool)
+        self.assertEqual(pool.stats()['size'], 3)
+        self.scale(pool)
+        self.wait_size(pool, 2)
+        for _ in xrange(SHRINK_AFTER):
+            self.scale(pool)
+        self.wait_size(pool, 1)
+        for _ in xrange(SHRINK_AFTER):
+            self.scale(pool)
+        # Never below the initial size.
+        self.assertEqual(pool.stats()['size'], 1)
+        self.assertEqual(pool.next_scale(), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of GapBackfill with the web services replaced by a stub.
+"""
+import json
+import time
+import unittest
+
+from threading import Event
+
+from idigi_monitor_api import push_client, GapBackfill
+
+DEVICE = "00000000-00000000-00409DFF-FF000001"
+
+class StubPool(object):
+    """
+    Answers every query with items once released.
+    """
+
+    def __init__(self, items):
+        self.items    = items
+        self.released = Event()
+
+    def get_json(self, url):
+        self.released.wait(10)
+        return {'resultTotalRows' : len(self.items), 'items' : self.items}
+
+    def close(self):
+        pass
+
+class Session(object):
+    monitor_id = 1
+
+def device_core(timestamp):
+    return {"devConnectwareId" : DEVICE, "dpLastConnectTime" : timestamp}
+
+def payload(timestamp):
+    return json.dumps({"Document" : {"Msg" : {
+        "topic" : "1/DeviceCore/1/0",
+        "operation" : "UPDATE",
+        "timestamp" : timestamp,
+        "DeviceCore" : device_core(timestamp)}}})
+
+def wait_done(handle, timeout=10):
+    deadline = time.time() + timeout
+    while not handle.done and time.time() < deadline:
+        time.sleep(0.01)
+    return handle.done
+
+class GapBackfillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = push_client('test', 'test', hostname='127.0.0.1',
+                                secure=False)
+        self.delivered = []
+
+    def backfill(self, callback, items):
+        backfill = GapBackfill(self.client, callback, ['DeviceCore'],
+                                since='2012-06-12T00:00:00.000Z')
+        backfill.pool = StubPool(items)
+        return backfill
+
+    def test_held_payloads_follow_backfilled(self):
+        def callback(msg):
+            self.delivered.append(msg['timestamp'])
+            return True
+        backfill = self.backfill(callback,
+                                [device_core('2012-06-12T01:00:00.000Z')])
+        backfill.connected(Session())
+        handle = backfill(payload('2012-06-12T02:00:00.000Z'))
+        backfill.pool.released.set()
+        self.assertTrue(wait_done(handle))
+        self.assertTrue(handle.result())
+        self.assertEqual(self.delivered, ['2012-06-12T01:00:00.000Z',
+                                        '2012-06-12T02:00:00.000Z'])
+
+    def test_callback_raising_rejects_held_payloads(self):
+        def callback(msg):
+            if msg.get('backfilled'):
+                raise RuntimeError("callback failed")
+            self.delivered.append(msg['timestamp'])
+            return True
+        backfill = self.backfill(callback,
+                                [device_core('2012-06-12T01:00:00.000Z')])
+        backfill.connected(Session())
+        handles = [backfill(payload('2012-06-12T02:00:00.000Z')),
+                    backfill(payload('2012-06-12T03:00:00.000Z'))]
+        backfill.pool.released.set()
+        for handle in handles:
+            self.assertTrue(wait_done(handle))
+            self.assertFalse(handle.result())
+        # The backfill has ended, live payloads are delivered directly.
+        self.assertTrue(backfill(payload('2012-06-12T04:00:00.000Z')))
+        self.assertEqual(self.delivered, ['2012-06-12T04:00:00.000Z'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of the acknowledgement of payloads batched by DiaChannelBatcher.
+"""
+import json
+import unittest
+
+from idigi_monitor_api.batching import DiaChannelBatcher
+
+def _payload(*values):
+    """
+    Returns a DiaChannelDataFull monitor payload of an event per value.
+    """
+    return json.dumps({'Document' : {'Msg' : [
+        {'timestamp' : '2012-06-12T03:18:45.381Z',
+         'DiaChannelDataFull' : {
+            'id' : {'devConnectwareId' : '00000000-00000000-00409DFF-FF000001',
+                    'ddInstanceName' : 'sensor',
+                    'dcChannelName' : 'temperature'},
+            'dcdStringValue' : value}}
+        for value in values]}})
+
+class DiaChannelBatcherTest(unittest.TestCase):
+
+    def test_ack_on_add(self):
+        batches = []
+        batcher = DiaChannelBatcher(batches.append, size=2, duration=None)
+        self.assertTrue(batcher(_payload('1')) is True)
+        self.assertEqual(batches, [])
+
+    def test_ack_after_sink(self):
+        batches = []
+        batcher = DiaChannelBatcher(batches.append, size=2, duration=None,
+                                    ack_after_sink=True)
+        first = batcher(_payload('1'))
+        self.assertFalse(first.done)
+        # Completes the first batch and starts the second.
+        second = batcher(_payload('2', '3'))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(first.result(), True)
+        self.assertFalse(second.done)
+        batcher.close()
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(second.result(), True)
+        # Nothing to wait for.
+        self.assertEqual(batcher(json.dumps(
+            {'Document' : {'Msg' : []}})).result(), True)
+
+    def test_sink_failure_rejects(self):
+        def sink(batch):
+            raise IOError("disk full")
+        batcher = DiaChannelBatcher(sink, size=2, duration=None,
+                                    ack_after_sink=True)
+        handle = batcher(_payload('1', '2'))
+        self.assertEqual(handle.result(), False)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of the fan-out broker's log of unconfirmed payloads.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from idigi_monitor_api.broker import FanoutBroker, FanoutSubscriber
+
+class BrokerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'broker.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def subscribe(self, broker, name):
+        subscriber = FanoutSubscriber(self.path, name, durable=True)
+        deadline = time.time() + 5
+        while name not in broker.subscriber_stats():
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+        return subscriber
+
+    def disconnect(self, broker, subscriber):
+        subscriber.close()
+        deadline = time.time() + 5
+        while subscriber.name in broker.subscriber_stats():
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+
+    def test_redelivery_keeps_offset(self):
+        broker = FanoutBroker(self.path, confirm_timeout=0.1)
+        try:
+            self.disconnect(broker, self.subscribe(broker, 'durable'))
+            self.assertFalse(broker('a'))
+            # Redelivered by iDigi.
+            self.assertFalse(broker('a'))
+
+            subscriber = self.subscribe(broker, 'durable')
+            self.assertEqual(subscriber.receive(), (0, 'a'))
+            subscriber.confirm(0)
+            thread = threading.Thread(target=broker, args=('b',))
+            thread.start()
+            self.assertEqual(subscriber.receive(), (1, 'b'))
+            subscriber.confirm(1)
+            thread.join()
+            subscriber.close()
+        finally:
+            broker.close()
+
+    def test_unconfirmed_bytes_bounded(self):
+        broker = FanoutBroker(self.path, history=0, confirm_timeout=0.1,
+                                max_unconfirmed=250)
+        try:
+            self.disconnect(broker, self.subscribe(broker, 'durable'))
+            self.assertFalse(broker('a' * 100))
+            self.assertFalse(broker('b' * 100))
+            started = time.time()
+            self.assertFalse(broker('c' * 100))
+            # Refused without waiting for a confirmation.
+            self.assertTrue(time.time() - started < 0.05)
+
+            subscriber = self.subscribe(broker, 'durable')
+            self.assertEqual(subscriber.receive(), (0, 'a' * 100))
+            self.assertEqual(subscriber.receive(), (1, 'b' * 100))
+            subscriber.confirm(1)
+            # Refused until the broker has read the confirmation.
+            def redeliver():
+                while not broker('c' * 100):
+                    time.sleep(0.01)
+            thread = threading.Thread(target=redeliver)
+            thread.start()
+            self.assertEqual(subscriber.receive(), (2, 'c' * 100))
+            subscriber.confirm(2)
+            thread.join()
+            subscriber.close()
+        finally:
+            broker.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of the FileData sinks.
+"""
+import base64
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from idigi_monitor_api import filedata
+from idigi_monitor_api.filedata import DeviceLogDemux, FileDataSink
+
+def _payload(*files):
+    """
+    Returns a FileData monitor payload of (fdPath, fdName, data) files.
+    """
+    return json.dumps({'Document' : {'Msg' : [
+        {'topic' : 'FileData%s%s' % (path, name),
+         'FileData' : {'id' : {'fdPath' : path, 'fdName' : name},
+                        'fdLastModifiedDate' : '2012-06-12T03:18:45.381Z',
+                        'fdData' : base64.b64encode(data)}}
+        for path, name, data in files]}})
+
+class FileDataSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.synced = []
+        self.fsync_directory = filedata._fsync_directory
+        def record(path):
+            self.synced.append(path)
+            self.fsync_directory(path)
+        filedata._fsync_directory = record
+
+    def tearDown(self):
+        filedata._fsync_directory = self.fsync_directory
+        shutil.rmtree(self.directory)
+
+    def test_created_directories_synced(self):
+        sink = FileDataSink(self.directory)
+        self.assertTrue(sink(_payload(('/db/device/', 'a.txt', 'a'))))
+        directory = os.path.join(self.directory, 'db/device/2012/6/12')
+        # The parent of every directory created, then the file's own.
+        expected = [directory]
+        while directory != self.directory:
+            directory = os.path.dirname(directory)
+            expected.append(directory)
+        self.assertEqual(sorted(self.synced), sorted(expected))
+
+    def test_same_path_keeps_last(self):
+        sink = FileDataSink(self.directory)
+        self.assertTrue(sink(_payload(('/db/device/', 'a.txt', 'first'),
+                                      ('/db/device/', 'b.txt', 'other'),
+                                      ('/db/device/', 'a.txt', 'last'))))
+        directory = os.path.join(self.directory, 'db/device/2012/6/12')
+        with open(os.path.join(directory, 'a.txt')) as written:
+            self.assertEqual(written.read(), 'last')
+        with open(os.path.join(directory, 'b.txt')) as written:
+            self.assertEqual(written.read(), 'other')
+
+class DeviceLogDemuxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failed_write_is_kept(self):
+        demux = DeviceLogDemux(self.directory, flush_interval=None)
+        path = demux.path_for('device')
+        # The log cannot be opened while a directory is in its place.
+        os.mkdir(path)
+        demux.write('device', 'first\n')
+        demux.flush()
+        os.rmdir(path)
+        demux.write('device', 'second\n')
+        demux.close()
+        with open(path) as log:
+            self.assertEqual(log.read(), 'first\nsecond\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of filtering raw payloads with MessageFilter.
+"""
+import json
+import unittest
+
+from idigi_monitor_api.filters import MessageFilter
+
+DEVICE = '00000000-00000000-00409DFF-FF000001'
+OTHER = '00000000-00000000-00409DFF-FF000002'
+
+def _msg(topic, operation='UPDATE', device=DEVICE, value='1'):
+    return {'topic' : topic, 'operation' : operation,
+            'DeviceCore' : {'devConnectwareId' : device,
+                            'dpDescription' : value}}
+
+def _payload(*msgs):
+    return json.dumps({'Document' : {'Msg' : list(msgs)}})
+
+def _topics(payload):
+    msgs = json.loads(payload)['Document']['Msg']
+    if isinstance(msgs, dict):
+        msgs = [msgs]
+    return [msg['topic'] for msg in msgs]
+
+class MessageFilterTest(unittest.TestCase):
+
+    def test_no_criteria(self):
+        payload = _payload(_msg('1/DeviceCore/1'))
+        self.assertTrue(MessageFilter().apply(payload) is payload)
+
+    def test_wildcard_topic(self):
+        message_filter = MessageFilter(topics=['FileData/*/trace.log'])
+        payload = _payload(_msg('1/FileData/~/%s/trace.log' % DEVICE),
+                            _msg('1/FileData/~/%s/other.log' % DEVICE),
+                            _msg('1/DeviceCore/1'))
+        self.assertEqual(_topics(message_filter.apply(payload)),
+                        ['1/FileData/~/%s/trace.log' % DEVICE])
+
+    def test_all_match(self):
+        message_filter = MessageFilter(topics=['DeviceCore'])
+        payload = _payload(_msg('1/DeviceCore/1'), _msg('1/DeviceCore/2'))
+        self.assertTrue(message_filter.apply(payload) is payload)
+
+    def test_none_match(self):
+        message_filter = MessageFilter(operations=['DELETE'])
+        self.assertEqual(message_filter.apply(
+            _payload(_msg('1/DeviceCore/1'), _msg('1/DeviceCore/2'))), None)
+
+    def test_criteria_in_same_message(self):
+        # Each criterion matches somewhere in the document, only the 
+        # message matching both is accepted.
+        message_filter = MessageFilter(operations=['INSERT'],
+                                        device_ids=[DEVICE.lower()])
+        payload = _payload(_msg('1/DeviceCore/1', 'INSERT', OTHER),
+                            _msg('1/DeviceCore/2', 'UPDATE', DEVICE),
+                            _msg('1/DeviceCore/3', 'INSERT', DEVICE),
+                            _msg('1/DeviceCore/4', 'UPDATE', OTHER))
+        self.assertEqual(_topics(message_filter.apply(payload)), 
+                        ['1/DeviceCore/3'])
+
+    def test_separator_in_string(self):
+        # Split with the bracket scan rather than the separators.
+        message_filter = MessageFilter(topics=['DeviceCore/2'])
+        payload = _payload(_msg('1/DeviceCore/1', value='},{'),
+                            _msg('1/DeviceCore/2', value='[{'))
+        self.assertEqual(_topics(message_filter.apply(payload)), 
+                        ['1/DeviceCore/2'])
+
+    def test_channels(self):
+        message_filter = MessageFilter(channels=['xbee.temperature'])
+        def channel(instance, name):
+            return {'topic' : '1/DiaChannelDataFull/%s/%s' % (instance, name),
+                    'DiaChannelDataFull' : {'id' : {
+                        'ddInstanceName' : instance, 
+                        'dcChannelName' : name}}}
+        # Both halves match somewhere, but not as a pair.
+        payload = _payload(channel('xbee', 'humidity'),
+                            channel('modbus', 'temperature'),
+                            channel('xbee', 'temperature'))
+        self.assertEqual(_topics(message_filter.apply(payload)),
+                        ['1/DiaChannelDataFull/xbee/temperature'])
+
+    def test_xml(self):
+        message_filter = MessageFilter(topics=['DeviceCore'], 
+                                        format_type='xml')
+        payload = '<Document><Msg topic="1/DeviceCore/1"></Msg>' \
+            '<Msg topic="1/FileData/1"></Msg></Document>'
+        self.assertEqual(message_filter.apply(payload), 
+            '<Document><Msg topic="1/DeviceCore/1"></Msg></Document>')
+
+if __name__ == '__main__':
+    unittest.main()
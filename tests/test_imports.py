@@ -0,0 +1,58 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Checks that importing the package leaves the heavy modules unloaded, and 
+that importing it and building the first Monitor request stay fast.
+"""
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules only loaded once a feature needing them is used.
+DEFERRED = ('json', 'ssl', 'urllib', 'mmap', 'httplib', 'zlib', 
+            'xml.dom.minidom')
+
+# Seconds importing the package and building the first Monitor request may 
+# take, about ten times what they take on a developer machine.
+IMPORT_BUDGET = 0.5
+REQUEST_BUDGET = 0.01
+
+class ImportTest(unittest.TestCase):
+
+    def test_deferred_modules(self):
+        # A fresh interpreter, as this one has likely loaded them already.
+        output = subprocess.check_output([sys.executable, '-c',
+            'import sys, idigi_monitor_api\n'
+            'print " ".join(m for m in %r if m in sys.modules)' %
+            (DEFERRED,)], cwd=ROOT)
+        self.assertEqual(output.split(), [])
+
+    def test_import_time(self):
+        output = subprocess.check_output([sys.executable, '-c',
+            'import time\n'
+            'start = time.time()\n'
+            'from idigi_monitor_api.push_client import _monitor_request\n'
+            'imported = time.time()\n'
+            '_monitor_request({"monTopic" : "DeviceCore",\n'
+            '                  "monBatchSize" : "1"})\n'
+            'print imported - start, time.time() - imported'], cwd=ROOT)
+        import_time, request_time = map(float, output.split())
+        self.assertTrue(import_time < IMPORT_BUDGET, 
+                        "import took %.3fs" % import_time)
+        self.assertTrue(request_time < REQUEST_BUDGET, 
+                        "Monitor request took %.3fs" % request_time)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of the weighted round robin between priority lanes.
+"""
+import threading
+import unittest
+
+from Queue import Empty
+
+from idigi_monitor_api.push_client import LaneQueue
+
+class LaneQueueTest(unittest.TestCase):
+
+    def fill(self, queue, count):
+        for lane in xrange(len(queue.weights)):
+            for _ in xrange(count):
+                queue.put(lane, lane)
+
+    def test_smooth_order(self):
+        queue = LaneQueue(weights=(4, 2, 1))
+        self.fill(queue, 20)
+        # Interleaved rather than four of lane 0 in a row.
+        self.assertEqual([queue.get_nowait() for _ in xrange(14)],
+                        [0, 1, 0, 2, 0, 1, 0] * 2)
+
+    def test_idle_lane_share(self):
+        # The share of an empty lane goes to the others.
+        queue = LaneQueue(weights=(4, 1))
+        for _ in xrange(3):
+            queue.put(1, 1)
+        self.assertEqual([queue.get_nowait() for _ in xrange(3)], [1] * 3)
+        self.assertRaises(Empty, queue.get_nowait)
+
+    def test_lanes_restricted(self):
+        queue = LaneQueue(weights=(4, 1))
+        self.fill(queue, 2)
+        self.assertEqual([queue.get_nowait(lanes=[1]) for _ in xrange(2)],
+                        [1, 1])
+        self.assertRaises(Empty, queue.get_nowait, lanes=[1])
+        self.assertEqual(queue.qsize(0), 2)
+
+    def test_full_lane(self):
+        queue = LaneQueue(weights=(4, 1), maxsize=1)
+        queue.put(0, 0)
+        self.assertTrue(queue.full(0))
+        self.assertFalse(queue.full(1))
+        put = threading.Thread(target=queue.put, args=(0, 0))
+        put.start()
+        put.join(0.1)
+        # Blocked until the lane has room.
+        self.assertTrue(put.is_alive())
+        queue.get_nowait()
+        put.join(5)
+        self.assertFalse(put.is_alive())
+        self.assertEqual(queue.qsize(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
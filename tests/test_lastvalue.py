@@ -0,0 +1,52 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of the persisted values of the last value cache.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from idigi_monitor_api.lastvalue import LastValueCache, UNPERSISTED
+
+DEVICE = '00000000-00000000-00409DFF-FF000001'
+
+class LastValueCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'lastvalues')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_value_size_fits_header(self):
+        self.assertRaises(ValueError, LastValueCache, self.path, 
+                            value_size=UNPERSISTED)
+
+    def test_reload(self):
+        cache = LastValueCache(self.path, value_size=8)
+        cache.put(DEVICE, 'sensor.temperature', 100.0, '21.5')
+        cache.put(DEVICE, 'sensor.humidity', 100.0, 'too long to persist')
+        cache.close()
+
+        cache = LastValueCache(self.path, value_size=8)
+        try:
+            self.assertEqual(cache.get(DEVICE, 'sensor.temperature'), 
+                            (100.0, '21.5'))
+            self.assertEqual(cache.get(DEVICE, 'sensor.humidity'), None)
+        finally:
+            cache.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of the IO thread's wakeups.
+"""
+import os
+import socket
+import threading
+import time
+import unittest
+
+from idigi_monitor_api.push_client import SessionTable
+
+from push_server import PUSH_CLIENT, PushServer
+
+class SessionTableTest(unittest.TestCase):
+
+    def test_wake(self):
+        table = SessionTable()
+        try:
+            table.wake()
+            started = time.time()
+            table.poll(5)
+            self.assertTrue(time.time() - started < 1)
+        finally:
+            table.close()
+
+    def test_wake_while_draining(self):
+        # Wakes racing with the poll draining the pipe must not leave a 
+        # wake recorded without a byte to wake the next poll.
+        table = SessionTable()
+        stop = threading.Event()
+        def waker():
+            while not stop.is_set():
+                table.wake()
+        threads = [threading.Thread(target=waker) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        try:
+            deadline = time.time() + 2
+            while time.time() < deadline:
+                table.poll(1)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        try:
+            # Empty the pipe, then a single wake must be seen.
+            table.poll(0)
+            table.wake()
+            started = time.time()
+            table.poll(5)
+            self.assertTrue(time.time() - started < 1)
+        finally:
+            table.close()
+
+class RestartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = PushServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_connect_refused(self):
+        # A port nothing listens on.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        client = self.server.client()
+        PUSH_CLIENT.PUSH_OPEN_PORT = port
+        try:
+            self.assertRaises(socket.error, client.create_session,
+                                lambda data: True, 1)
+        finally:
+            client.stop_all()
+
+    def test_failed_restart_is_retried(self):
+        client = self.server.client()
+        try:
+            client.create_session(lambda data: True, 1)
+            # The session is restarted once the connection drops, and its
+            # ConnectionRequest is refused.
+            self.server.refuse = 1
+            self.server.accept().close()
+            conn = self.server.accept()
+            self.assertEqual(conn.monitor_id, 1)
+            conn.publish('{}')
+            self.assertEqual(conn.read_ack(), (1, 200))
+            self.assertEqual(len(client.sessions), 1)
+        finally:
+            client.stop_all()
+
+class BatchBacklogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = PushServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_backlog_does_not_spin(self):
+        # With MAX_PENDING_BATCHES batches pending behind a blocked 
+        # callback, the IO thread must wait rather than poll the session 
+        # over and over.
+        release = threading.Event()
+        def callback(payloads):
+            release.wait(10)
+            return True
+        client = self.server.client()
+        try:
+            client.create_session(callback, 1, batch_size=2, batch_wait=0)
+            conn = self.server.accept()
+            count = (PUSH_CLIENT.MAX_PENDING_BATCHES + 2) * 2 + 1
+            for block_id in xrange(1, count + 1):
+                conn.publish('{}', block_id=block_id)
+            time.sleep(0.5)
+            started = sum(os.times()[:2])
+            time.sleep(1)
+            self.assertTrue(sum(os.times()[:2]) - started < 0.5)
+            release.set()
+            acked = set(conn.read_ack()[0] for _ in xrange(count))
+            self.assertEqual(acked, set(xrange(1, count + 1)))
+        finally:
+            release.set()
+            client.stop_all()
+
+class HandOffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = PushServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_hand_off_idle(self):
+        client = self.server.client()
+        client.create_session(lambda data: True, 1)
+        conn = self.server.accept()
+        # Let the IO thread block in poll on the idle session.
+        time.sleep(0.5)
+        result = []
+        thread = threading.Thread(target=lambda:
+                                    result.append(client.hand_off()))
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        try:
+            self.assertFalse(thread.is_alive(), "hand_off did not return")
+            self.assertTrue(result[0])
+        finally:
+            for session in client.sessions.values():
+                session.socket.close()
+            conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of the ranking of addresses and of racing connections by Resolver.
+"""
+import select
+import socket
+import time
+import unittest
+
+from idigi_monitor_api.resolver import Resolver
+
+V4 = socket.AF_INET
+V6 = socket.AF_INET6
+
+def _free_port():
+    """
+    Returns a port nothing listens on.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    return port
+
+class ResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sockets = []
+        self.resolver = Resolver(attempt_delay=0.1, timeout=5)
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def listen(self, host, port=0, backlog=16):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind((host, port))
+        listener.listen(backlog)
+        self.sockets.append(listener)
+        return listener.getsockname()[1]
+
+    def stall(self, host, port):
+        """
+        Fills the accept queue of a listener so that connecting to it 
+        stays in progress.
+        """
+        while True:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            sock.connect_ex((host, port))
+            self.sockets.append(sock)
+            if not select.select([], [sock], [], 0.2)[1]:
+                return
+
+    def race(self, addresses, port):
+        return self.resolver._Resolver__race(addresses, port, 5, None)
+
+    def test_rank_alternates_families(self):
+        addresses = [(V4, ('10.0.0.1', 0)), (V4, ('10.0.0.2', 0)),
+                     (V6, ('fd00::1', 0, 0, 0))]
+        self.assertEqual(self.resolver.rank(addresses, 3200),
+                        [addresses[0], addresses[2], addresses[1]])
+
+    def test_slow_address_raced(self):
+        port = self.listen('127.0.0.1')
+        self.listen('127.0.0.2', port, backlog=0)
+        self.stall('127.0.0.2', port)
+        addresses = [(V4, ('127.0.0.2', 0)), (V4, ('127.0.0.1', 0))]
+        started = time.time()
+        sock = self.race(addresses, port)
+        elapsed = time.time() - started
+        self.sockets.append(sock)
+        self.assertEqual(sock.getpeername()[0], '127.0.0.1')
+        # The second attempt started attempt_delay after the first.
+        self.assertTrue(0.1 <= elapsed < 1, elapsed)
+        # Known to be fast, so tried before an address never connected to.
+        self.assertEqual(self.resolver.rank(addresses, port),
+                        [addresses[1], addresses[0]])
+
+    def test_refused_address_ranked_last(self):
+        port = _free_port()
+        refused = (V4, ('127.0.0.1', 0))
+        self.assertRaises(socket.error, self.race, [refused], port)
+        stats = self.resolver.stats()[('127.0.0.1', port)]
+        self.assertEqual(stats['failures'], 1)
+        unknown = (V4, ('127.0.0.2', 0))
+        self.assertEqual(self.resolver.rank([refused, unknown], port),
+                        [unknown, refused])
+        # Its failure does not hold up the next address.
+        self.listen('127.0.0.2', port)
+        started = time.time()
+        self.sockets.append(self.race([refused, unknown], port))
+        self.assertTrue(time.time() - started < 0.1)
+
+    def test_failover(self):
+        port = self.listen('127.0.0.2')
+        self.resolver.resolve('127.0.0.1')
+        sock, hostname = self.resolver.connect(['127.0.0.1', '127.0.0.2'],
+                                                port)
+        self.sockets.append(sock)
+        self.assertEqual(hostname, '127.0.0.2')
+        self.assertFalse(self.resolver.healthy('127.0.0.1', port))
+        # The failed hostname is tried last while it is penalized.
+        sock, hostname = self.resolver.connect(['127.0.0.1', '127.0.0.2'],
+                                                port)
+        self.sockets.append(sock)
+        self.assertEqual(hostname, '127.0.0.2')
+        self.assertEqual(
+            self.resolver.stats()[('127.0.0.1', port)]['failures'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+A run of examples/soak_test.py for SOAK_DURATION seconds, with disconnects,
+reconnect storms and slow callbacks compressed into that time.  Skipped
+unless SOAK_DURATION is set.
+"""
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@unittest.skipUnless(os.environ.get('SOAK_DURATION'), 
+                    "set SOAK_DURATION to run the soak test")
+class SoakTest(unittest.TestCase):
+
+    def run_soak(self, *args):
+        duration = float(os.environ['SOAK_DURATION'])
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + env.get('PYTHONPATH', '').split(os.pathsep))
+        process = subprocess.Popen([sys.executable,
+            os.path.join(ROOT, 'examples', 'soak_test.py'),
+            '--duration', str(duration), '--warmup', str(duration / 3),
+            '--sample', '1', '--sessions', '20', '--interval', '0.01',
+            '--disconnect-rate', '0.01', '--storm-every', '4',
+            '--slow-rate', '0.01', '--slow-time', '0.1'] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+
+    def test_soak(self):
+        self.run_soak()
+
+    def test_soak_compressed(self):
+        self.run_soak('--compress')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Sends payloads larger than spill_threshold through the callbacks shipped
+with the package, which are then passed an mmap rather than a string.
+"""
+import base64
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+
+from Queue import Queue
+
+from idigi_monitor_api.batching import DiaChannelBatcher
+from idigi_monitor_api.filedata import DeviceLogDemux, FileDataSink
+
+from push_server import PushServer
+
+# trace_client configures logging on import, a handler on the root logger
+# keeps it quiet.
+logging.getLogger().addHandler(logging.NullHandler())
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'examples'))
+from trace_client import fleet_callback
+
+THRESHOLD = 1024
+
+DEVICE = "00000000-00000000-00409DFF-FF000001"
+
+def file_data(name, content):
+    """ A FileData Msg of DEVICE """
+    return {"topic" : "1/FileData/~/%s/%s" % (DEVICE, name),
+            "operation" : "INSERT",
+            "timestamp" : "2012-06-12T03:18:45.381Z",
+            "FileData" : {
+                "id" : {"fdPath" : "/~/%s/" % DEVICE, "fdName" : name},
+                "fdLastModifiedDate" : "2012-06-12T03:18:45.381Z",
+                "fdSize" : len(content),
+                "fdData" : base64.b64encode(content)}}
+
+def dia_channel(i):
+    """ A DiaChannelDataFull Msg of DEVICE """
+    return {"topic" : "1/DiaChannelDataFull/%s/xbee/temperature" % DEVICE,
+            "operation" : "INSERT",
+            "timestamp" : "2012-06-12T03:18:45.381Z",
+            "DiaChannelDataFull" : {
+                "id" : {"devConnectwareId" : DEVICE,
+                        "ddInstanceName" : "xbee",
+                        "dcChannelName" : "temperature"},
+                "dcdUpdateTime" : "2012-06-12T03:18:45.381Z",
+                "dcdStringValue" : str(i),
+                "dcdFloatValue" : float(i),
+                "dcdDataType" : 2}}
+
+def document(msgs):
+    return json.dumps({"Document" : {"Msg" : msgs}})
+
+class SpillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = PushServer()
+        self.client = self.server.client(spill_threshold=THRESHOLD)
+        self.dest = tempfile.mkdtemp(prefix='test_spill')
+        # Type of each payload passed to the callback under test.
+        self.types = []
+
+    def tearDown(self):
+        self.client.stop_all()
+        self.server.close()
+        shutil.rmtree(self.dest)
+
+    def deliver(self, callback, payload, compress=False):
+        """
+        Sends payload on a session calling callback, returns its status.
+        """
+        def recording(data):
+            self.types.append(type(data).__name__)
+            return callback(data)
+        self.client.create_session(recording, 1)
+        conn = self.server.accept()
+        try:
+            conn.publish(payload, compress=compress)
+            return conn.read_ack()[1]
+        finally:
+            conn.close()
+
+    def test_default_keeps_payloads_in_memory(self):
+        self.client.stop_all()
+        self.client = self.server.client()
+        payload = document([file_data('a.bin', os.urandom(4 * THRESHOLD))])
+        self.assertEqual(self.deliver(json.loads, payload), 200)
+        self.assertEqual(self.types, ['str'])
+
+    def test_file_data_sink(self):
+        content = os.urandom(4 * THRESHOLD)
+        sink = FileDataSink(self.dest, fsync=False)
+        payload = document([file_data('a.bin', content)])
+        self.assertEqual(self.deliver(sink, payload), 200)
+        self.assertEqual(self.types, ['mmap'])
+        with open(os.path.join(self.dest, '~', DEVICE, '2012/6/12',
+                                'a.bin'), 'rb') as written:
+            self.assertEqual(written.read(), content)
+
+    def test_file_data_sink_compressed(self):
+        content = os.urandom(4 * THRESHOLD)
+        sink = FileDataSink(self.dest, fsync=False)
+        payload = document([file_data('a.bin', content)])
+        self.assertEqual(self.deliver(sink, payload, compress=True), 200)
+        self.assertEqual(self.types, ['mmap'])
+
+    def test_dia_channel_batcher(self):
+        batches = Queue()
+        batcher = DiaChannelBatcher(batches.put, size=100, duration=None)
+        payload = document([dia_channel(i) for i in xrange(100)])
+        self.assertTrue(len(payload) > THRESHOLD)
+        self.assertEqual(self.deliver(batcher, payload), 200)
+        self.assertEqual(self.types, ['mmap'])
+        self.assertEqual(len(batches.get(timeout=5)), 100)
+
+    def test_trace_client(self):
+        chunk = os.urandom(4 * THRESHOLD)
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gzipped = compressor.compress(chunk) + compressor.flush()
+        demux = DeviceLogDemux(self.dest, flush_interval=None)
+        payload = document([file_data('trace.log.gz', gzipped)])
+        self.assertEqual(self.deliver(fleet_callback(demux), payload), 200)
+        self.assertEqual(self.types, ['mmap'])
+        demux.close()
+        with open(demux.path_for(DEVICE)) as log:
+            self.assertEqual(log.read(), chunk)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# ***************************************************************************
+# Copyright (c) 2012 Digi International Inc.,
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+# ***************************************************************************
+"""
+Tests of the timer wheel of idle sessions.
+"""
+import time
+import unittest
+
+from idigi_monitor_api.push_client import TimerWheel
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        # The start of a tick, after the tick the wheel starts at.
+        self.now = float(int(time.time()) + 1)
+
+    def test_expire(self):
+        wheel = TimerWheel(tick=1.0)
+        wheel.schedule('a', self.now + 2.5)
+        wheel.schedule('b', self.now + 5.2)
+        self.assertEqual(len(wheel), 2)
+        self.assertEqual(wheel.next_expiry(), self.now + 3)
+        self.assertEqual(wheel.expire(self.now + 2.6), [])
+        # At the end of its tick, at most a tick late.
+        self.assertEqual(wheel.expire(self.now + 3), ['a'])
+        self.assertEqual(wheel.next_expiry(), self.now + 6)
+        self.assertEqual(wheel.expire(self.now + 10), ['b'])
+        self.assertEqual(len(wheel), 0)
+        self.assertEqual(wheel.next_expiry(), None)
+
+    def test_cancel_and_reschedule(self):
+        wheel = TimerWheel(tick=1.0)
+        wheel.schedule('a', self.now + 1.5)
+        wheel.schedule('b', self.now + 1.5)
+        wheel.cancel('a')
+        wheel.cancel('missing')
+        # Replaces the earlier timer.
+        wheel.schedule('b', self.now + 4.5)
+        self.assertEqual(wheel.expire(self.now + 3), [])
+        self.assertEqual(wheel.expire(self.now + 5), ['b'])
+
+    def test_past_deadline(self):
+        wheel = TimerWheel(tick=1.0)
+        wheel.expire(self.now + 3)
+        # Goes in the next tick rather than one already expired.
+        wheel.schedule('a', self.now)
+        self.assertEqual(wheel.expire(self.now + 4), ['a'])
+
+    def test_beyond_one_turn(self):
+        wheel = TimerWheel(tick=1.0, size=4)
+        wheel.schedule('a', self.now + 9.5)
+        # Its slot comes around twice before the deadline.
+        self.assertEqual(wheel.expire(self.now + 2), [])
+        self.assertEqual(wheel.expire(self.now + 6), [])
+        self.assertEqual(wheel.expire(self.now + 10), ['a'])
+
+if __name__ == '__main__':
+    unittest.main()